@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Delay analytics over the stored train history.
+
+Boards only give a train's status as text, such as "On Time", "Now 9:25PM"
+or "Second Boarding". parse_status() turns a status and scheduled time into
+a StatusInfo with the delay in minutes, the boarding phase and whether the
+train was cancelled. A history holds a few hundred distinct (scheduled time,
+status) pairs, so each pair is parsed once and the results are spread over
+every row with NumPy indexing instead of a Python loop per row.
+
+Two sources can be read:
+
+    locations   train_locations, the last status seen for each train. Cheap,
+                but a train that went on to board has lost its delay. With
+                --shards it is read from the history shards.
+    events      train_events, every status a train showed. The delay of a
+                train is the last delay it showed before it left the board.
+                Days pruned by `maintain` are read from their train_days
+                rollup, which keeps the last status giving a delay and the
+                final status.
+
+The summaries are delay percentiles per train number or per route (the
+train name, e.g. "Empire Service"), the effect of the day of the week, and a
+rolling average of the daily mean delay. `scrape.py analytics` prints them
+as a punctuality report.
+
+NumPy is only needed for this command and is imported on use.
+"""
+
+import datetime
+import functools
+import re
+import sqlite3
+from dataclasses import dataclass
+from typing import List, Optional, Sequence
+
+from scrape import DEFAULT_STATION
+from shards import ShardSet
+
+SOURCES = ['locations', 'events']
+GROUPS = ['train', 'route']
+
+PHASE_NONE = 0
+PHASE_BOARDING = 1
+PHASE_SECOND_BOARDING = 2
+PHASE_FINAL_CALL = 3
+
+BOARDING_PHASES = {
+    'boarding': PHASE_BOARDING,
+    'now boarding': PHASE_BOARDING,
+    'second boarding': PHASE_SECOND_BOARDING,
+    'final call': PHASE_FINAL_CALL,
+}
+
+CANCELLED_STATUSES = {'cancelled', 'canceled'}
+
+# Trains at most this late still count as on time, as in Amtrak's own reporting
+ON_TIME_MINUTES = 5
+
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+NOW_PATTERN = re.compile(r'now\s+(\d{1,2}):(\d{2})\s*([ap]m)', re.IGNORECASE)
+TIME_PATTERN = re.compile(r'(\d{1,2}):(\d{2})\s*([ap]m)', re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class StatusInfo:
+    # None when the status gives no estimate, e.g. "Boarding" or "Delayed"
+    delay_minutes: Optional[int]
+    boarding_phase: int = PHASE_NONE
+    cancelled: bool = False
+
+
+@dataclass
+class DelaySummary:
+    key: str
+    trains: int
+    with_delay: int
+    on_time_share: float
+    cancelled: int
+    mean_minutes: float
+    p50_minutes: float
+    p90_minutes: float
+    p95_minutes: float
+
+
+@dataclass
+class WeekdayEffect:
+    weekday: str
+    trains: int
+    mean_minutes: float
+    # Mean delay of the weekday minus the mean delay over all days
+    effect_minutes: float
+
+
+@dataclass
+class DailyDelay:
+    day: str
+    trains: int
+    mean_minutes: float
+    rolling_mean_minutes: float
+
+
+def import_numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError("Delay analytics need numpy, install it with `pipenv install`") from e
+    return numpy
+
+
+def minute_of_day(match) -> int:
+    hour, minute, meridiem = int(match.group(1)), int(match.group(2)), match.group(3).lower()
+    return (hour % 12 + (12 if meridiem == 'pm' else 0)) * 60 + minute
+
+
+@functools.lru_cache(maxsize=8192)
+def parse_status(status: Optional[str], schedule_time: Optional[str]) -> StatusInfo:
+    """Return what a board status says about a train scheduled at schedule_time, e.g. ("Now 9:25PM", "9:20 PM")."""
+    text = ' '.join((status or '').split()).lower()
+    if text == 'on time':
+        return StatusInfo(0)
+    if text in CANCELLED_STATUSES:
+        return StatusInfo(None, cancelled=True)
+    if text in BOARDING_PHASES:
+        return StatusInfo(None, boarding_phase=BOARDING_PHASES[text])
+    now = NOW_PATTERN.fullmatch(text)
+    scheduled = TIME_PATTERN.fullmatch(schedule_time.strip()) if schedule_time else None
+    if now and scheduled:
+        delay = minute_of_day(now) - minute_of_day(scheduled)
+        # A new time past midnight, or a train running early across it
+        if delay < -12 * 60:
+            delay += 24 * 60
+        elif delay > 12 * 60:
+            delay -= 24 * 60
+        return StatusInfo(delay)
+    return StatusInfo(None)
+
+
+@dataclass
+class History:
+    """
+    One row per train per day, as parallel NumPy arrays.
+
+    train and route are indexes into train_numbers and routes.
+    delay_minutes is NaN where no delay is known.
+    """
+    day: object
+    train: object
+    route: object
+    delay_minutes: object
+    boarding_phase: object
+    cancelled: object
+    train_numbers: List[str]
+    routes: List[str]
+
+    def __len__(self):
+        return len(self.day)
+
+
+def factorize(np, values) -> tuple:
+    """Return integer codes for values and the distinct values they index, in order of first appearance."""
+    index = {}
+    codes = np.fromiter((index.setdefault(value, len(index)) for value in values), dtype=np.int64,
+                        count=len(values))
+    return codes, list(index)
+
+
+def status_table(np, schedule_times: Sequence, statuses: Sequence, schedule_codes, status_codes):
+    """
+    Parse every distinct (schedule_time, status) pair once and spread the results over the rows.
+
+    Returns the delay (NaN if unknown), boarding phase and cancelled arrays of the rows.
+    """
+    pairs = schedule_codes * len(statuses) + status_codes
+    distinct, inverse = np.unique(pairs, return_inverse=True)
+    parsed = [parse_status(statuses[pair % len(statuses)], schedule_times[pair // len(statuses)])
+              for pair in distinct.tolist()]
+    delay = np.array([np.nan if info.delay_minutes is None else info.delay_minutes for info in parsed])
+    phase = np.array([info.boarding_phase for info in parsed], dtype=np.int8)
+    cancelled = np.array([info.cancelled for info in parsed], dtype=bool)
+    return delay[inverse], phase[inverse], cancelled[inverse]
+
+
+def _lookup_names(conn: sqlite3.Connection, table: str) -> list:
+    """Return a table's names as a list indexed by id, with None for missing ids and at the end for NULL."""
+    rows = conn.execute(f'SELECT id, name FROM {table}').fetchall()
+    names = [None] * (max((id for id, _ in rows), default=0) + 2)
+    for id, name in rows:
+        names[id] = name
+    return names
+
+
+def load_locations(conn: sqlite3.Connection, station: str, since_day: str, until_day: str) -> History:
+    """Read the last status of every train from train_locations, keeping names as lookup ids."""
+    np = import_numpy()
+    rows = conn.execute('''
+        SELECT day, train_number, schedule_time_id, train_name_id, status_id
+        FROM train_locations
+        WHERE station = ? AND day >= ? AND day <= ?
+    ''', (station, since_day, until_day)).fetchall()
+    schedule_times = _lookup_names(conn, 'schedule_times')
+    statuses = _lookup_names(conn, 'statuses')
+    train_names = _lookup_names(conn, 'train_names')
+    days, train_numbers, schedule_ids, name_ids, status_ids = zip(*rows) if rows else ((),) * 5
+
+    def ids(column, names):
+        # NULL ids point at the None kept at the end of names
+        return np.array([len(names) - 1 if id is None else id for id in column], dtype=np.int64)
+
+    day_codes, distinct_days = factorize(np, days)
+    train, numbers = factorize(np, train_numbers)
+    route, routes = factorize(np, ids(name_ids, train_names).tolist())
+    delay, phase, cancelled = status_table(np, schedule_times, statuses,
+                                           ids(schedule_ids, schedule_times), ids(status_ids, statuses))
+    return History(
+        day=np.array(distinct_days, dtype='datetime64[D]')[day_codes],
+        train=train,
+        route=route,
+        delay_minutes=delay,
+        boarding_phase=phase,
+        cancelled=cancelled,
+        train_numbers=numbers,
+        routes=[train_names[id] or '' for id in routes],
+    )
+
+
+def load_shard_locations(shard_dir: str, station: str, since_day: str, until_day: str) -> History:
+    """Read the last status of every train from the history shards, which each have their own lookup ids."""
+    np = import_numpy()
+    shard_set = ShardSet(shard_dir)
+    try:
+        rows = list(shard_set.query('''
+            SELECT day, train_number, schedule_time, train_name, status
+            FROM train_track_locations
+            WHERE station = ? AND day >= ? AND day <= ?
+        ''', (station, since_day, until_day), since_day=since_day, until_day=until_day))
+    finally:
+        shard_set.close()
+    days, train_numbers, schedule_times, train_names, statuses = zip(*rows) if rows else ((),) * 5
+    day_codes, distinct_days = factorize(np, days)
+    train, numbers = factorize(np, train_numbers)
+    route, routes = factorize(np, train_names)
+    schedule_codes, distinct_times = factorize(np, schedule_times)
+    status_codes, distinct_statuses = factorize(np, statuses)
+    delay, phase, cancelled = status_table(np, distinct_times, distinct_statuses, schedule_codes, status_codes)
+    return History(
+        day=np.array(distinct_days, dtype='datetime64[D]')[day_codes],
+        train=train,
+        route=route,
+        delay_minutes=delay,
+        boarding_phase=phase,
+        cancelled=cancelled,
+        train_numbers=numbers,
+        routes=[name or '' for name in routes],
+    )
+
+
+def load_events(conn: sqlite3.Connection, station: str, since_day: str, until_day: str) -> History:
+    """
+    Read every status shown by each train from train_events and reduce it to one row per train.
+
+    A train keeps the last delay it showed, the furthest boarding phase it
+    reached, and counts as cancelled, without a delay, if it was ever shown
+    cancelled. A day whose events were rolled up into train_days is read as
+    its last status giving a delay followed by its final status.
+    """
+    np = import_numpy()
+    rows = conn.execute('''
+        SELECT day, schedule_time, train_number, train_name, status
+        FROM train_events
+        WHERE station = ? AND event IN ('new', 'status') AND day >= ? AND day <= ?
+        ORDER BY observed_at, rowid
+    ''', (station, since_day, until_day)).fetchall()
+    event_days = {row[0] for row in rows}
+    rolled_up = []
+    for day, schedule_time, train_number, train_name, delay_status, final_status in conn.execute('''
+        SELECT day, schedule_time, train_number, train_name, delay_status, final_status
+        FROM train_days
+        WHERE station = ? AND day >= ? AND day <= ?
+        ORDER BY day, last_seen
+    ''', (station, since_day, until_day)):
+        if day in event_days:
+            continue
+        if delay_status is not None:
+            rolled_up.append((day, schedule_time, train_number, train_name, delay_status))
+        rolled_up.append((day, schedule_time, train_number, train_name, final_status))
+    rows = rolled_up + rows
+    days, schedule_times, train_numbers, train_names, statuses = zip(*rows) if rows else ((),) * 5
+    day_codes, distinct_days = factorize(np, days)
+    schedule_codes, distinct_times = factorize(np, schedule_times)
+    train, numbers = factorize(np, train_numbers)
+    route, routes = factorize(np, train_names)
+    status_codes, distinct_statuses = factorize(np, statuses)
+    delay, phase, cancelled = status_table(np, distinct_times, distinct_statuses, schedule_codes, status_codes)
+
+    # One key per train run: the same number on the same day at the same scheduled time
+    keys = (day_codes * len(distinct_times) + schedule_codes) * max(len(numbers), 1) + train
+    distinct_keys, inverse = np.unique(keys, return_inverse=True)
+    runs = len(distinct_keys)
+    # Rows are in observation order, so a run's last row is the one with the highest index
+    rows_index = np.arange(len(keys))
+    last_row = np.zeros(runs, dtype=np.int64)
+    np.maximum.at(last_row, inverse, rows_index)
+    last_known = np.full(runs, -1, dtype=np.int64)
+    known = ~np.isnan(delay)
+    np.maximum.at(last_known, inverse[known], rows_index[known])
+    last_delay = np.where(last_known >= 0, delay[last_known], np.nan)
+    furthest_phase = np.zeros(runs, dtype=np.int8)
+    np.maximum.at(furthest_phase, inverse, phase)
+    ever_cancelled = np.zeros(runs, dtype=bool)
+    np.logical_or.at(ever_cancelled, inverse, cancelled)
+    # A cancelled train never ran, so earlier estimates do not count as its delay
+    last_delay[ever_cancelled] = np.nan
+    return History(
+        day=np.array(distinct_days, dtype='datetime64[D]')[day_codes[last_row]],
+        train=train[last_row],
+        route=route[last_row],
+        delay_minutes=last_delay,
+        boarding_phase=furthest_phase,
+        cancelled=ever_cancelled,
+        train_numbers=numbers,
+        routes=[name or '' for name in routes],
+    )
+
+
+def load_history(conn: sqlite3.Connection, source: str = 'events', station: str = DEFAULT_STATION.code,
+                 since_day: str = '0000-01-01', until_day: str = '9999-12-31',
+                 shard_dir: Optional[str] = None) -> History:
+    """Load one row per train run from a source, reading train history from shard_dir if it is set."""
+    if source == 'locations' and shard_dir:
+        return load_shard_locations(shard_dir, station, since_day, until_day)
+    if source == 'locations':
+        return load_locations(conn, station, since_day, until_day)
+    return load_events(conn, station, since_day, until_day)
+
+
+def delay_percentiles(history: History, by: str = 'train',
+                      on_time_minutes: int = ON_TIME_MINUTES) -> List[DelaySummary]:
+    """Summarize the delay distribution of each train number or route, most delayed (p90) first."""
+    np = import_numpy()
+    groups = history.train if by == 'train' else history.route
+    names = history.train_numbers if by == 'train' else history.routes
+    if not len(history):
+        return []
+    # Sorted by group and then delay, NaN last, so each group is one slice
+    order = np.lexsort((history.delay_minutes, groups))
+    sorted_groups = groups[order]
+    sorted_delays = history.delay_minutes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+    trains = np.bincount(groups)
+    cancelled = np.bincount(groups, weights=history.cancelled)
+    summaries = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        group = int(sorted_groups[start])
+        delays = sorted_delays[start:end]
+        delays = delays[:np.count_nonzero(~np.isnan(delays))]
+        if len(delays):
+            p50, p90, p95 = np.percentile(delays, [50, 90, 95])
+            mean = float(delays.mean())
+            on_time = float(np.count_nonzero(delays <= on_time_minutes) / len(delays))
+        else:
+            p50 = p90 = p95 = mean = on_time = float('nan')
+        summaries.append(DelaySummary(
+            key=names[group],
+            trains=int(trains[group]),
+            with_delay=len(delays),
+            on_time_share=on_time,
+            cancelled=int(cancelled[group]),
+            mean_minutes=mean,
+            p50_minutes=float(p50),
+            p90_minutes=float(p90),
+            p95_minutes=float(p95),
+        ))
+    summaries.sort(key=lambda summary: (not summary.with_delay, -summary.p90_minutes if summary.with_delay else 0,
+                                        summary.key))
+    return summaries
+
+
+def weekday_effects(history: History) -> List[WeekdayEffect]:
+    """Return the mean delay of each day of the week and how far it is from the overall mean."""
+    np = import_numpy()
+    known = ~np.isnan(history.delay_minutes)
+    delays = history.delay_minutes[known]
+    # 1970-01-01 was a Thursday
+    weekdays = (history.day[known].astype(np.int64) + 3) % 7
+    counts = np.bincount(weekdays, minlength=7)
+    totals = np.bincount(weekdays, weights=delays, minlength=7)
+    overall = delays.mean() if len(delays) else float('nan')
+    effects = []
+    for weekday, name in enumerate(WEEKDAYS):
+        if counts[weekday]:
+            mean = totals[weekday] / counts[weekday]
+            effects.append(WeekdayEffect(name, int(counts[weekday]), float(mean), float(mean - overall)))
+    return effects
+
+
+def rolling_delay(history: History, window_days: int = 7) -> List[DailyDelay]:
+    """
+    Return the mean delay of each day with the mean over the window_days ending on it.
+
+    The rolling mean weights each train equally, and days without trains are
+    skipped rather than counted as zero.
+    """
+    np = import_numpy()
+    known = ~np.isnan(history.delay_minutes)
+    if not np.any(known):
+        return []
+    days = history.day[known].astype(np.int64)
+    first = days.min()
+    offsets = days - first
+    counts = np.bincount(offsets)
+    totals = np.bincount(offsets, weights=history.delay_minutes[known])
+    count_sums = np.cumsum(counts)
+    total_sums = np.cumsum(totals)
+    window_counts = count_sums - np.r_[np.zeros(window_days, dtype=count_sums.dtype), count_sums][:len(counts)]
+    window_totals = total_sums - np.r_[np.zeros(window_days), total_sums][:len(totals)]
+    return [
+        DailyDelay(
+            day=str(np.datetime64(int(first + offset), 'D')),
+            trains=int(counts[offset]),
+            mean_minutes=float(totals[offset] / counts[offset]),
+            rolling_mean_minutes=float(window_totals[offset] / window_counts[offset]),
+        )
+        for offset in np.flatnonzero(counts).tolist()
+    ]
+
+
+def month_range(month: str):
+    """Return the first and last day of a YYYY-MM month."""
+    first = datetime.date.fromisoformat(f'{month}-01')
+    following = (first.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return first.isoformat(), (following - datetime.timedelta(days=1)).isoformat()
+
+
+def run_report(db_path: str, since_day: str, until_day: str, source: str = 'events', by: str = 'train',
+               station: str = DEFAULT_STATION.code, window_days: int = 7, limit: int = 20,
+               shard_dir: Optional[str] = None):
+    """Print a punctuality report of matching trains between two days."""
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        history = load_history(conn, source, station, since_day, until_day, shard_dir)
+    finally:
+        conn.close()
+    if not len(history):
+        print(f"No trains recorded at {station} between {since_day} and {until_day}")
+        return
+
+    summaries = delay_percentiles(history, by)
+    print(f"{len(history)} trains at {station} from {since_day} to {until_day}, most delayed first")
+    for summary in summaries[:limit]:
+        if not summary.with_delay:
+            continue
+        print(f"{by.title()} {summary.key}: {summary.on_time_share:.0%} on time over {summary.with_delay}, "
+              f"mean {summary.mean_minutes:.1f} min, p50 {summary.p50_minutes:.0f}, "
+              f"p90 {summary.p90_minutes:.0f}, p95 {summary.p95_minutes:.0f}, {summary.cancelled} cancelled")
+    for effect in weekday_effects(history):
+        print(f"{effect.weekday}: mean {effect.mean_minutes:.1f} min ({effect.effect_minutes:+.1f}) "
+              f"over {effect.trains}")
+    for daily in rolling_delay(history, window_days):
+        print(f"{daily.day}: mean {daily.mean_minutes:.1f} min over {daily.trains}, "
+              f"{window_days} day mean {daily.rolling_mean_minutes:.1f}")
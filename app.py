@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Read-only HTTP service over the scraper's database.
+
+    GET /board?station=NYP                      current departures and arrivals
+    GET /trains/<number>?station=NYP            the train on the current board and its track
+    GET /trains/<number>/history?station=NYP    past tracks of a train number (?days=30)
+
+Responses are rendered once per database version and kept in memory, so
+repeated requests for the same resource do not touch SQLite. The version is
+PRAGMA data_version, which changes whenever the scraper commits a new board,
+and is checked at most once per check interval. Each response carries an
+ETag of its body, so clients can poll with If-None-Match and get a 304.
+
+The database path is read from SCRAPE_DB (default train_data.sqlite3), e.g.
+
+    SCRAPE_DB=train_data.sqlite3 make run_gunicorn
+
+If the scraper writes history to shards (--shards DIR), set SCRAPE_SHARDS=DIR
+as well so the history endpoint reads them.
+"""
+
+import dataclasses
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from itertools import islice
+from typing import Callable, Dict, Optional, Tuple
+
+from flask import Flask, Response, request
+
+from changes import ChangeDetector
+from query import track_distribution
+from scrape import DEFAULT_STATION, ScheduleBoard, current_day
+from shards import ShardSet
+
+MAX_HISTORY_DAYS = 366
+# Safety cap on the rows of a history response, well above a year of one train
+MAX_HISTORY_ROWS = 5000
+
+
+class ResponseCache:
+    """Rendered JSON responses, dropped whenever the database has changed."""
+
+    def __init__(self, db_path: str, check_interval: float = 1.0, max_entries: int = 4096,
+                 clock=time.monotonic, shard_dir: Optional[str] = None):
+        self.db_path = db_path
+        self.shard_dir = shard_dir
+        self.check_interval = check_interval
+        self.max_entries = max_entries
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.shard_set: Optional[ShardSet] = None
+        self.data_version = None
+        self.checked_at = None
+        self.boards: Dict[str, Optional[Tuple[str, ScheduleBoard]]] = {}
+        self.entries: Dict[tuple, Tuple[Optional[bytes], Optional[str]]] = {}
+
+    def _refresh(self):
+        now = self.clock()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        if self.conn is None:
+            self.conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        version = self.conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != self.data_version:
+            self.data_version = version
+            self.boards.clear()
+            self.entries.clear()
+
+    def board(self, station: str) -> Optional[Tuple[str, ScheduleBoard]]:
+        """Return the fingerprint and last stored board of a station, or None if it was never scraped."""
+        if station not in self.boards:
+            detector = ChangeDetector(self.conn, station)
+            self.boards[station] = (detector.fingerprint, detector.board()) if detector.fingerprint else None
+        return self.boards[station]
+
+    def shards(self) -> ShardSet:
+        """Return the history shards, opening their manifest on first use."""
+        if self.shard_set is None:
+            # Requests are rendered under the lock, one at a time, from any thread
+            self.shard_set = ShardSet(self.shard_dir, check_same_thread=False)
+        return self.shard_set
+
+    def get(self, key: tuple, render: Callable[['ResponseCache'], Optional[dict]]):
+        """
+        Return the (body, etag) cached for key, rendering it with render(self) on a miss.
+
+        A render returning None is cached as (None, None), for not found.
+        """
+        with self.lock:
+            self._refresh()
+            entry = self.entries.get(key)
+            if entry is None:
+                payload = render(self)
+                if payload is None:
+                    entry = (None, None)
+                else:
+                    body = json.dumps(payload).encode()
+                    entry = (body, hashlib.blake2b(body, digest_size=16).hexdigest())
+                if len(self.entries) >= self.max_entries:
+                    # Evict the oldest entry, dicts keep insertion order
+                    del self.entries[next(iter(self.entries))]
+                self.entries[key] = entry
+            return entry
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self.shard_set is not None:
+            self.shard_set.close()
+            self.shard_set = None
+
+
+def board_payload(cache: ResponseCache, station: str) -> Optional[dict]:
+    current = cache.board(station)
+    if current is None:
+        return None
+    fingerprint, board = current
+    return {
+        'station': station,
+        'fingerprint': fingerprint,
+        'departures': [dataclasses.asdict(train) for train in board.departures],
+        'arrivals': [dataclasses.asdict(train) for train in board.arrivals],
+    }
+
+
+def train_payload(cache: ResponseCache, station: str, train_number: str) -> Optional[dict]:
+    current = cache.board(station)
+    if current is None:
+        return None
+    _, board = current
+    trains = [
+        {'board': name, **dataclasses.asdict(train)}
+        for name, trains in (('departures', board.departures), ('arrivals', board.arrivals))
+        for train in trains
+        if train.train_number == train_number
+    ]
+    if not trains:
+        return None
+    return {'station': station, 'train_number': train_number, 'trains': trains}
+
+
+HISTORY_SQL = '''
+    SELECT day, schedule_time, train_name, destination, status, track
+    FROM train_track_locations
+    WHERE station = ? AND train_number = ? AND day >= ?
+    ORDER BY day DESC, time DESC
+    LIMIT ?
+'''
+
+
+def history_rows(cache: ResponseCache, station: str, train_number: str, days: int, today: str) -> list:
+    """Return a train's rows from the last `days` days before today, newest first, up to MAX_HISTORY_ROWS."""
+    since_day = (datetime.date.fromisoformat(today) - datetime.timedelta(days=days)).isoformat()
+    params = (station, train_number, since_day, MAX_HISTORY_ROWS)
+    if cache.shard_dir is None:
+        return cache.conn.execute(HISTORY_SQL, params).fetchall()
+    # Newest shard first, skipping shards before the window
+    rows = cache.shards().query(HISTORY_SQL, params, since_day=since_day, newest_first=True)
+    return list(islice(rows, MAX_HISTORY_ROWS))
+
+
+def history_payload(cache: ResponseCache, station: str, train_number: str, days: int,
+                    today: str) -> Optional[dict]:
+    rows = history_rows(cache, station, train_number, days, today)
+    if not rows:
+        return None
+    columns = ('day', 'schedule_time', 'train_name', 'destination', 'status', 'track')
+    return {
+        'station': station,
+        'train_number': train_number,
+        'history': [dict(zip(columns, row)) for row in rows],
+        'tracks': [dataclasses.asdict(share)
+                   for share in track_distribution(cache.conn, train_number=train_number, station=station)],
+    }
+
+
+def create_app(db_path: Optional[str] = None, check_interval: float = 1.0, shard_dir: Optional[str] = None) -> Flask:
+    app = Flask(__name__)
+    cache = ResponseCache(db_path or os.environ.get('SCRAPE_DB', 'train_data.sqlite3'), check_interval,
+                          shard_dir=shard_dir or os.environ.get('SCRAPE_SHARDS'))
+    app.extensions['response_cache'] = cache
+
+    def respond(key: tuple, render):
+        body, etag = cache.get(key, render)
+        if body is None:
+            return Response(json.dumps({'error': 'not found'}), status=404, mimetype='application/json')
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        # Let clients keep the body but revalidate it on every request
+        response.headers['Cache-Control'] = 'no-cache'
+        return response.make_conditional(request)
+
+    def station_arg() -> str:
+        return request.args.get('station', DEFAULT_STATION.code)
+
+    @app.get('/board')
+    def board():
+        station = station_arg()
+        return respond(('board', station), lambda cache: board_payload(cache, station))
+
+    @app.get('/trains/<train_number>')
+    def train(train_number):
+        station = station_arg()
+        return respond(('train', station, train_number), lambda cache: train_payload(cache, station, train_number))
+
+    @app.get('/trains/<train_number>/history')
+    def history(train_number):
+        station = station_arg()
+        days = min(max(request.args.get('days', 30, type=int), 1), MAX_HISTORY_DAYS)
+        # The window moves at midnight even if the database does not change
+        today = current_day()
+        return respond(('history', station, train_number, days, today),
+                       lambda cache: history_payload(cache, station, train_number, days, today))
+
+    return app
+
+
+app = create_app()
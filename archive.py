@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Archive of the raw board markup behind every poll.
+
+train_track_locations only keeps what the parser made of each board, so a
+parsing bug (such as parse_day_time once reading 12-hour times with %H,
+storing PM trains twelve hours early) cannot be repaired once the page is
+gone. FragmentArchive keeps every fetched
+departures/arrivals fragment in its own SQLite file, zlib-compressed and
+keyed by its blake2b hash, so a fragment identical to one fetched earlier is
+stored once and each fetch only adds a row of hashes and a timestamp.
+
+reparse() replays the archive through the current parser across a process
+pool and rebuilds the trains it saw in train_track_locations in a single
+transaction, or in their history shards with --shards.
+"""
+
+import hashlib
+import multiprocessing
+import sqlite3
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Iterator, Optional, Tuple
+
+from scrape import TrainWriter, parse_fragments
+from shards import open_writer
+
+ARCHIVE_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS fragments (
+        hash TEXT PRIMARY KEY,
+        data BLOB NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS fetches (
+        fetched_at INTEGER NOT NULL,
+        station TEXT NOT NULL,
+        day TEXT NOT NULL,
+        departures TEXT NOT NULL REFERENCES fragments (hash),
+        arrivals TEXT NOT NULL REFERENCES fragments (hash)
+    );
+    CREATE INDEX IF NOT EXISTS fetches_by_day ON fetches (day, station, fetched_at);
+'''
+
+
+def fragment_hash(fragment: str) -> str:
+    return hashlib.blake2b(fragment.encode(), digest_size=16).hexdigest()
+
+
+class FragmentArchive:
+    def __init__(self, path: str, compress_level: int = 9, read_only: bool = False):
+        self.path = path
+        self.compress_level = compress_level
+        if read_only:
+            self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+            return
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript(ARCHIVE_SCHEMA)
+
+    def _store(self, fragment: str) -> str:
+        digest = fragment_hash(fragment)
+        # Only compress fragments that are not archived yet
+        if self.conn.execute('SELECT 1 FROM fragments WHERE hash = ?', (digest,)).fetchone() is None:
+            self.conn.execute('INSERT INTO fragments (hash, data) VALUES (?, ?)',
+                              (digest, zlib.compress(fragment.encode(), self.compress_level)))
+        return digest
+
+    def record(self, station: str, day: str, departures_html: str, arrivals_html: str,
+               fetched_at: Optional[int] = None):
+        """Archive one fetch of a station's board."""
+        if fetched_at is None:
+            fetched_at = int(time.time())
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO fetches (fetched_at, station, day, departures, arrivals) VALUES (?, ?, ?, ?, ?)',
+                (fetched_at, station, day, self._store(departures_html), self._store(arrivals_html)),
+            )
+
+    def fragment(self, digest: str) -> str:
+        row = self.conn.execute('SELECT data FROM fragments WHERE hash = ?', (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        return zlib.decompress(row[0]).decode()
+
+    def fetches(self, since_day: Optional[str] = None, until_day: Optional[str] = None,
+                station: Optional[str] = None) -> Iterator[Tuple[int, str, str, str, str]]:
+        """Yield (fetched_at, station, day, departures hash, arrivals hash) in fetch order."""
+        clauses = ['day >= ?', 'day <= ?']
+        params = [since_day or '', until_day or '9999-12-31']
+        if station is not None:
+            clauses.append('station = ?')
+            params.append(station)
+        return self.conn.execute(f'''
+            SELECT fetched_at, station, day, departures, arrivals
+            FROM fetches
+            WHERE {' AND '.join(clauses)}
+            ORDER BY fetched_at, rowid
+        ''', params)
+
+    def close(self):
+        self.conn.close()
+
+
+@dataclass
+class ReparseStats:
+    fetches: int = 0
+    boards: int = 0
+    days: int = 0
+    rows: int = 0
+    skipped: int = 0
+
+
+# Read-only archive opened once per worker process by _init_worker
+_worker_archive: Optional[FragmentArchive] = None
+
+
+def _init_worker(archive_path: str):
+    global _worker_archive
+    _worker_archive = FragmentArchive(archive_path, read_only=True)
+
+
+def _parse_board(task):
+    """Parse one archived board, returning the database rows of its trains with tracks."""
+    station, day, departures_hash, arrivals_hash, parser = task
+    schedule_board = parse_fragments(_worker_archive.fragment(departures_hash),
+                                     _worker_archive.fragment(arrivals_hash), parser=parser)
+    trains = [train for train in schedule_board.departures + schedule_board.arrivals if train.track]
+    # The parsers stamp trains with today's date, the archive knows the day they were on the board
+    for train in trains:
+        train.day = day
+    return TrainWriter.to_rows(trains, station)
+
+
+def reparse(archive_path: str, db_path: str, parser: str = 'stream', workers: Optional[int] = None,
+            since_day: Optional[str] = None, until_day: Optional[str] = None,
+            station: Optional[str] = None, chunksize: int = 32, shard_dir: Optional[str] = None,
+            shard_period: str = 'month') -> ReparseStats:
+    """
+    Rebuild train_track_locations for the archived days from the raw fragments.
+
+    Like the live poller, only boards that differ from the station's previous
+    fetch are parsed, and each train keeps the last status and track it was
+    seen with. Only the trains the archive shows with a track are replaced,
+    in one transaction, or one per shard with shard_dir: the archive may
+    cover a day only in part, from when archiving was turned on or around
+    gaps, so trains it never saw tracked are left as they are.
+    """
+    stats = ReparseStats()
+    archive = FragmentArchive(archive_path, read_only=True)
+    tasks = []
+    covered = set()
+    previous = {}
+    try:
+        for _, code, day, departures_hash, arrivals_hash in archive.fetches(since_day, until_day, station):
+            stats.fetches += 1
+            covered.add((code, day))
+            board = (day, departures_hash, arrivals_hash)
+            if previous.get(code) != board:
+                previous[code] = board
+                tasks.append((code, day, departures_hash, arrivals_hash, parser))
+    finally:
+        archive.close()
+    stats.boards = len(tasks)
+    stats.days = len(covered)
+
+    latest = {}
+    workers = workers or multiprocessing.cpu_count()
+    if workers < 2:
+        _init_worker(archive_path)
+        parsed = map(_parse_board, tasks)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(archive_path,))
+        parsed = pool.map(_parse_board, tasks, chunksize=chunksize)
+    try:
+        # map preserves task order, so later boards overwrite earlier ones
+        for rows, skipped in parsed:
+            stats.skipped += skipped
+            for row in rows:
+                day, time_datetime, _, train_number = row[:4]
+                latest[(row[8], day, time_datetime, train_number)] = row
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        else:
+            _worker_archive.close()
+
+    writer = open_writer(db_path, shard_dir, shard_period)
+    try:
+        writer.replace_trains(latest.values())
+    finally:
+        writer.close()
+    stats.rows = len(latest)
+    return stats
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for start-up and the parse, scrape and upsert hot paths.
+
+Everything runs offline: pages come from the HTML fixtures in
+benchmarks/fixtures/ plus synthetic boards with hundreds of rows, and are
+served through a mocked primp.get. Results are written as JSON so runs can be
+compared, e.g.
+
+    python bench.py --output before.json
+    python bench.py --output after.json --db-sizes 0,1000000,10000000
+"""
+
+import argparse
+import contextlib
+import datetime
+import glob
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from unittest.mock import Mock, patch
+
+import scrape
+from scrape import DEFAULT_STATION, PARSERS, Train, TrainWriter, init_database
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'fixtures')
+
+TRAIN_NAMES = ['Northeast Regional', 'Acela', 'Empire Service', 'Keystone Service', 'Vermonter', 'Palmetto']
+DESTINATIONS = ['Washington, DC', 'Boston, MA', 'Albany-Rensselaer, NY', 'Harrisburg, PA', 'Philadelphia, PA']
+STATUSES = ['On Time', 'On Time', 'On Time', 'Now 9:25PM', 'Boarding', 'Second Boarding', 'Delayed']
+
+
+def synthetic_rows_html(rows: int, rng: random.Random) -> str:
+    parts = []
+    for i in range(rows):
+        minutes = (i * 7) % (24 * 60)
+        hour = minutes // 60 % 12 or 12
+        time_text = f"{hour}:{minutes % 60:02d} {'AM' if minutes < 12 * 60 else 'PM'}"
+        track = str(rng.randint(1, 21)) if rng.random() < 0.3 else ''
+        parts.append(
+            f'<tr class="amtrak-header-row"><td>{time_text}</td><td colspan="2">'
+            f'<span class="train-number">{100 + i}</span>&nbsp;'
+            f'<span class="train-name">{rng.choice(TRAIN_NAMES)}</span></td></tr>'
+            f'<tr class="amtrak-destination"><td colspan="2" class="pill-cell">'
+            f'<span class="pill-destination">{rng.choice(DESTINATIONS)}</span>'
+            f'<span class="pill-status ">{rng.choice(STATUSES)}</span></td>'
+            f'<td class="track-cell">{track}</td></tr>'
+        )
+    return ''.join(parts)
+
+
+def synthetic_page(rows: int, seed: int = 0, filler_kib: int = 200) -> str:
+    """
+    Return a full transportation page with `rows` departures and arrivals.
+
+    The boards are surrounded by filler markup standing in for the rest of
+    the page, which a full-page parser has to walk through as well.
+    """
+    rng = random.Random(seed)
+    filler_block = '<div class="promo"><p>Shop, dine and relax at Moynihan Train Hall.</p><img src="x.jpg"></div>'
+    filler = filler_block * (filler_kib * 1024 // len(filler_block))
+    return (
+        '<html><head><title>Transportation</title></head><body>'
+        f'{filler}'
+        '<div id="amtrak-departures-target"><table class="amtrak-table departures"><tbody>'
+        f'{synthetic_rows_html(rows, rng)}'
+        '</tbody></table></div>'
+        '<div id="amtrak-arrivals-target"><table class="amtrak-table arrivals"><tbody>'
+        f'{synthetic_rows_html(rows, rng)}'
+        '</tbody></table></div>'
+        f'{filler}'
+        '</body></html>'
+    )
+
+
+def load_pages(fixtures_dir: str, synthetic_rows, filler_kib: int = 200):
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(fixtures_dir, '*.html'))):
+        with open(path, encoding='utf-8') as f:
+            pages[os.path.basename(path)] = f.read()
+    for rows in synthetic_rows:
+        pages[f'synthetic-{rows}'] = synthetic_page(rows, filler_kib=filler_kib)
+    return pages
+
+
+@contextlib.contextmanager
+def quiet():
+    """Discard any output of the scraper while timing."""
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def time_calls(fn, repeat: int):
+    """Return timing statistics in milliseconds for `repeat` calls of fn."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {
+        'min_ms': min(timings),
+        'median_ms': statistics.median(timings),
+        'max_ms': max(timings),
+        'repeat': repeat,
+    }
+
+
+def measure_allocations(fn):
+    """Return the peak traced allocation size and block count of one call of fn."""
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    return {
+        'peak_kib': peak / 1024,
+        'retained_blocks': sum(stat.count for stat in snapshot.statistics('filename')),
+    }
+
+
+def mock_response(page: str):
+    response = Mock()
+    response.status_code = 200
+    response.text = page
+    response.content = page.encode()
+    response.headers = {}
+    return response
+
+
+def bench_parse(pages, repeat: int):
+    results = []
+    for name, page in pages.items():
+        for parser, parse_page in sorted(PARSERS.items()):
+            with quiet():
+                board = parse_page(page)
+                timing = time_calls(lambda: parse_page(page), repeat)
+                allocations = measure_allocations(lambda: parse_page(page))
+            results.append({
+                'page': name,
+                'parser': parser,
+                'page_kib': len(page) / 1024,
+                'trains': len(board.departures) + len(board.arrivals),
+                **timing,
+                **allocations,
+            })
+    return results
+
+
+def bench_scrape(pages, repeat: int):
+    """Time scrape() and a full poll-and-store against each page served by a mocked primp.get."""
+    from stations import MultiStationPoller
+
+    results = []
+    for name, page in pages.items():
+        for parser in sorted(PARSERS):
+            with patch('primp.get', return_value=mock_response(page)), quiet():
+                timing = time_calls(lambda: scrape.scrape(parser=parser), repeat)
+            results.append({'page': name, 'parser': parser, 'stage': 'scrape', **timing})
+
+            with tempfile.TemporaryDirectory() as tmp:
+                db_path = os.path.join(tmp, 'bench.sqlite3')
+                init_database(db_path)
+                writer = TrainWriter(db_path)
+                client = Mock()
+                client.get.return_value = mock_response(page)
+                poller = MultiStationPoller([scrape.DEFAULT_STATION], writer, parser=parser, client=client,
+                                            min_host_interval=0)
+                try:
+                    with quiet():
+                        # First poll stores the board, later polls are unchanged and short-circuit
+                        first = time_calls(lambda: poller.poll(day='2024-01-15'), 1)
+                        unchanged = time_calls(lambda: poller.poll(day='2024-01-15'), repeat)
+                finally:
+                    poller.close()
+                    writer.close()
+            results.append({'page': name, 'parser': parser, 'stage': 'poll_changed', **first})
+            results.append({'page': name, 'parser': parser, 'stage': 'poll_unchanged', **unchanged})
+    return results
+
+
+def populate(db_path: str, rows: int, batch: int = 100000):
+    """Fill train_track_locations with `rows` history rows spread over past days."""
+    writer = TrainWriter(db_path)
+    start = datetime.date(2020, 1, 1)
+    per_day = 200
+    rng = random.Random(1)
+    try:
+        for offset in range(0, rows, batch):
+            values = []
+            for i in range(offset, min(offset + batch, rows)):
+                day = start + datetime.timedelta(days=i // per_day)
+                minutes = (i % per_day) * 7
+                values.append((
+                    day, datetime.datetime.combine(day, datetime.time()) + datetime.timedelta(minutes=minutes),
+                    f"{minutes // 60 % 12 or 12}:{minutes % 60:02d} PM", str(i % per_day),
+                    rng.choice(TRAIN_NAMES), rng.choice(DESTINATIONS), rng.choice(STATUSES), str(rng.randint(1, 21)),
+                    DEFAULT_STATION.code,
+                ))
+            writer.insert_rows(values)
+    finally:
+        writer.close()
+
+
+def bench_upsert(db_sizes, board_rows: int, repeat: int):
+    results = []
+    rng = random.Random(2)
+    for size in db_sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'bench.sqlite3')
+            init_database(db_path)
+            populate(db_path, size)
+            writer = TrainWriter(db_path)
+            try:
+                for run in range(repeat):
+                    trains = [
+                        Train(f'2030-01-{run + 1:02d}', f"{i % 12 + 1}:{i % 60:02d} PM", str(1000 + i),
+                              rng.choice(TRAIN_NAMES), rng.choice(DESTINATIONS), 'On Time', str(rng.randint(1, 21)))
+                        for i in range(board_rows)
+                    ]
+                    for stage, batch in (
+                        ('insert', trains),
+                        ('unchanged', trains),
+                        ('update', [Train(t.day, t.time, t.train_number, t.train_name, t.destination,
+                                          'Boarding', t.track) for t in trains]),
+                    ):
+                        start = time.perf_counter()
+                        stats = writer.write(batch)
+                        elapsed = time.perf_counter() - start
+                        results.append({
+                            'db_rows': size,
+                            'stage': stage,
+                            'run': run,
+                            'rows': len(batch),
+                            'ms': elapsed * 1000,
+                            'rows_per_s': len(batch) / elapsed if elapsed else None,
+                            'stats': vars(stats),
+                        })
+            finally:
+                writer.close()
+    return results
+
+
+SCRAPE_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scrape.py')
+
+# Commands timed from a cold interpreter. full_imports is what every command
+# paid before the network and parser dependencies were imported lazily.
+STARTUP_COMMANDS = {
+    'import': ['-c', 'import scrape'],
+    'full_imports': ['-c', 'import scrape, primp, bs4, pytz'],
+    'help': [SCRAPE_PY, '--help'],
+    'query': [SCRAPE_PY, '--db', '{db}', '--log-level', 'WARNING', 'query', '--train-number', '241'],
+}
+
+# Runs a startup command and prints the interpreter's own peak RSS in KiB
+# last. ru_maxrss is no use here, as on Linux it carries over the peak of
+# this process through fork and exec.
+STARTUP_WRAPPER = """
+import atexit, sys
+def peak_rss():
+    with open('/proc/self/status') as status:
+        print(next(line.split()[1] for line in status if line.startswith('VmHWM:')), file=sys.stderr)
+atexit.register(peak_rss)
+if sys.argv[1] == '-c':
+    exec(sys.argv[2], {'__name__': '__main__'})
+else:
+    import runpy
+    sys.argv = sys.argv[1:]
+    runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+def run_cold(args):
+    """Run a command in a fresh interpreter, returning its wall time in milliseconds and peak RSS in KiB."""
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', STARTUP_WRAPPER] + args, cwd=os.path.dirname(SCRAPE_PY),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    return elapsed, int(process.stderr.split()[-1])
+
+
+def bench_startup(repeat: int):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.sqlite3')
+        init_database(db_path)
+        for name, command in STARTUP_COMMANDS.items():
+            args = [arg.format(db=db_path) for arg in command]
+            runs = [run_cold(args) for _ in range(repeat)]
+            timings = [elapsed for elapsed, _ in runs]
+            results.append({
+                'command': name,
+                'min_ms': min(timings),
+                'median_ms': statistics.median(timings),
+                'max_ms': max(timings),
+                'repeat': repeat,
+                'max_rss_kib': max(rss for _, rss in runs),
+            })
+    return results
+
+
+def run(fixtures_dir=FIXTURES_DIR, synthetic_rows=(50, 500), db_sizes=(0, 100000), board_rows=200, repeat=5,
+        benchmarks=('startup', 'parse', 'scrape', 'upsert'), filler_kib=200):
+    pages = load_pages(fixtures_dir, synthetic_rows, filler_kib)
+    results = {
+        'meta': {
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'repeat': repeat,
+            'filler_kib': filler_kib,
+        },
+    }
+    if 'startup' in benchmarks:
+        results['startup'] = bench_startup(repeat)
+    if 'parse' in benchmarks:
+        results['parse'] = bench_parse(pages, repeat)
+    if 'scrape' in benchmarks:
+        results['scrape'] = bench_scrape(pages, repeat)
+    if 'upsert' in benchmarks:
+        results['upsert'] = bench_upsert(db_sizes, board_rows, repeat)
+    return results
+
+
+def int_list(value: str):
+    return [int(item) for item in value.split(',') if item]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the scraper hot paths offline')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help='Directory of full-page HTML fixtures')
+    parser.add_argument('--synthetic-rows', type=int_list, default=[50, 500], help='Comma separated rows per board for synthetic pages')
+    parser.add_argument('--db-sizes', type=int_list, default=[0, 100000], help='Comma separated history row counts for upsert benchmarks, e.g. 0,1000000,10000000')
+    parser.add_argument('--filler-kib', type=int, default=200, help='Size of the non-board markup around each synthetic board')
+    parser.add_argument('--board-rows', type=int, default=200, help='Trains written per upsert')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed repetitions per measurement')
+    parser.add_argument('--only', choices=['startup', 'parse', 'scrape', 'upsert'], action='append', help='Run only these benchmarks')
+    args = parser.parse_args()
+
+    results = run(fixtures_dir=args.fixtures, synthetic_rows=args.synthetic_rows, db_sizes=args.db_sizes,
+                  board_rows=args.board_rows, repeat=args.repeat,
+                  benchmarks=args.only or ('startup', 'parse', 'scrape', 'upsert'), filler_kib=args.filler_kib)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
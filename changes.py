@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Change detection for scraped boards.
+
+Most polls return exactly the same board as the previous one. ChangeDetector
+fingerprints the raw departures/arrivals markup so an unchanged board can be
+skipped before it is parsed, and diffs the trains of a changed board against
+the previous snapshot so only tracked trains that actually changed are
+written. The fingerprint and snapshot are kept in memory and persisted in the
+board_state table, so cron-style single runs benefit as well as the daemon.
+"""
+
+import dataclasses
+import functools
+import hashlib
+import json
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from scrape import DEFAULT_STATION, ScheduleBoard, Train, TrainWriter, WriteStats, scheduled_datetime, transaction
+
+CHANGE_NEW = 'new'
+CHANGE_TRACK = 'track'
+CHANGE_STATUS = 'status'
+CHANGE_OTHER = 'other'
+CHANGE_REMOVED = 'removed'
+
+
+@dataclass
+class TrainChange:
+    kind: str
+    train: Train
+    previous: Optional[Train] = None
+
+
+def train_key(train: Train) -> Tuple[str, str, str]:
+    """Return the natural key of a train, matching the train_track_locations primary key."""
+    return (train.day, train.time, train.train_number)
+
+
+@functools.lru_cache(maxsize=4096)
+def _scheduled_epoch(day: str, time: str) -> Optional[int]:
+    try:
+        return int(scheduled_datetime(day, time).timestamp())
+    except ValueError:
+        return None
+
+
+def service_key(train: Train, now: Optional[float] = None) -> Tuple[object, str]:
+    """
+    Return the key a train is diffed by: when it is scheduled, and its number.
+
+    Boards are dated with the scrape day, so the trains still listed at
+    midnight are re-dated to the new day. Given now, the time the board was
+    seen, a train is taken to run on whichever day puts it within twelve
+    hours of now, so it keeps its key across the rollover.
+    """
+    scheduled = _scheduled_epoch(train.day, train.time)
+    if scheduled is None:
+        return (train.day, train.time), train.train_number
+    if now is not None:
+        half_day = 12 * 3600
+        if scheduled > now + half_day:
+            scheduled -= 2 * half_day
+        elif scheduled < now - half_day:
+            scheduled += 2 * half_day
+    return scheduled, train.train_number
+
+
+def board_fingerprint(day: str, departures_html: str, arrivals_html: str) -> str:
+    """
+    Return a fingerprint of the board markup.
+
+    The scrape day is included so an identical board seen on a new service day
+    is still written under that day.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in (day, departures_html, arrivals_html):
+        digest.update(part.encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def diff_trains(previous: List[Train], current: List[Train], now: Optional[float] = None,
+                previous_at: Optional[float] = None) -> List[TrainChange]:
+    """
+    Diff two lists of trains by service_key(), for boards seen at previous_at and now.
+
+    A train re-dated at midnight keeps the day it was first listed under in
+    its changes, so it is neither new nor written again under the new day. A
+    train whose track and status both changed yields one change of each kind.
+    """
+    previous_by_key = {service_key(train, previous_at): train for train in previous}
+    changes = []
+    seen = set()
+    for train in current:
+        key = service_key(train, now)
+        seen.add(key)
+        old = previous_by_key.get(key)
+        if old is None:
+            changes.append(TrainChange(CHANGE_NEW, train))
+            continue
+        if old.day != train.day:
+            train = dataclasses.replace(train, day=old.day)
+        if old == train:
+            continue
+        changed = False
+        if old.track != train.track:
+            changes.append(TrainChange(CHANGE_TRACK, train, old))
+            changed = True
+        if old.status != train.status:
+            changes.append(TrainChange(CHANGE_STATUS, train, old))
+            changed = True
+        if not changed:
+            changes.append(TrainChange(CHANGE_OTHER, train, old))
+    for key, old in previous_by_key.items():
+        if key not in seen:
+            changes.append(TrainChange(CHANGE_REMOVED, old, old))
+    return changes
+
+
+def changed_trains(changes: List[TrainChange]) -> List[Train]:
+    """Return each train that needs writing once, in board order."""
+    trains: Dict[Tuple[str, str, str], Train] = {}
+    for change in changes:
+        if change.kind != CHANGE_REMOVED:
+            trains.setdefault(train_key(change.train), change.train)
+    return list(trains.values())
+
+
+class ChangeDetector:
+    def __init__(self, conn: sqlite3.Connection, station: str = DEFAULT_STATION.code):
+        self.conn = conn
+        self.station = station
+        self.reload()
+
+    def reload(self):
+        """Read the last saved fingerprint and snapshot back from board_state."""
+        self.fingerprint = self._load('fingerprint')
+        snapshot = self._load('trains')
+        # Snapshots are saved as field lists, older ones as objects
+        self.trains = [Train(*row) if isinstance(row, list) else Train(**row)
+                       for row in json.loads(snapshot)] if snapshot else []
+        departures = self._load('departures')
+        self.departures = int(departures) if departures is not None else len(self.trains)
+        observed_at = self._load('observed_at')
+        self.observed_at = int(observed_at) if observed_at is not None else None
+
+    def _state_name(self, name: str) -> str:
+        # The default station keeps the unprefixed names it has always used
+        return name if self.station == DEFAULT_STATION.code else f'{self.station}:{name}'
+
+    def _load(self, name: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM board_state WHERE name = ?', (self._state_name(name),)).fetchone()
+        return row[0] if row else None
+
+    def board_changed(self, fingerprint: str) -> bool:
+        return fingerprint != self.fingerprint
+
+    def diff(self, trains: List[Train], now: Optional[float] = None) -> List[TrainChange]:
+        return diff_trains(self.trains, trains, now, self.observed_at)
+
+    def board(self) -> ScheduleBoard:
+        """Return the last saved board, split back into departures and arrivals."""
+        return ScheduleBoard(departures=self.trains[:self.departures], arrivals=self.trains[self.departures:])
+
+    def save(self, fingerprint: str, trains: List[Train], departures: Optional[int] = None,
+             observed_at: Optional[int] = None):
+        """
+        Record the board just written as the new baseline.
+
+        trains are the departures followed by the arrivals, of which the first
+        `departures` are departures (all of them if not given), seen at
+        observed_at.
+        """
+        trains = list(trains)
+        departures = departures if departures is not None else len(trains)
+        snapshot = json.dumps([train.astuple() for train in trains])
+        state = [(self._state_name('fingerprint'), fingerprint), (self._state_name('trains'), snapshot),
+                 (self._state_name('departures'), str(departures))]
+        if observed_at is not None:
+            state.append((self._state_name('observed_at'), str(observed_at)))
+        with transaction(self.conn):
+            self.conn.executemany('INSERT OR REPLACE INTO board_state (name, value) VALUES (?, ?)', state)
+        self.fingerprint = fingerprint
+        self.trains = trains
+        self.departures = departures
+        if observed_at is not None:
+            self.observed_at = observed_at
+
+
+@dataclass
+class PollResult:
+    changed: bool
+    changes: List[TrainChange] = dataclasses.field(default_factory=list)
+    stats: WriteStats = dataclasses.field(default_factory=WriteStats)
+    # Set when the server answered a conditional request with 304 Not Modified
+    not_modified: bool = False
+    bytes_transferred: int = 0
+    # Trains on a changed board, and the seconds spent in each stage of the poll
+    trains: int = 0
+    timings: Dict[str, float] = dataclasses.field(default_factory=dict)
+
+
+def store_board(detector: ChangeDetector, writer: TrainWriter, fingerprint: str, schedule_board: ScheduleBoard,
+                sinks=()) -> PollResult:
+    """
+    Write the trains with tracks on a changed board that differ from the last snapshot.
+
+    Changes cover every train on the board, tracked or not, and are passed to
+    each sink's record(changes, observed_at), e.g. events.EventLog. The
+    history, the sinks and the new snapshot are committed together on the
+    writer's connection, so a failure part way leaves the previous snapshot
+    and nothing of this board, and the next poll diffs it again.
+    """
+    timings = {}
+    start = time.perf_counter()
+    all_trains = schedule_board.departures + schedule_board.arrivals
+    observed_at = int(time.time())
+    changes = detector.diff(all_trains, observed_at)
+    timings['diff'] = time.perf_counter() - start
+
+    # Only trains with a track are kept in train_track_locations
+    start = time.perf_counter()
+    tracked = [train for train in changed_trains(changes) if train.track]
+    timings['filter'] = time.perf_counter() - start
+
+    try:
+        with writer.transaction():
+            start = time.perf_counter()
+            stats = writer.write(tracked, station=detector.station)
+            timings['write'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for sink in sinks:
+                sink.record(changes, observed_at)
+            detector.save(fingerprint, all_trains, len(schedule_board.departures), observed_at)
+    except Exception:
+        detector.reload()
+        raise
+    # Including the commit
+    timings['record'] = time.perf_counter() - start
+    return PollResult(changed=True, changes=changes, stats=stats, trains=len(all_trains), timings=timings)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Append-only history of observed train transitions.
+
+train_track_locations only keeps the latest status and track of each train,
+since every poll overwrites the row. EventLog records each change found by
+diffing successive boards (see changes.diff_trains) in train_events together
+with the time it was observed, and the query helpers below read it back
+through the covering indexes created in init_database.
+"""
+
+import sqlite3
+import time
+from typing import List, Optional
+
+from changes import TrainChange
+from scrape import DEFAULT_STATION, parse_day_time, transaction
+
+TRACK_EVENT_FILTER = "event IN ('new', 'track') AND track != ''"
+
+
+class EventLog:
+    INSERT_SQL = '''
+        INSERT INTO train_events
+        (observed_at, event, day, time, schedule_time, train_number, train_name, destination,
+         old_status, status, old_track, track, station)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+
+    def __init__(self, conn: sqlite3.Connection, station: str = DEFAULT_STATION.code):
+        self.conn = conn
+        self.station = station
+
+    def to_rows(self, changes: List[TrainChange], observed_at: int):
+        rows = []
+        for change in changes:
+            train = change.train
+            previous = change.previous
+            try:
+                day_date, time_datetime = parse_day_time(train.day, train.time)
+                epoch = int(time_datetime.timestamp())
+            except ValueError:
+                day_date, epoch = train.day, None
+            rows.append((
+                observed_at,
+                change.kind,
+                day_date,
+                epoch,
+                train.time,
+                train.train_number,
+                train.train_name,
+                train.destination,
+                previous.status if previous else None,
+                train.status,
+                previous.track if previous else None,
+                train.track,
+                self.station,
+            ))
+        return rows
+
+    def record(self, changes: List[TrainChange], observed_at: Optional[int] = None) -> int:
+        """Append one event per change, returning the number recorded."""
+        if not changes:
+            return 0
+        if observed_at is None:
+            observed_at = int(time.time())
+        rows = self.to_rows(changes, observed_at)
+        with transaction(self.conn):
+            self.conn.executemany(self.INSERT_SQL, rows)
+        return len(rows)
+
+
+def train_history(conn: sqlite3.Connection, train_number: str):
+    """Return (observed_at, event, day, schedule_time, status, track) for every event of a train."""
+    return conn.execute('''
+        SELECT observed_at, event, day, schedule_time, status, track
+        FROM train_events
+        WHERE train_number = ?
+        ORDER BY observed_at
+    ''', (train_number,)).fetchall()
+
+
+def track_assignments(conn: sqlite3.Connection, day: str):
+    """Return (observed_at, train_number, schedule_time, destination, track) for each track posted on a day."""
+    return conn.execute(f'''
+        SELECT observed_at, train_number, schedule_time, destination, track
+        FROM train_events
+        WHERE day = ? AND {TRACK_EVENT_FILTER}
+        ORDER BY observed_at
+    ''', (day,)).fetchall()
+
+
+def track_usage(conn: sqlite3.Connection, track: str, since_day: Optional[str] = None):
+    """Return (day, train_number, observed_at) for every assignment of a track number."""
+    return conn.execute(f'''
+        SELECT day, train_number, observed_at
+        FROM train_events
+        WHERE track = ? AND day >= ? AND {TRACK_EVENT_FILTER}
+        ORDER BY day, observed_at
+    ''', (track, since_day or '')).fetchall()
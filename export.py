@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Columnar export of train_track_locations for offline analysis.
+
+Each station's service day is written to its own hive-style partition,
+out_dir/station=NYP/day=YYYY-MM-DD/part-0.parquet (or .arrow for Arrow IPC),
+so tools such as pyarrow.dataset, pandas or DuckDB can read a station or a
+date range without loading the whole database, e.g.
+
+    pyarrow.dataset.dataset('export/', format='parquet', partitioning='hive')
+
+Partitions are streamed from SQLite in chunks of rows, one at a time. The
+low-cardinality text columns are dictionary-encoded. Only finished days are
+exported: today's board is still changing, so it is left for a later run.
+Incremental runs (the default) skip partitions that already exist. A day
+exported unfinished with include_today is marked with a _partial file, which
+dataset readers ignore, and is exported again by the next run. With
+--shards the history is read from the shard files, see shards.py.
+
+pyarrow is only needed for this command and is imported on use.
+"""
+
+import datetime
+import os
+import shutil
+from dataclasses import dataclass
+from itertools import islice
+from typing import Iterable, List, Optional, Set, Tuple
+
+from scrape import current_day
+from shards import open_reader
+
+FORMATS = ['parquet', 'arrow']
+
+# Columns repeating a handful of distinct values, stored dictionary-encoded.
+# The station and day are partition directories rather than columns.
+DICTIONARY_COLUMNS = ['schedule_time', 'train_number', 'train_name', 'destination', 'status', 'track']
+
+EXPORT_COLUMNS = ['time'] + DICTIONARY_COLUMNS
+
+
+# Left in a partition exported before its day finished
+PARTIAL_MARKER = '_partial'
+
+
+@dataclass
+class ExportStats:
+    # Station days written and already exported
+    days: int = 0
+    rows: int = 0
+    skipped_days: int = 0
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Exporting needs pyarrow, install it with `pipenv install`") from e
+    return pyarrow
+
+
+def export_schema(pa):
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema(
+        [pa.field('time', pa.timestamp('s', tz='UTC'))]
+        + [pa.field(column, dictionary) for column in DICTIONARY_COLUMNS]
+    )
+
+
+def epoch_seconds(value) -> Optional[int]:
+    """Return a stored time as epoch seconds, also accepting ISO text from older databases."""
+    if value is None or isinstance(value, int):
+        return value
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+
+def exported_partitions(out_dir: str) -> Set[Tuple[str, str]]:
+    """Return the (station, day) partitions in out_dir, leaving out days exported before they finished."""
+    partitions = set()
+    if not os.path.isdir(out_dir):
+        return partitions
+    for station_dir in os.listdir(out_dir):
+        if not station_dir.startswith('station='):
+            continue
+        for day_dir in os.listdir(os.path.join(out_dir, station_dir)):
+            if day_dir.startswith('day=') and not os.path.exists(
+                    os.path.join(out_dir, station_dir, day_dir, PARTIAL_MARKER)):
+                partitions.add((station_dir[len('station='):], day_dir[len('day='):]))
+    return partitions
+
+
+def record_batch(pa, schema, rows):
+    columns = list(zip(*rows))
+    times = pa.array([epoch_seconds(value) for value in columns[0]], type=pa.int64())
+    arrays = [times.cast(schema.field('time').type)]
+    for index, column in enumerate(DICTIONARY_COLUMNS, start=1):
+        arrays.append(pa.array(columns[index], type=pa.string()).dictionary_encode())
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class PartitionWriter:
+    """Writes record batches of one day to a partition file, as Parquet row groups or Arrow IPC batches."""
+
+    def __init__(self, pa, schema, path: str, file_format: str):
+        if file_format == 'parquet':
+            self.writer = pa.parquet.ParquetWriter(path, schema, compression='zstd',
+                                                   use_dictionary=DICTIONARY_COLUMNS)
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_file(self.sink, schema)
+        self.file_format = file_format
+
+    def write(self, batch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.file_format != 'parquet':
+            self.sink.close()
+
+
+def partitions_to_export(reader, done: Iterable[Tuple[str, str]], until_day: str,
+                         station: Optional[str] = None) -> List[Tuple[str, str]]:
+    # The primary key starts with day and station, so this reads the index rather than the table
+    partitions = reader.query('''
+        SELECT DISTINCT station, day FROM train_track_locations
+        WHERE day < ?1 AND (?2 IS NULL OR station = ?2)
+        ORDER BY day, station
+    ''', (until_day, station), until_day=until_day)
+    done = set(done)
+    return [partition for partition in partitions if partition not in done]
+
+
+def export(db_path: str, out_dir: str, file_format: str = 'parquet', incremental: bool = True,
+           include_today: bool = False, chunk_rows: int = 50000, station: Optional[str] = None,
+           shard_dir: Optional[str] = None) -> ExportStats:
+    """
+    Export every finished station day of train_track_locations that has no partition in out_dir yet.
+
+    With shard_dir, the history is read from its shards rather than the main database.
+    """
+    pa = import_pyarrow()
+    schema = export_schema(pa)
+    stats = ExportStats()
+    os.makedirs(out_dir, exist_ok=True)
+    done = exported_partitions(out_dir) if incremental else set()
+    if station is not None:
+        done = {partition for partition in done if partition[0] == station}
+    today = current_day()
+    until_day = '9999-12-31' if include_today else today
+
+    reader = open_reader(db_path, shard_dir)
+    try:
+        partitions = partitions_to_export(reader, done, until_day, station)
+        stats.skipped_days = len(done)
+        for partition_station, day in partitions:
+            station_dir = os.path.join(out_dir, f'station={partition_station}')
+            partition = os.path.join(station_dir, f'day={day}')
+            # Written next to the partition and renamed into place, so an
+            # interrupted export never leaves a partial day that later runs skip
+            staging = os.path.join(station_dir, f'.day={day}.tmp')
+            shutil.rmtree(staging, ignore_errors=True)
+            os.makedirs(staging)
+            writer = PartitionWriter(pa, schema, os.path.join(staging, f'part-0.{file_format}'), file_format)
+            try:
+                rows = reader.query(f'''
+                    SELECT {', '.join(EXPORT_COLUMNS)}
+                    FROM train_track_locations
+                    WHERE day = ? AND station = ?
+                    ORDER BY time, train_number
+                ''', (day, partition_station), since_day=day, until_day=day)
+                for chunk in iter(lambda: list(islice(rows, chunk_rows)), []):
+                    writer.write(record_batch(pa, schema, chunk))
+                    stats.rows += len(chunk)
+            finally:
+                writer.close()
+            if day >= today:
+                open(os.path.join(staging, PARTIAL_MARKER), 'w').close()
+            shutil.rmtree(partition, ignore_errors=True)
+            os.replace(staging, partition)
+            stats.days += 1
+    finally:
+        reader.close()
+    return stats
@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""
+Push feed of train changes over Server-Sent Events.
+
+ChangeFeed fans the changes found by diffing successive boards out to any
+number of subscribers as they are polled, instead of leaving consumers to
+poll the database. It is fed by a FeedSink per station, registered next to
+events.EventLog, and publishes three event types:
+
+    track_assigned  a track was posted for a train, or changed
+    status_changed  a train's status changed
+    train_removed   a train dropped off the board
+
+Each subscriber has a bounded queue. Publishing never blocks the poller: a
+subscriber whose queue is full is disconnected, and can resume without gaps
+by reconnecting with Last-Event-ID as long as the missed events are still in
+the feed's replay buffer.
+
+FeedServer serves the feed at /events, optionally filtered with ?station=
+and ?train=. `python feed.py` runs the server with a DemoPublisher posting
+made-up changes, as a local stand-in for the scraper.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import logging
+import queue
+import random
+import threading
+import time
+from dataclasses import asdict, dataclass, replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, List, Optional, Set
+from urllib.parse import parse_qs, urlparse
+
+from changes import CHANGE_NEW, CHANGE_REMOVED, CHANGE_STATUS, CHANGE_TRACK, TrainChange
+from scrape import DEFAULT_STATION, Train, TrainWriter, current_day
+
+logger = logging.getLogger(__name__)
+
+EVENT_TRACK_ASSIGNED = 'track_assigned'
+EVENT_STATUS_CHANGED = 'status_changed'
+EVENT_TRAIN_REMOVED = 'train_removed'
+
+
+@dataclass
+class FeedEvent:
+    id: int
+    type: str
+    station: str
+    observed_at: int
+    train: dict
+    previous: Optional[dict] = None
+
+    def to_sse(self) -> str:
+        data = json.dumps({'station': self.station, 'observed_at': self.observed_at,
+                           'train': self.train, 'previous': self.previous})
+        return f'id: {self.id}\nevent: {self.type}\ndata: {data}\n\n'
+
+
+def event_type(change: TrainChange) -> Optional[str]:
+    """Return the feed event type of a change, or None if it is not published."""
+    if change.kind in (CHANGE_NEW, CHANGE_TRACK) and change.train.track:
+        return EVENT_TRACK_ASSIGNED
+    if change.kind == CHANGE_STATUS:
+        return EVENT_STATUS_CHANGED
+    if change.kind == CHANGE_REMOVED:
+        return EVENT_TRAIN_REMOVED
+    return None
+
+
+class Subscription:
+    def __init__(self, max_queue: int, station: Optional[str] = None, train_number: Optional[str] = None):
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.station = station
+        self.train_number = train_number
+        # Set once the subscriber fell behind and was dropped from the feed
+        self.overflowed = False
+
+    def wants(self, event: FeedEvent) -> bool:
+        return ((self.station is None or event.station == self.station)
+                and (self.train_number is None or event.train['train_number'] == self.train_number))
+
+    def get(self, timeout: Optional[float] = None) -> Optional[FeedEvent]:
+        """Return the next event, or None if none arrived within timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class ChangeFeed:
+    def __init__(self, replay: int = 1000, max_queue: int = 256):
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        # Ids continue upwards across restarts, so a Last-Event-ID from before one replays nothing
+        self.ids = itertools.count(int(time.time() * 1000))
+        self.history: Deque[FeedEvent] = collections.deque(maxlen=replay)
+        self.subscribers: Set[Subscription] = set()
+
+    def subscribe(self, station: Optional[str] = None, train_number: Optional[str] = None,
+                  last_event_id: Optional[int] = None) -> Subscription:
+        """
+        Start receiving events, first replaying any after last_event_id still in the buffer.
+
+        A replay larger than the queue overflows the subscription straight away.
+        """
+        subscription = Subscription(self.max_queue, station, train_number)
+        with self.lock:
+            if last_event_id is not None:
+                for event in self.history:
+                    if event.id > last_event_id and subscription.wants(event) and not self._offer(subscription, event):
+                        return subscription
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            self.subscribers.discard(subscription)
+
+    def _offer(self, subscription: Subscription, event: FeedEvent) -> bool:
+        try:
+            subscription.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            subscription.overflowed = True
+            return False
+
+    def publish(self, station: str, changes: List[TrainChange], observed_at: int) -> List[FeedEvent]:
+        """Publish the changes of one station's poll to every interested subscriber."""
+        published = []
+        with self.lock:
+            for change in changes:
+                kind = event_type(change)
+                if kind is None:
+                    continue
+                event = FeedEvent(
+                    id=next(self.ids),
+                    type=kind,
+                    station=station,
+                    observed_at=observed_at,
+                    train=asdict(change.train),
+                    previous=asdict(change.previous) if change.previous and kind != EVENT_TRAIN_REMOVED else None,
+                )
+                self.history.append(event)
+                published.append(event)
+                for subscription in list(self.subscribers):
+                    if subscription.wants(event) and not self._offer(subscription, event):
+                        logger.warning("Dropping a feed subscriber that fell %d events behind", self.max_queue)
+                        self.subscribers.discard(subscription)
+        return published
+
+
+class FeedSink:
+    """
+    Sink publishing one station's polled changes to a ChangeFeed.
+
+    Sinks record inside the transaction storing the board, so the changes are
+    held back until writer commits it and dropped if it rolls back: a poll
+    that fails is diffed again, and publishing it straight away would send
+    its changes twice.
+    """
+
+    def __init__(self, feed: ChangeFeed, writer: TrainWriter, station: str = DEFAULT_STATION.code):
+        self.feed = feed
+        self.writer = writer
+        self.station = station
+
+    def record(self, changes: List[TrainChange], observed_at: int):
+        self.writer.after_commit(lambda: self.feed.publish(self.station, changes, observed_at))
+
+
+class FeedServer:
+    """Serves a ChangeFeed as Server-Sent Events on /events."""
+
+    def __init__(self, feed: ChangeFeed, port: int, host: str = '', keepalive: float = 15):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                if url.path != '/events':
+                    self.send_error(404)
+                    return
+                params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                last_event_id = self.headers.get('Last-Event-ID') or params.get('last_event_id')
+                subscription = feed.subscribe(
+                    station=params.get('station'),
+                    train_number=params.get('train'),
+                    last_event_id=int(last_event_id) if last_event_id and last_event_id.isdigit() else None,
+                )
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                try:
+                    while not server.stopping.is_set():
+                        # Once dropped, only what is already queued is still sent
+                        event = subscription.get(timeout=0 if subscription.overflowed else keepalive)
+                        if event is not None:
+                            self.wfile.write(event.to_sse().encode())
+                        elif subscription.overflowed:
+                            # Tell the client to reconnect with its Last-Event-ID
+                            self.wfile.write(b'event: overflow\ndata: {}\n\n')
+                            break
+                        else:
+                            self.wfile.write(b': keepalive\n\n')
+                        self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    feed.unsubscribe(subscription)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        server = self
+        self.stopping = threading.Event()
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='feed', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DemoPublisher:
+    """Publishes made-up changes to a ChangeFeed every interval seconds, standing in for the scraper."""
+
+    TRAINS = [
+        Train('', '6:45 PM', '241', 'Empire Service', 'Albany-Rensselaer, NY', 'On Time'),
+        Train('', '7:05 PM', '57', 'Vermonter', 'St. Albans, VT', 'On Time'),
+        Train('', '7:20 PM', '2171', 'Acela', 'Washington, DC', 'On Time'),
+    ]
+    STATUSES = ['On Time', 'Boarding', 'Second Boarding', 'Delayed']
+
+    def __init__(self, feed: ChangeFeed, interval: float = 5, station: str = DEFAULT_STATION.code, seed=None):
+        self.feed = feed
+        self.interval = interval
+        self.station = station
+        self.random = random.Random(seed)
+        self.board = {train.train_number: replace(train, day=current_day()) for train in self.TRAINS}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='demo-publisher', daemon=True)
+
+    def step(self) -> List[FeedEvent]:
+        """Make one random change to the demo board and publish it."""
+        number = self.random.choice(sorted(self.board))
+        previous = self.board[number]
+        roll = self.random.random()
+        if roll < 0.4:
+            change = TrainChange(CHANGE_TRACK, replace(previous, track=str(self.random.randint(1, 21))), previous)
+        elif roll < 0.9:
+            change = TrainChange(CHANGE_STATUS, replace(previous, status=self.random.choice(self.STATUSES)), previous)
+        else:
+            change = TrainChange(CHANGE_REMOVED, previous, previous)
+        self.board[number] = change.train if change.kind != CHANGE_REMOVED else replace(previous, track='')
+        return self.feed.publish(self.station, [change], int(time.time()))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.step()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a change feed of made-up train changes for local testing')
+    parser.add_argument('--port', type=int, default=5002, help='Port to serve /events on')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds between made-up changes')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    feed = ChangeFeed()
+    server = FeedServer(feed, args.port)
+    publisher = DemoPublisher(feed, args.interval)
+    server.start()
+    publisher.start()
+    logger.info("Serving demo change feed on http://localhost:%d/events", server.port)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        publisher.stop()
+        server.close()
@@ -0,0 +1,6 @@
+"""gunicorn settings for `make run_gunicorn`, which serves app:app."""
+
+accesslog = '-'
+errorlog = '-'
+# Keep the in-memory response cache warm rather than recycling workers
+max_requests = 0
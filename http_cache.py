@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Conditional fetching of station pages.
+
+HttpCache keeps each station's last ETag/Last-Modified validators and body
+on disk and sends them back as If-None-Match/If-Modified-Since. A 304 reply
+means the page has not changed: nothing but headers is downloaded, and the
+cached body is handed back so the poll only re-checks its fingerprint and
+skips parsing and writing. Bytes transferred are recorded for every fetch so
+bandwidth use can be tracked per poll.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from scrape import DEFAULT_STATION, Station
+
+
+@dataclass
+class FetchResult:
+    page: str
+    not_modified: bool = False
+    bytes_transferred: int = 0
+    seconds: float = 0.0
+    fetched_at: int = 0
+
+
+def response_size(response) -> int:
+    """
+    Return the size of a response body as sent on the wire.
+
+    primp decompresses bodies transparently, so the Content-Length header
+    (the compressed size when the server compressed the body) is preferred
+    over the length of the decoded content.
+    """
+    content_length = (response.headers or {}).get('content-length')
+    if content_length is not None and content_length.isdigit():
+        return int(content_length)
+    return len(response.content or b'')
+
+
+class HttpCache:
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, station: Station, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f'{station.code}.{suffix}')
+
+    def validators(self, station: Station) -> dict:
+        try:
+            with open(self._path(station, 'json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def cached_page(self, station: Station) -> Optional[str]:
+        try:
+            with open(self._path(station, 'html'), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, station: Station, response):
+        headers = response.headers or {}
+        validators = {name: headers[name] for name in ('etag', 'last-modified') if headers.get(name)}
+        # Write the body before the validators so a validator on disk always
+        # refers to a complete cached body
+        body_path = self._path(station, 'html')
+        with open(body_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(response.text)
+        os.replace(body_path + '.tmp', body_path)
+        with open(self._path(station, 'json'), 'w') as f:
+            json.dump(validators, f)
+
+    def fetch(self, client, station: Station = DEFAULT_STATION) -> FetchResult:
+        """Fetch a station's page, sending the cached validators if there are any."""
+        headers = {'Referer': station.referer}
+        validators = self.validators(station)
+        # Without the cached body a 304 would leave nothing to fall back on
+        if validators and self.cached_page(station) is not None:
+            if 'etag' in validators:
+                headers['If-None-Match'] = validators['etag']
+            if 'last-modified' in validators:
+                headers['If-Modified-Since'] = validators['last-modified']
+
+        r = client.get(station.url, headers=headers)
+        if r.status_code == 304:
+            return FetchResult(page=self.cached_page(station), not_modified=True, bytes_transferred=0)
+        if r.status_code != 200:
+            raise Exception(f"Failed to scrape: {r.status_code}: {r.text}")
+        self.store(station, r)
+        return FetchResult(page=r.text, bytes_transferred=response_size(r))
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Retention, rollup and compaction of the history database.
+
+train_events keeps every transition of every train, so it is by far the
+fastest growing table. `scrape.py maintain` keeps its detail for a window
+of days, by default 30. Older days are rolled up into train_days: one row
+per train per day with the final status and track, the last status that
+gave a delay, when the train was first and last seen, and when its track
+was first posted. Their events are then deleted. TrackStats.rebuild() and
+the events source of `scrape.py analytics` read train_days as well, so the
+track summaries and delay reports still cover pruned days. train_locations
+can be pruned as well with a separate, usually longer window. With
+--shards, the shards that ended before the window are deleted whole and
+the shard it starts in is pruned a day at a time.
+
+Every step is a short transaction of its own, so the scraper, which may
+keep running, only waits briefly for the write lock:
+
+    rollup      one transaction per station and day
+    prune       one transaction per day of train_locations
+    vacuum      PRAGMA incremental_vacuum, a slice of pages per transaction,
+                sized to take about slice_seconds
+    analyze     ANALYZE one table at a time, with analysis_limit bounding
+                how many index rows each one reads
+
+Rollup and pruning always run. Vacuuming and analyzing stop once the
+time budget is spent, and the next run carries on from there. Without
+vacuuming, freed pages stay in the file and are reused by later writes,
+which still stops it growing. Incremental vacuuming needs a database created
+with auto_vacuum=INCREMENTAL, which init_database sets on new files. Older
+files are switched once with `--full-vacuum`, which rewrites the whole
+file and blocks the scraper while it runs.
+"""
+
+import datetime
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from analytics import parse_status
+from scrape import current_day
+from shards import ShardSet
+
+logger = logging.getLogger(__name__)
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+ANALYZE_TABLES = ['train_locations', 'train_events', 'train_days', 'track_stats', 'track_lead_stats']
+
+# status_delay() is analytics.parse_status's delay, registered on the connection
+ROLLUP_SQL = '''
+    INSERT OR REPLACE INTO train_days
+    (station, day, train_number, schedule_time, train_name, destination, final_status, final_track,
+     delay_status, first_seen, last_seen, track_posted_at, events)
+    SELECT station, day, train_number, schedule_time,
+           MAX(CASE WHEN latest = 1 THEN train_name END),
+           MAX(CASE WHEN latest = 1 THEN destination END),
+           MAX(CASE WHEN latest = 1 THEN status END),
+           MAX(CASE WHEN latest = 1 THEN track END),
+           MAX(CASE WHEN latest_of_kind = 1 AND has_delay THEN status END),
+           MIN(observed_at),
+           MAX(observed_at),
+           MIN(CASE WHEN event IN ('new', 'track') AND track != '' THEN observed_at END),
+           COUNT(*)
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (
+            PARTITION BY train_number, schedule_time ORDER BY observed_at DESC, rowid DESC
+        ) AS latest, ROW_NUMBER() OVER (
+            PARTITION BY train_number, schedule_time, has_delay ORDER BY observed_at DESC, rowid DESC
+        ) AS latest_of_kind
+        FROM (
+            SELECT rowid, *, status_delay(status, schedule_time) IS NOT NULL AS has_delay
+            FROM train_events
+            WHERE station = ? AND day = ?
+        )
+    )
+    GROUP BY train_number, schedule_time
+'''
+
+
+@dataclass
+class MaintenanceStats:
+    rolled_up_days: int = 0
+    rolled_up_trains: int = 0
+    pruned_events: int = 0
+    pruned_rows: int = 0
+    vacuumed_pages: int = 0
+    analyzed_tables: int = 0
+    # Whether vacuuming or analyzing stopped early for lack of time
+    out_of_time: bool = False
+
+
+class Maintenance:
+    def __init__(self, db_path: str, keep_days: int = 30, keep_history_days: Optional[int] = None,
+                 budget_seconds: float = 60, slice_seconds: float = 0.1, pause_seconds: float = 0.05,
+                 busy_timeout: float = 30, analysis_limit: int = 1000, today: Optional[str] = None,
+                 shard_dir: Optional[str] = None, clock=time.monotonic, sleep=time.sleep):
+        self.keep_days = keep_days
+        self.keep_history_days = keep_history_days
+        self.budget_seconds = budget_seconds
+        self.slice_seconds = slice_seconds
+        self.pause_seconds = pause_seconds
+        self.analysis_limit = analysis_limit
+        self.busy_timeout = busy_timeout
+        self.shard_dir = shard_dir
+        self.today = datetime.date.fromisoformat(today or current_day())
+        self.clock = clock
+        self.sleep = sleep
+        # Transactions are opened explicitly, one per step
+        self.conn = sqlite3.connect(db_path, isolation_level=None, timeout=busy_timeout)
+        self.conn.create_function('status_delay', 2, lambda status, schedule_time:
+                                  parse_status(status, schedule_time).delay_minutes, deterministic=True)
+        self.deadline = None
+        self.stats = MaintenanceStats()
+
+    def cutoff(self, keep_days: int) -> str:
+        """Return the first day kept by a window of keep_days, today included."""
+        return (self.today - datetime.timedelta(days=keep_days - 1)).isoformat()
+
+    def time_left(self) -> float:
+        return self.deadline - self.clock()
+
+    def _transaction(self, *statements: Tuple[str, tuple], conn: Optional[sqlite3.Connection] = None) -> List[int]:
+        """Run statements in one write transaction, on conn or the main database, returning their row counts."""
+        conn = conn or self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            counts = [conn.execute(sql, params).rowcount for sql, params in statements]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return counts
+
+    def rollup(self):
+        """Roll the events of days before the retention window into train_days and delete them."""
+        station_days = self.conn.execute('''
+            SELECT DISTINCT station, day FROM train_events WHERE day < ? ORDER BY day, station
+        ''', (self.cutoff(self.keep_days),)).fetchall()
+        for station, day in station_days:
+            trains, events = self._transaction(
+                (ROLLUP_SQL, (station, day)),
+                ('DELETE FROM train_events WHERE station = ? AND day = ?', (station, day)),
+            )
+            self.stats.rolled_up_days += 1
+            self.stats.rolled_up_trains += trains
+            self.stats.pruned_events += events
+            self.sleep(self.pause_seconds)
+
+    def prune_history(self):
+        """Delete train_locations rows of days before the history window, a day at a time."""
+        if self.keep_history_days is None:
+            return
+        cutoff = self.cutoff(self.keep_history_days)
+        if self.shard_dir is not None:
+            self.prune_shards(cutoff)
+            return
+        self.prune_days(self.conn, cutoff)
+
+    def prune_days(self, conn: sqlite3.Connection, cutoff: str):
+        days = conn.execute('SELECT DISTINCT day FROM train_locations WHERE day < ? ORDER BY day',
+                            (cutoff,)).fetchall()
+        for (day,) in days:
+            [rows] = self._transaction(('DELETE FROM train_locations WHERE day = ?', (day,)), conn=conn)
+            self.stats.pruned_rows += rows
+            self.sleep(self.pause_seconds)
+
+    def prune_shards(self, cutoff: str):
+        """Delete the shards that ended before cutoff, and the earlier days of the shard it falls in."""
+        shard_set = ShardSet(self.shard_dir)
+        try:
+            for shard in shard_set.shards(until_day=cutoff):
+                if shard.last_day < cutoff:
+                    self.stats.pruned_rows += shard_set.remove(shard.key)
+                elif shard.first_day < cutoff and shard.read_only:
+                    logger.warning("Not pruning days before %s from read-only history shard %s", cutoff, shard.key)
+                elif shard.first_day < cutoff:
+                    conn = sqlite3.connect(shard.path, isolation_level=None, timeout=self.busy_timeout)
+                    try:
+                        self.prune_days(conn, cutoff)
+                    finally:
+                        conn.close()
+        finally:
+            shard_set.close()
+
+    def full_vacuum(self):
+        """Switch the file to incremental auto-vacuum, rewriting it in one blocking VACUUM."""
+        logger.warning("Rewriting the whole database with VACUUM, writers are blocked until it finishes")
+        self.conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+        self.conn.execute('VACUUM')
+
+    def vacuum(self):
+        """Give free pages back to the file system in slices of about slice_seconds each."""
+        if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            logger.info("Skipping incremental vacuum, the database needs converting once with --full-vacuum")
+            return
+        pages = 64
+        while True:
+            free = self.conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if not free:
+                return
+            if self.time_left() <= 0:
+                self.stats.out_of_time = True
+                return
+            started = self.clock()
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Python's sqlite3 steps a statement without result columns only
+                # once, and each step of incremental_vacuum frees one page
+                for _ in range(min(pages, free)):
+                    self.conn.execute('PRAGMA incremental_vacuum')
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.stats.vacuumed_pages += min(pages, free)
+            elapsed = self.clock() - started
+            # Size the next slice to take about slice_seconds
+            if elapsed < self.slice_seconds / 2:
+                pages *= 2
+            elif elapsed > self.slice_seconds and pages > 1:
+                pages //= 2
+            self.sleep(self.pause_seconds)
+
+    def analyze(self):
+        """Refresh the query planner statistics one table at a time."""
+        self.conn.execute(f'PRAGMA analysis_limit = {int(self.analysis_limit)}')
+        for table in ANALYZE_TABLES:
+            if self.time_left() <= 0:
+                self.stats.out_of_time = True
+                return
+            self.conn.execute(f'ANALYZE {table}')
+            self.stats.analyzed_tables += 1
+            self.sleep(self.pause_seconds)
+
+    def run(self, full_vacuum: bool = False) -> MaintenanceStats:
+        self.deadline = self.clock() + self.budget_seconds
+        self.rollup()
+        self.prune_history()
+        if full_vacuum:
+            self.full_vacuum()
+        self.vacuum()
+        self.analyze()
+        # Shrink the write-ahead log as well, if no reader is still using it
+        self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return self.stats
+
+    def close(self):
+        self.conn.close()
+
+
+def run_maintenance(db_path: str, full_vacuum: bool = False, **kwargs) -> MaintenanceStats:
+    maintenance = Maintenance(db_path, **kwargs)
+    try:
+        return maintenance.run(full_vacuum)
+    finally:
+        maintenance.close()
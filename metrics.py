@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Stage timings, counters and structured logging for the scraper.
+
+Every poll is broken into stages (fetch, extract, parse_departures,
+parse_arrivals, diff, filter, write, record) whose durations are kept on the
+station's PollResult and accumulated in a Metrics registry along with row,
+change and byte counts. In daemon mode the registry can be scraped as
+Prometheus text from --metrics-port or written as JSON to --stats-file after
+every poll, and each poll's stage breakdown is logged so slow polls can be
+traced to the stage that was slow.
+"""
+
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+METRIC_PREFIX = 'scrape'
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+def label_set(labels: Dict[str, object]) -> LabelSet:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(labels: LabelSet) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def format_timings(timings: Dict[str, float]) -> str:
+    return ', '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in timings.items())
+
+
+class Metrics:
+    """Thread-safe registry of counters and per-stage timing summaries."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters: Dict[Tuple[str, LabelSet], float] = {}
+        # (stage, labels) -> [count, total seconds, max seconds, last seconds]
+        self.timings: Dict[Tuple[str, LabelSet], list] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, label_set(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage: str, seconds: float, **labels):
+        key = (stage, label_set(labels))
+        with self.lock:
+            summary = self.timings.get(key)
+            if summary is None:
+                self.timings[key] = [1, seconds, seconds, seconds]
+            else:
+                summary[0] += 1
+                summary[1] += seconds
+                summary[2] = max(summary[2], seconds)
+                summary[3] = seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage: str, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def record_poll(self, station: str, result):
+        """Add one station's PollResult, or the exception its poll raised, to the registry."""
+        if isinstance(result, Exception):
+            self.inc('polls_total', station=station, result='error')
+            return
+        outcome = 'changed' if result.changed else 'not_modified' if result.not_modified else 'unchanged'
+        self.inc('polls_total', station=station, result=outcome)
+        self.inc('bytes_transferred_total', result.bytes_transferred, station=station)
+        for stage, seconds in result.timings.items():
+            self.observe(stage, seconds, station=station)
+        if not result.changed:
+            return
+        self.inc('trains_parsed_total', result.trains, station=station)
+        for change in result.changes:
+            self.inc('changes_total', station=station, kind=change.kind)
+        for outcome in ('inserted', 'updated', 'unchanged', 'skipped'):
+            self.inc('rows_written_total', getattr(result.stats, outcome), station=station, outcome=outcome)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ]
+            timings = [
+                {'stage': stage, 'labels': dict(labels), 'count': count, 'total_seconds': total,
+                 'mean_seconds': total / count, 'max_seconds': maximum, 'last_seconds': last}
+                for (stage, labels), (count, total, maximum, last) in sorted(self.timings.items())
+            ]
+        return {
+            'started_at': datetime.datetime.fromtimestamp(self.started_at, datetime.timezone.utc).isoformat(),
+            'uptime_seconds': time.time() - self.started_at,
+            'counters': counters,
+            'timings': timings,
+        }
+
+    def to_prometheus(self) -> str:
+        """Render the registry in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(self.timings.items())
+
+        seen = set()
+        for (name, labels), value in counters:
+            metric = f'{METRIC_PREFIX}_{name}'
+            if metric not in seen:
+                seen.add(metric)
+                lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric}{format_labels(labels)} {value:g}')
+
+        metric = f'{METRIC_PREFIX}_stage_seconds'
+        if timings:
+            lines.append(f'# HELP {metric} Time spent in each stage of a poll')
+            lines.append(f'# TYPE {metric} summary')
+        for (stage, labels), (count, total, _, _) in timings:
+            stage_labels = format_labels(label_set({'stage': stage, **dict(labels)}))
+            lines.append(f'{metric}_count{stage_labels} {count}')
+            lines.append(f'{metric}_sum{stage_labels} {total:.6f}')
+        for suffix, index in (('max', 2), ('last', 3)):
+            if timings:
+                lines.append(f'# TYPE {metric}_{suffix} gauge')
+            for (stage, labels), summary in timings:
+                stage_labels = format_labels(label_set({'stage': stage, **dict(labels)}))
+                lines.append(f'{metric}_{suffix}{stage_labels} {summary[index]:.6f}')
+
+        lines.append(f'# TYPE {METRIC_PREFIX}_uptime_seconds gauge')
+        lines.append(f'{METRIC_PREFIX}_uptime_seconds {time.time() - self.started_at:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path: str):
+        """Write a snapshot to path, replacing it atomically so readers never see a partial file."""
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+# Registry shared by the pollers of this process
+METRICS = Metrics()
+
+
+class MetricsServer:
+    """Serves a Metrics registry as Prometheus text on /metrics and JSON on /stats.json."""
+
+    def __init__(self, metrics: Metrics, port: int, host: str = ''):
+        # Imported here as every command configures logging from this module, but only the daemon serves
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.to_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                elif self.path == '/stats.json':
+                    body = json.dumps(metrics.snapshot()).encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.getLogger(__name__).debug(format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# Attributes every LogRecord has, anything else was passed through extra=
+STANDARD_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as one JSON object, including any fields passed through extra=."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in STANDARD_RECORD_ATTRS:
+                entry[name] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = 'INFO', log_format: str = 'text', stream=None):
+    handler = logging.StreamHandler(stream)
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Long-running polling mode for the Moynihan Train Hall scraper.
+
+One process stays resident and reuses a single primp client (and its TLS
+connection pool), a single TrainWriter connection and the station poller's
+worker pools across scrapes. Scrapes are scheduled on a fixed cadence
+measured from the daemon's start time, so a slow scrape does not push every
+later scrape back, or by an AdaptiveScheduler that polls faster while tracks
+are due to be posted (see scheduler.py). SIGTERM/SIGINT stop the loop after
+the current scrape finishes. Stage timings and counters can be served as
+Prometheus text on a port or written to a JSON stats file after every
+scrape, and train changes can be pushed to subscribers as Server-Sent Events
+(see feed.py).
+"""
+
+import logging
+import random
+import signal
+import threading
+import time
+
+from typing import List, Optional
+
+import primp
+
+from archive import FragmentArchive
+from feed import ChangeFeed, FeedServer
+from http_cache import HttpCache
+from metrics import METRICS, Metrics, MetricsServer
+from scheduler import AdaptiveScheduler, board_time
+from scrape import DEFAULT_STATION, Station
+from shards import open_writer
+from stations import MultiStationPoller, log_results
+
+logger = logging.getLogger(__name__)
+
+
+class Daemon:
+    def __init__(self, db_path: str, interval: float = 60, jitter: float = 0, parser: str = 'bs4',
+                 client=None, clock=time.monotonic, cache_size_kib: int = 8192,
+                 stations: Optional[List[Station]] = None, parse_workers: Optional[int] = None,
+                 min_host_interval: float = 1.0, timeout: float = 10, http_cache_dir: Optional[str] = None,
+                 metrics: Metrics = METRICS, metrics_port: Optional[int] = None, stats_file: Optional[str] = None,
+                 archive_path: Optional[str] = None, feed_port: Optional[int] = None,
+                 shard_dir: Optional[str] = None, shard_period: str = 'month',
+                 scheduler: Optional[AdaptiveScheduler] = None):
+        if interval <= 0:
+            raise ValueError(f"interval must be positive: {interval}")
+        if jitter < 0 or jitter >= interval:
+            raise ValueError(f"jitter must be in [0, interval): {jitter}")
+        self.db_path = db_path
+        self.interval = interval
+        self.jitter = jitter
+        self.parser = parser
+        self.client = client
+        self.clock = clock
+        self.cache_size_kib = cache_size_kib
+        self.stations = stations or [DEFAULT_STATION]
+        self.parse_workers = parse_workers
+        self.min_host_interval = min_host_interval
+        self.timeout = timeout
+        self.http_cache_dir = http_cache_dir
+        self.metrics = metrics
+        self.metrics_port = metrics_port
+        self.stats_file = stats_file
+        self.metrics_server = None
+        self.archive_path = archive_path
+        self.archive = None
+        self.feed_port = feed_port
+        self.feed = ChangeFeed() if feed_port is not None else None
+        self.feed_server = None
+        self.shard_dir = shard_dir
+        self.shard_period = shard_period
+        self.scheduler = scheduler
+        self.bytes_transferred = 0
+        self.writer = None
+        self.station_poller = None
+        self.stop_event = threading.Event()
+        self.scrape_count = 0
+        self.error_count = 0
+
+    def next_due(self, start: float, now: float) -> float:
+        """
+        Return the next slot on the start + k * interval grid after now.
+
+        Slots missed because a scrape overran are skipped rather than run
+        back to back, which keeps the cadence from drifting.
+        """
+        slots = int((now - start) // self.interval) + 1
+        due = start + slots * self.interval
+        if self.jitter:
+            due += random.uniform(-self.jitter, self.jitter)
+        return max(due, now)
+
+    def next_adaptive(self, started: float, now: float, changed: bool) -> float:
+        """Return when the scheduler wants the scrape after the one started at started."""
+        boards = [detector.board() for detector in self.station_poller.detectors.values()]
+        interval = self.scheduler.next_interval(boards, changed, board_time())
+        self.metrics.observe('poll_interval', interval)
+        return max(started + interval, now)
+
+    def run_once(self):
+        """Scrape every station and store the trains with tracks that changed."""
+        results = self.station_poller.poll()
+        self.scrape_count += 1
+        self.error_count += sum(isinstance(result, Exception) for result in results.values())
+        self.bytes_transferred += sum(result.bytes_transferred for result in results.values()
+                                      if not isinstance(result, Exception))
+        log_results(results, self.db_path, include_unchanged=False)
+        if self.stats_file:
+            self.metrics.write_json(self.stats_file)
+        return results
+
+    def run(self):
+        """Scrape on a fixed cadence until stop() is called."""
+        if self.client is None:
+            self.client = primp.Client(timeout=self.timeout)
+        self.writer = open_writer(self.db_path, self.shard_dir, self.shard_period, cache_size_kib=self.cache_size_kib)
+        if self.archive_path:
+            self.archive = FragmentArchive(self.archive_path)
+        self.station_poller = MultiStationPoller(self.stations, self.writer, parser=self.parser, client=self.client,
+                                                 parse_workers=self.parse_workers,
+                                                 min_host_interval=self.min_host_interval,
+                                                 http_cache=HttpCache(self.http_cache_dir) if self.http_cache_dir else None,
+                                                 metrics=self.metrics, archive=self.archive, feed=self.feed)
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+            self.metrics_server.start()
+            logger.info("Serving metrics on port %d", self.metrics_server.port)
+        if self.feed is not None:
+            self.feed_server = FeedServer(self.feed, self.feed_port)
+            self.feed_server.start()
+            logger.info("Serving the change feed on port %d", self.feed_server.port)
+        try:
+            start = self.clock()
+            while not self.stop_event.is_set():
+                started = self.clock()
+                changed = False
+                try:
+                    results = self.run_once()
+                    changed = any(getattr(result, 'changed', False) for result in results.values())
+                except Exception:
+                    # Keep polling through transient database or parse failures
+                    self.error_count += 1
+                    self.metrics.inc('poll_errors_total')
+                    logger.exception("Scrape failed")
+                now = self.clock()
+                if self.scheduler is not None:
+                    due = self.next_adaptive(started, now, changed)
+                else:
+                    due = self.next_due(start, now)
+                self.stop_event.wait(due - now)
+        finally:
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+                self.metrics_server = None
+            if self.feed_server is not None:
+                self.feed_server.close()
+                self.feed_server = None
+            self.station_poller.close()
+            self.station_poller = None
+            self.writer.close()
+            self.writer = None
+            if self.archive is not None:
+                self.archive.close()
+                self.archive = None
+
+    def stop(self, *_):
+        self.stop_event.set()
+
+
+def run_daemon(db_path: str, interval: float = 60, jitter: float = 0, parser: str = 'bs4',
+               cache_size_kib: int = 8192, stations: Optional[List[Station]] = None,
+               parse_workers: Optional[int] = None, min_host_interval: float = 1.0, timeout: float = 10,
+               http_cache_dir: Optional[str] = None, metrics_port: Optional[int] = None,
+               stats_file: Optional[str] = None, archive_path: Optional[str] = None,
+               feed_port: Optional[int] = None, shard_dir: Optional[str] = None, shard_period: str = 'month',
+               scheduler: Optional[AdaptiveScheduler] = None):
+    """Run the polling daemon in the foreground, stopping cleanly on SIGTERM or SIGINT."""
+    daemon = Daemon(db_path, interval=interval, jitter=jitter, parser=parser, cache_size_kib=cache_size_kib,
+                    stations=stations, parse_workers=parse_workers, min_host_interval=min_host_interval,
+                    timeout=timeout, http_cache_dir=http_cache_dir, metrics_port=metrics_port,
+                    stats_file=stats_file, archive_path=archive_path, feed_port=feed_port,
+                    shard_dir=shard_dir, shard_period=shard_period, scheduler=scheduler)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    if scheduler is not None:
+        logger.info("Polling every %ss while tracks are due, otherwise every %ss backing off to %ss, into database: %s",
+                    scheduler.min_interval, scheduler.interval, scheduler.max_interval, db_path)
+    else:
+        logger.info("Polling every %ss (jitter %ss) into database: %s", interval, jitter, db_path)
+    daemon.run()
+    logger.info("Stopped after %d scrapes (%d failed, %d bytes transferred)",
+                daemon.scrape_count, daemon.error_count, daemon.bytes_transferred)
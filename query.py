@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Track prediction statistics.
+
+TrackStats keeps two summary tables up to date as changes are polled:
+track_stats counts which track each train/name/destination was assigned, and
+track_lead_stats is a histogram of how long before the scheduled time the
+track was first posted. Both are updated incrementally from the board diff,
+so the query helpers only read a handful of summary rows instead of
+aggregating the whole history.
+
+Postings are keyed on the scheduled train rather than the day the board was
+scraped on. A train already showing a track when it first appears, because
+the day rolled over or the poller restarted without a snapshot, is matched
+against track_postings: within REPOST_WINDOW_SECONDS of the last posting
+counted for it, the same track is not counted again and a different one is
+a reassignment.
+"""
+
+import sqlite3
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from changes import CHANGE_NEW, CHANGE_TRACK, TrainChange
+from scrape import DEFAULT_STATION, scheduled_datetime, transaction
+
+# Width of a track_lead_stats histogram bucket
+LEAD_BUCKET_SECONDS = 300
+# A train seen tracked again sooner than this after its last counted posting
+# is the same run, a daily train's next run is posted about a day later
+REPOST_WINDOW_SECONDS = 12 * 3600
+
+
+@dataclass
+class TrackShare:
+    track: str
+    assignments: int
+    share: float
+
+
+@dataclass
+class LeadSummary:
+    samples: int
+    mean_minutes: float
+    median_minutes: float
+    p10_minutes: float
+    p90_minutes: float
+
+
+class TrackStats:
+    def __init__(self, conn: sqlite3.Connection, station: str = DEFAULT_STATION.code):
+        self.conn = conn
+        self.station = station
+
+    def to_rows(self, changes: List[TrainChange], observed_at: int):
+        """
+        Return the track postings and reassignments among changes as (observed_at, station,
+        day, schedule_time, train_number, train_name, destination, old_track, track).
+        """
+        return [
+            (
+                observed_at,
+                self.station,
+                change.train.day,
+                change.train.time,
+                change.train.train_number,
+                change.train.train_name,
+                change.train.destination,
+                change.previous.track if change.previous else None,
+                change.train.track,
+            )
+            for change in changes
+            if change.kind in (CHANGE_NEW, CHANGE_TRACK) and change.train.track
+        ]
+
+    def record(self, changes: List[TrainChange], observed_at: int):
+        """Apply the track postings and reassignments among changes to the summaries."""
+        rows = self.to_rows(changes, observed_at)
+        if rows:
+            with transaction(self.conn):
+                self._apply(rows)
+
+    def _last_posting(self, key: tuple, schedule_time: str, observed_at: int) -> Optional[str]:
+        """Return the track last counted for a scheduled train if it was within REPOST_WINDOW_SECONDS."""
+        row = self.conn.execute('''
+            SELECT track FROM track_postings
+            WHERE station = ? AND train_number = ? AND train_name = ? AND destination = ? AND schedule_time = ?
+              AND observed_at > ?
+        ''', key + (schedule_time, observed_at - REPOST_WINDOW_SECONDS)).fetchone()
+        return row[0] if row else None
+
+    def _apply(self, rows):
+        for observed_at, station, day, schedule_time, train_number, train_name, destination, old_track, track in rows:
+            key = (station, train_number, train_name, destination)
+            if not old_track:
+                old_track = self._last_posting(key, schedule_time, observed_at)
+                if old_track == track:
+                    continue
+            self.conn.execute('''
+                INSERT OR REPLACE INTO track_postings
+                (station, train_number, train_name, destination, schedule_time, track, observed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', key + (schedule_time, track, observed_at))
+            if old_track:
+                # A reassignment moves the train's count to the new track but is
+                # not a new posting, so it adds no lead time sample
+                self.conn.execute('''
+                    UPDATE track_stats SET assignments = assignments - 1
+                    WHERE station = ? AND train_number = ? AND train_name = ? AND destination = ? AND track = ?
+                ''', key + (old_track,))
+                self.conn.execute('''
+                    DELETE FROM track_stats
+                    WHERE station = ? AND train_number = ? AND train_name = ? AND destination = ? AND track = ?
+                      AND assignments <= 0
+                ''', key + (old_track,))
+            else:
+                try:
+                    lead_seconds = int(scheduled_datetime(day, schedule_time).timestamp()) - observed_at
+                except ValueError:
+                    lead_seconds = None
+                if lead_seconds is not None:
+                    self.conn.execute('''
+                        INSERT INTO track_lead_stats
+                        (station, train_number, train_name, destination, lead_bucket, samples, lead_seconds_total)
+                        VALUES (?, ?, ?, ?, ?, 1, ?)
+                        ON CONFLICT (station, train_number, train_name, destination, lead_bucket) DO UPDATE SET
+                            samples = samples + 1,
+                            lead_seconds_total = lead_seconds_total + excluded.lead_seconds_total
+                    ''', key + (lead_seconds // LEAD_BUCKET_SECONDS, lead_seconds))
+            self.conn.execute('''
+                INSERT INTO track_stats (station, train_number, train_name, destination, track, assignments)
+                VALUES (?, ?, ?, ?, ?, 1)
+                ON CONFLICT (station, train_number, train_name, destination, track) DO UPDATE SET
+                    assignments = assignments + 1
+            ''', key + (track,))
+
+    def rebuild(self):
+        """
+        Recompute both summaries from scratch by replaying the train_events log.
+
+        Days whose events were pruned by `maintain` are replayed from their
+        train_days rollup first, as a single posting of each train's final track.
+        """
+        with transaction(self.conn):
+            self.conn.execute('DELETE FROM track_stats')
+            self.conn.execute('DELETE FROM track_lead_stats')
+            self.conn.execute('DELETE FROM track_postings')
+            rolled_up = self.conn.execute('''
+                SELECT track_posted_at, station, day, schedule_time, train_number, train_name, destination,
+                       NULL, final_track
+                FROM train_days
+                WHERE track_posted_at IS NOT NULL AND final_track != ''
+                ORDER BY track_posted_at
+            ''')
+            self._apply(rolled_up)
+            rows = self.conn.execute('''
+                SELECT observed_at, station, day, schedule_time, train_number, train_name, destination, old_track, track
+                FROM train_events
+                WHERE event IN (?, ?) AND track != ''
+                ORDER BY observed_at, rowid
+            ''', (CHANGE_NEW, CHANGE_TRACK))
+            self._apply(rows)
+
+
+def _filter(station: str, train_number: Optional[str], train_name: Optional[str],
+            destination: Optional[str]) -> Tuple[str, tuple]:
+    clauses = ['station = ?']
+    params = [station]
+    for column, value in (('train_number', train_number), ('train_name', train_name), ('destination', destination)):
+        if value is not None:
+            clauses.append(f'{column} = ?')
+            params.append(value)
+    if len(clauses) == 1:
+        raise ValueError("At least one of train_number, train_name or destination is required")
+    return ' AND '.join(clauses), tuple(params)
+
+
+def track_distribution(conn: sqlite3.Connection, train_number: Optional[str] = None,
+                       train_name: Optional[str] = None, destination: Optional[str] = None,
+                       station: str = DEFAULT_STATION.code) -> List[TrackShare]:
+    """Return how often each track was assigned to matching trains, most common first."""
+    where, params = _filter(station, train_number, train_name, destination)
+    rows = conn.execute(f'''
+        SELECT track, SUM(assignments) AS assignments
+        FROM track_stats
+        WHERE {where}
+        GROUP BY track
+        ORDER BY assignments DESC, track
+    ''', params).fetchall()
+    total = sum(assignments for _, assignments in rows)
+    return [TrackShare(track, assignments, assignments / total) for track, assignments in rows]
+
+
+def track_lead(conn: sqlite3.Connection, train_number: Optional[str] = None,
+               train_name: Optional[str] = None, destination: Optional[str] = None,
+               station: str = DEFAULT_STATION.code) -> Optional[LeadSummary]:
+    """
+    Summarize how long before the scheduled time matching trains had their track posted.
+
+    Percentiles are read from the histogram and are accurate to the bucket width.
+    """
+    where, params = _filter(station, train_number, train_name, destination)
+    buckets = conn.execute(f'''
+        SELECT lead_bucket, SUM(samples), SUM(lead_seconds_total)
+        FROM track_lead_stats
+        WHERE {where}
+        GROUP BY lead_bucket
+        ORDER BY lead_bucket
+    ''', params).fetchall()
+    samples = sum(count for _, count, _ in buckets)
+    if not samples:
+        return None
+
+    def percentile(fraction):
+        threshold = fraction * samples
+        seen = 0
+        for bucket, count, _ in buckets:
+            seen += count
+            if seen >= threshold:
+                return (bucket + 0.5) * LEAD_BUCKET_SECONDS / 60
+        return (buckets[-1][0] + 0.5) * LEAD_BUCKET_SECONDS / 60
+
+    return LeadSummary(
+        samples=samples,
+        mean_minutes=sum(total for _, _, total in buckets) / samples / 60,
+        median_minutes=percentile(0.5),
+        p10_minutes=percentile(0.1),
+        p90_minutes=percentile(0.9),
+    )
+
+
+def run_query(db_path: str, train_number: Optional[str] = None, train_name: Optional[str] = None,
+              destination: Optional[str] = None, station: str = DEFAULT_STATION.code, rebuild: bool = False):
+    """Print the track distribution and posting lead time for matching trains."""
+    conn = sqlite3.connect(db_path)
+    try:
+        if rebuild:
+            TrackStats(conn).rebuild()
+        distribution = track_distribution(conn, train_number, train_name, destination, station)
+        lead = track_lead(conn, train_number, train_name, destination, station)
+    finally:
+        conn.close()
+
+    if not distribution:
+        print("No track assignments recorded for matching trains")
+        return
+    for share in distribution:
+        print(f"Track {share.track}: {share.assignments} ({share.share:.0%})")
+    if lead:
+        print(f"Track posted {lead.median_minutes:.0f} min before scheduled time (median over {lead.samples}, "
+              f"mean {lead.mean_minutes:.1f}, p10 {lead.p10_minutes:.0f}, p90 {lead.p90_minutes:.0f})")
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Adaptive polling cadence for the daemon.
+
+A track appears in a board's track-cell in the last twenty minutes or so
+before a train leaves. A fixed interval either wastes requests overnight or
+sees postings late. AdaptiveScheduler reads the boards it was last given to
+work out when each train without a track is expected: its scheduled time,
+or the new time of a status like "Now 9:25PM". A train's track window opens
+lead_minutes before that time and closes overdue_minutes after it.
+
+    in a window     poll every min_interval seconds
+    otherwise       poll every interval seconds, backing off by a factor
+                    for every poll in a row that found the board unchanged,
+                    up to max_interval, but waking when the next window opens
+
+Without --adaptive the daemon keeps its fixed interval.
+
+simulate() replays boards recorded with --archive under a scheduler. The
+fetch that first showed a track is taken as the time it was posted, so the
+replay can report how many fetches a scheduler makes and how late it sees
+each track. `scrape.py simulate` compares the adaptive scheduler with a
+fixed interval. The replay cannot be finer than the recording: a scheduler
+polling faster than the archive was recorded sees the same board again.
+"""
+
+import bisect
+import datetime
+import functools
+import logging
+import math
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+from analytics import TIME_PATTERN, minute_of_day, parse_status
+from archive import FragmentArchive
+from changes import train_key
+from scrape import DEFAULT_STATION, ScheduleBoard, Train, parse_fragments, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def board_time(timestamp: Optional[float] = None) -> datetime.datetime:
+    """Return the station's local time, now or at a Unix timestamp, without a time zone as boards show it."""
+    if timestamp is None:
+        return datetime.datetime.now(timezone()).replace(tzinfo=None)
+    return datetime.datetime.fromtimestamp(timestamp, timezone()).replace(tzinfo=None)
+
+
+@functools.lru_cache(maxsize=4096)
+def scheduled_at(day: str, schedule_time: str) -> Optional[datetime.datetime]:
+    """Return when a train on a board of day is scheduled, e.g. ("2024-01-15", "9:20 PM")."""
+    match = TIME_PATTERN.fullmatch(schedule_time.strip()) if schedule_time else None
+    if match is None:
+        return None
+    try:
+        midnight = datetime.datetime.fromisoformat(day)
+    except ValueError:
+        return None
+    return midnight + datetime.timedelta(minutes=minute_of_day(match))
+
+
+def expected_at(train: Train, now: datetime.datetime) -> Optional[datetime.datetime]:
+    """Return when a train is expected to leave or arrive, or None if it is cancelled or has no time."""
+    scheduled = scheduled_at(train.day, train.time)
+    if scheduled is None:
+        return None
+    # A train scheduled just after midnight is listed under the day before
+    if scheduled < now - datetime.timedelta(hours=12):
+        scheduled += datetime.timedelta(days=1)
+    status = parse_status(train.status, train.time)
+    if status.cancelled:
+        return None
+    return scheduled + datetime.timedelta(minutes=status.delay_minutes or 0)
+
+
+class FixedScheduler:
+    """Poll every interval seconds whatever the boards show."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+
+    def next_interval(self, boards: Iterable[ScheduleBoard], changed: bool, now: datetime.datetime) -> float:
+        return self.interval
+
+
+class AdaptiveScheduler:
+    def __init__(self, interval: float = 60, min_interval: float = 15, max_interval: float = 600,
+                 lead_minutes: float = 20, overdue_minutes: float = 30, backoff: float = 1.5):
+        if not 0 < min_interval <= interval <= max_interval:
+            raise ValueError(f"intervals must satisfy 0 < min <= interval <= max: "
+                             f"{min_interval}, {interval}, {max_interval}")
+        if backoff < 1:
+            raise ValueError(f"backoff must be at least 1: {backoff}")
+        self.interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lead = datetime.timedelta(minutes=lead_minutes)
+        self.overdue = datetime.timedelta(minutes=overdue_minutes)
+        self.backoff = backoff
+        self.unchanged_polls = 0
+
+    def window_opens_in(self, train: Train, now: datetime.datetime) -> Optional[float]:
+        """
+        Return the seconds until a train's track window opens, 0 while it is
+        open, or None if the train has a track or its window has closed.
+        """
+        if train.track:
+            return None
+        expected = expected_at(train, now)
+        if expected is None or now > expected + self.overdue:
+            return None
+        return max((expected - self.lead - now).total_seconds(), 0)
+
+    def next_interval(self, boards: Iterable[ScheduleBoard], changed: bool, now: datetime.datetime) -> float:
+        """Return the seconds to wait before the next poll, given the latest boards and whether any changed."""
+        self.unchanged_polls = 0 if changed else self.unchanged_polls + 1
+        quiet = min(self.interval * self.backoff ** self.unchanged_polls, self.max_interval)
+        opens = [self.window_opens_in(train, now)
+                 for board in boards for train in board.departures + board.arrivals]
+        opens_in = min((seconds for seconds in opens if seconds is not None), default=None)
+        if opens_in is None:
+            return quiet
+        return max(min(quiet, opens_in), self.min_interval)
+
+
+@dataclass
+class SimulationResult:
+    recorded_fetches: int
+    fetches: int
+    # Tracks posted during the recording, and how many of them the replay saw
+    tracks: int
+    detected: int
+    median_latency: Optional[float]
+    p90_latency: Optional[float]
+    max_latency: Optional[float]
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    """Return the nearest-rank percentile of values, e.g. share=0.9, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(share * len(ordered)) - 1, 0)]
+
+
+class Recording:
+    """A station's archived boards in fetch order, each parsed once."""
+
+    def __init__(self, archive_path: str, station: str = DEFAULT_STATION.code, since_day: Optional[str] = None,
+                 until_day: Optional[str] = None, parser: str = 'stream'):
+        archive = FragmentArchive(archive_path, read_only=True)
+        self.times: List[int] = []
+        self.boards: List[ScheduleBoard] = []
+        # Index of each fetch's distinct board, so a replay can tell whether the board changed
+        self.versions: List[int] = []
+        parsed: Dict[tuple, int] = {}
+        distinct: List[ScheduleBoard] = []
+        try:
+            for fetched_at, _, day, departures_hash, arrivals_hash in archive.fetches(since_day, until_day, station):
+                key = (day, departures_hash, arrivals_hash)
+                if key not in parsed:
+                    board = parse_fragments(archive.fragment(departures_hash), archive.fragment(arrivals_hash),
+                                            parser=parser)
+                    # As in reparse(), the archive knows the day the board was fetched on
+                    for train in board.departures + board.arrivals:
+                        train.day = day
+                    parsed[key] = len(distinct)
+                    distinct.append(board)
+                self.times.append(fetched_at)
+                self.versions.append(parsed[key])
+                self.boards.append(distinct[parsed[key]])
+        finally:
+            archive.close()
+
+    def __len__(self):
+        return len(self.times)
+
+    def at(self, timestamp: float) -> int:
+        """Return the index of the last fetch recorded at or before timestamp."""
+        return bisect.bisect_right(self.times, timestamp) - 1
+
+    def posted(self) -> Dict[tuple, int]:
+        """Return the time of the first fetch showing each train's track."""
+        posted = {}
+        for fetched_at, board in zip(self.times, self.boards):
+            for train in board.departures + board.arrivals:
+                if train.track:
+                    posted.setdefault(train_key(train), fetched_at)
+        return posted
+
+
+def simulate(recording: Recording, scheduler) -> SimulationResult:
+    """Replay a recording, polling when scheduler says, and measure how late each posted track is seen."""
+    posted = recording.posted()
+    if not len(recording):
+        return SimulationResult(0, 0, 0, 0, None, None, None)
+    seen: Dict[tuple, float] = {}
+    fetches = 0
+    version = None
+    now = recording.times[0]
+    while now <= recording.times[-1]:
+        index = recording.at(now)
+        board = recording.boards[index]
+        fetches += 1
+        for train in board.departures + board.arrivals:
+            if train.track:
+                seen.setdefault(train_key(train), now)
+        changed = recording.versions[index] != version
+        version = recording.versions[index]
+        now += scheduler.next_interval([board], changed, board_time(now))
+    latencies = [seen[key] - posted_at for key, posted_at in posted.items() if key in seen]
+    return SimulationResult(
+        recorded_fetches=len(recording),
+        fetches=fetches,
+        tracks=len(posted),
+        detected=len(latencies),
+        median_latency=percentile(latencies, 0.5),
+        p90_latency=percentile(latencies, 0.9),
+        max_latency=max(latencies, default=None),
+    )
+
+
+def run_simulation(archive_path: str, interval: float, min_interval: float, max_interval: float,
+                   station: str = DEFAULT_STATION.code, since_day: Optional[str] = None,
+                   until_day: Optional[str] = None, parser: str = 'stream', lead_minutes: float = 20):
+    """Print how a fixed interval and the adaptive scheduler would have polled a recording."""
+    recording = Recording(archive_path, station, since_day, until_day, parser)
+    if not len(recording):
+        print(f"No fetches of {station} archived in {archive_path}")
+        return
+    print(f"{len(recording)} fetches of {station} recorded, tracks posted for {len(recording.posted())} trains")
+    for name, scheduler in (
+        (f"Fixed {interval:g}s", FixedScheduler(interval)),
+        (f"Adaptive {min_interval:g}-{max_interval:g}s",
+         AdaptiveScheduler(interval, min_interval, max_interval, lead_minutes=lead_minutes)),
+    ):
+        result = simulate(recording, scheduler)
+        if result.detected:
+            latency = (f"median {result.median_latency:.0f}s, p90 {result.p90_latency:.0f}s, "
+                       f"max {result.max_latency:.0f}s")
+        else:
+            latency = "no latencies"
+        print(f"{name}: {result.fetches} fetches, {result.detected}/{result.tracks} tracks seen, {latency}")
@@ -8,20 +8,40 @@ specified by the TZ environment variable (defaults to America/New_York).
 """
 
 import datetime
-import primp
-from bs4 import BeautifulSoup
+import functools
 from dataclasses import dataclass
-from typing import List
+from html.parser import HTMLParser
+from typing import Callable, Dict, List, Optional, Tuple
 import argparse
+import contextlib
+import logging
+import re
 import sqlite3
 import os
-import pytz
+import sys
+import time
 
+# primp, bs4 and pytz take most of the start-up time, so they are imported
+# where they are used and subcommands that do not fetch or parse skip them
 TIMEZONE_NAME = os.environ.get('TZ', 'America/New_York')
-TIMEZONE = pytz.timezone(TIMEZONE_NAME)
 
+@functools.lru_cache(maxsize=None)
+def timezone():
+    import pytz
+    return pytz.timezone(TIMEZONE_NAME)
 
-@dataclass
+def __getattr__(name):
+    # TIMEZONE used to be created on import
+    if name == 'TIMEZONE':
+        return timezone()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Named explicitly so records keep the module name when run as a script
+logger = logging.getLogger('scrape')
+
+
+# Slotted, so the many Train records of a board take no per-instance dict
+@dataclass(slots=True)
 class Train:
     day: str
     time: str
@@ -31,25 +51,47 @@ class Train:
     status: str
     track: str = ""
 
-@dataclass
+    def astuple(self) -> tuple:
+        """Return the fields in declaration order, without the deep copy of dataclasses.astuple()."""
+        return (self.day, self.time, self.train_number, self.train_name, self.destination, self.status,
+                self.track)
+
+@dataclass(slots=True)
 class ScheduleBoard:
     departures: List[Train]
     arrivals: List[Train]
 
+DEPARTURES_TARGET_ID = 'amtrak-departures-target'
+ARRIVALS_TARGET_ID = 'amtrak-arrivals-target'
+
+@dataclass(frozen=True)
+class Station:
+    """A station board page using the amtrak-header-row markup."""
+    code: str
+    url: str
+    referer: str
+    departures_target_id: str = DEPARTURES_TARGET_ID
+    arrivals_target_id: str = ARRIVALS_TARGET_ID
+
+DEFAULT_STATION = Station(
+    code='NYP',
+    url='https://moynihantrainhall.nyc/transportation/',
+    referer='https://moynihantrainhall.nyc/',
+)
+
+def current_day() -> str:
+    """Return the service day a scrape taken now belongs to."""
+    return datetime.datetime.now(timezone()).strftime("%Y-%m-%d")
+
 def adapt_date_iso(val):
     """Adapt datetime.date to ISO 8601 date."""
     return val.isoformat()
 
-def adapt_datetime_iso(val):
-    """Adapt datetime.datetime to ISO 8601 date."""
-    return val.isoformat()
-
 def adapt_datetime_epoch(val):
     """Adapt datetime.datetime to Unix timestamp."""
     return int(val.timestamp())
 
 sqlite3.register_adapter(datetime.date, adapt_date_iso)
-sqlite3.register_adapter(datetime.datetime, adapt_datetime_iso)
 sqlite3.register_adapter(datetime.datetime, adapt_datetime_epoch)
 
 def convert_date(val):
@@ -70,72 +112,595 @@ sqlite3.register_converter("date", convert_date)
 sqlite3.register_converter("datetime", convert_datetime)
 sqlite3.register_converter("timestamp", convert_timestamp)
 
-def init_database(db_path: str):
-    """Initialize the SQLite database with the train_track_locations table."""
+def table_columns(cursor, table: str) -> List[str]:
+    """Return the column names of a table, or an empty list if it does not exist."""
+    return [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+
+def column_types(cursor, table: str) -> Dict[str, str]:
+    """Return the declared type of each column of a table."""
+    return {row[1]: row[2] for row in cursor.execute(f'PRAGMA table_info({table})')}
+
+def add_missing_column(cursor, table: str, column: str, declaration: str):
+    """Add a column to a table created by an older version of init_database."""
+    if column not in table_columns(cursor, table):
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+
+SCHEMA_VERSION = 2
+
+# v2 lookup tables, by the train_track_locations column whose values they hold.
+# Boards repeat a few dozen distinct names, so rows store small integer ids.
+LOOKUP_TABLES = {
+    'schedule_time': 'schedule_times',
+    'train_name': 'train_names',
+    'destination': 'destinations',
+    'status': 'statuses',
+}
+
+# Clustered on the natural key, so a day's rows are stored next to each other
+# and there is no separate rowid b-tree to keep in step with the key index
+TRAIN_LOCATIONS_SQL = '''
+    CREATE TABLE IF NOT EXISTS train_locations (
+        day TEXT NOT NULL,
+        station TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        train_number TEXT NOT NULL,
+        schedule_time_id INTEGER REFERENCES schedule_times (id),
+        train_name_id INTEGER REFERENCES train_names (id),
+        destination_id INTEGER REFERENCES destinations (id),
+        status_id INTEGER REFERENCES statuses (id),
+        track TEXT,
+        PRIMARY KEY (day, station, time, train_number)
+    ) WITHOUT ROWID
+'''
+
+# time holds epoch seconds, like train_locations
+TRAIN_EVENTS_SQL = '''
+    CREATE TABLE IF NOT EXISTS train_events (
+        observed_at INTEGER NOT NULL,
+        event TEXT NOT NULL,
+        day DATE,
+        time INTEGER,
+        schedule_time TEXT,
+        train_number TEXT,
+        train_name TEXT,
+        destination TEXT,
+        old_status TEXT,
+        status TEXT,
+        old_track TEXT,
+        track TEXT,
+        station TEXT NOT NULL DEFAULT 'NYP'
+    )
+'''
+
+# Read-only view with the v1 table's columns, for queries and tools reading history
+TRAIN_TRACK_LOCATIONS_VIEW_SQL = '''
+    CREATE VIEW IF NOT EXISTS train_track_locations AS
+    SELECT l.day AS day, l.time AS time, schedule_times.name AS schedule_time, l.train_number AS train_number,
+           train_names.name AS train_name, destinations.name AS destination, statuses.name AS status,
+           l.track AS track, l.station AS station
+    FROM train_locations AS l
+    LEFT JOIN schedule_times ON schedule_times.id = l.schedule_time_id
+    LEFT JOIN train_names ON train_names.id = l.train_name_id
+    LEFT JOIN destinations ON destinations.id = l.destination_id
+    LEFT JOIN statuses ON statuses.id = l.status_id
+'''
+
+MIGRATION_PROGRESS_KEY = 'migrate_v2_rowid'
+
+@dataclass
+class MigrationStats:
+    rows: int = 0
+    skipped: int = 0
+    batches: int = 0
+
+def create_v2_tables(cursor):
+    for table in LOOKUP_TABLES.values():
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {table} (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+    cursor.execute(TRAIN_LOCATIONS_SQL)
+    # Per-train track history, as served by app.py
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS train_locations_by_train
+        ON train_locations (station, train_number, day)
+    ''')
+
+def has_v1_table(cursor) -> bool:
+    """Return whether train_track_locations is still a v1 table rather than the v2 view."""
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = 'train_track_locations'").fetchone()
+    return row is not None and row[0] == 'table'
+
+def v1_row_time(day: Optional[str], schedule_time: Optional[str], time: Optional[int]) -> Optional[int]:
+    """
+    Return the epoch time of a v1 row, recomputed from its day and schedule_time.
+
+    v1 times were parsed with %H, so PM trains are twelve hours early. Rows
+    whose schedule_time does not parse keep the time they were stored with.
+    """
+    try:
+        return int(parse_day_time(day, schedule_time)[1].timestamp())
+    except (TypeError, ValueError):
+        return time
+
+def migrate_to_v2(conn: sqlite3.Connection, batch_rows: int = 100000) -> MigrationStats:
+    """
+    Copy a v1 train_track_locations table into train_locations and its lookup tables.
+
+    Rows are copied in rowid ranges of batch_rows, each range in its own
+    transaction with the last copied rowid kept in board_state, so memory use
+    does not grow with the table and an interrupted migration carries on where
+    it stopped. Once every row is copied the v1 table is dropped and replaced
+    by the train_track_locations view. Times are recomputed with v1_row_time(),
+    and rows that then share a key are merged into the one written last. Rows
+    without a day, time or train number cannot be keyed and are skipped.
+    Tables from before stations were tracked have no station column, and
+    their rows are all Moynihan.
+    """
+    stats = MigrationStats()
+    cursor = conn.cursor()
+    conn.create_function('v1_row_time', 3, v1_row_time, deterministic=True)
+    create_v2_tables(cursor)
+    conn.commit()
+    station = 'v1.station' if 'station' in table_columns(cursor, 'train_track_locations') else "'NYP'"
+    last_rowid = cursor.execute('SELECT MAX(rowid) FROM train_track_locations').fetchone()[0] or 0
+    row = cursor.execute('SELECT value FROM board_state WHERE name = ?', (MIGRATION_PROGRESS_KEY,)).fetchone()
+    start = int(row[0]) if row else 0
+    if start:
+        logger.warning("Resuming the v2 migration of train_track_locations after rowid %d", start)
+    else:
+        logger.warning("Migrating train_track_locations to the v2 schema")
+
+    joins = ' '.join(f'LEFT JOIN {table} ON {table}.name = v1.{column}' for column, table in LOOKUP_TABLES.items())
+    while start < last_rowid:
+        end = min(start + batch_rows, last_rowid)
+        with conn:
+            for column, table in LOOKUP_TABLES.items():
+                cursor.execute(f'''
+                    INSERT OR IGNORE INTO {table} (name)
+                    SELECT DISTINCT {column} FROM train_track_locations
+                    WHERE rowid > ? AND rowid <= ? AND {column} IS NOT NULL
+                ''', (start, end))
+            # v1 wrote with INSERT OR REPLACE, so the highest rowid of a key is its latest write
+            inserted = cursor.execute(f'''
+                INSERT INTO train_locations
+                (day, station, time, train_number, schedule_time_id, train_name_id, destination_id, status_id, track)
+                SELECT v1.day, {station}, v1_row_time(v1.day, v1.schedule_time, v1.time),
+                       v1.train_number, schedule_times.id, train_names.id, destinations.id, statuses.id, v1.track
+                FROM train_track_locations AS v1 {joins}
+                WHERE v1.rowid > ? AND v1.rowid <= ? AND v1.day IS NOT NULL AND v1.train_number IS NOT NULL
+                  AND v1_row_time(v1.day, v1.schedule_time, v1.time) IS NOT NULL
+                ORDER BY v1.rowid
+                ON CONFLICT (day, station, time, train_number) DO UPDATE SET
+                    schedule_time_id = excluded.schedule_time_id, train_name_id = excluded.train_name_id,
+                    destination_id = excluded.destination_id, status_id = excluded.status_id, track = excluded.track
+            ''', (start, end)).rowcount
+            copied = cursor.execute('SELECT COUNT(*) FROM train_track_locations WHERE rowid > ? AND rowid <= ?',
+                                    (start, end)).fetchone()[0]
+            cursor.execute('INSERT OR REPLACE INTO board_state (name, value) VALUES (?, ?)',
+                           (MIGRATION_PROGRESS_KEY, str(end)))
+        stats.rows += inserted
+        stats.skipped += copied - inserted
+        stats.batches += 1
+        start = end
+        logger.info("Migrated train_track_locations up to rowid %d of %d", end, last_rowid)
+
+    # DDL does not open a transaction implicitly, so the swap is made atomic explicitly
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('DROP TABLE train_track_locations')
+        cursor.execute(TRAIN_TRACK_LOCATIONS_VIEW_SQL)
+        cursor.execute('DELETE FROM board_state WHERE name = ?', (MIGRATION_PROGRESS_KEY,))
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return stats
+
+def retype_train_events_time(conn: sqlite3.Connection):
+    """
+    Rebuild a train_events table whose time column was declared DATETIME.
+
+    The column has always held epoch seconds, which connections opened with
+    PARSE_DECLTYPES failed to convert as ISO text on read. SQLite cannot change
+    a declared type in place, so the rows are copied into a new table in one
+    transaction. Its indexes are dropped with the old table and recreated by
+    init_database.
+    """
+    logger.warning("Rebuilding train_events with its time column declared INTEGER")
+    cursor = conn.cursor()
+    columns = ', '.join(table_columns(cursor, 'train_events'))
+    cursor.execute('BEGIN')
+    try:
+        cursor.execute('ALTER TABLE train_events RENAME TO train_events_old')
+        cursor.execute(TRAIN_EVENTS_SQL)
+        cursor.execute(f'INSERT INTO train_events ({columns}) SELECT {columns} FROM train_events_old')
+        cursor.execute('DROP TABLE train_events_old')
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def init_database(db_path: str, batch_rows: int = 100000):
+    """
+    Initialize the SQLite database tables: train history, events, track summaries and scraper state.
+
+    A train_track_locations table from before the v2 schema is migrated in place.
+    """
     conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
     cursor = conn.cursor()
-    
+    # Only takes effect on a new database, letting `maintain` give freed pages
+    # back a slice at a time. Older files switch with `maintain --full-vacuum`.
+    cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+
+    # Small key/value table for scraper state that must survive restarts,
+    # such as the fingerprint of the last board written
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS train_track_locations (
-            day DATE,
-            time DATETIME,
-            schedule_time TEXT,
+        CREATE TABLE IF NOT EXISTS board_state (
+            name TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+    create_v2_tables(cursor)
+    if has_v1_table(cursor):
+        conn.commit()
+        migrate_to_v2(conn, batch_rows)
+    cursor.execute(TRAIN_TRACK_LOCATIONS_VIEW_SQL)
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    # Append-only log of every observed train transition. The partial and
+    # covering indexes serve per-train history, per-day track assignments and
+    # per-track usage queries without touching the table itself.
+    cursor.execute(TRAIN_EVENTS_SQL)
+    add_missing_column(cursor, 'train_events', 'station', "TEXT NOT NULL DEFAULT 'NYP'")
+    if column_types(cursor, 'train_events')['time'] != 'INTEGER':
+        conn.commit()
+        retype_train_events_time(conn)
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS train_events_by_train
+        ON train_events (train_number, observed_at, event, day, schedule_time, status, track)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS train_events_track_by_day
+        ON train_events (day, observed_at, train_number, schedule_time, destination, track, event)
+        WHERE event IN ('new', 'track') AND track != ''
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS train_events_track_usage
+        ON train_events (track, day, observed_at, train_number, event)
+        WHERE event IN ('new', 'track') AND track != ''
+    ''')
+
+    # One row per train per day, rolled up from train_events by `maintain`
+    # before the detail of old days is pruned
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS train_days (
+            station TEXT NOT NULL,
+            day TEXT NOT NULL,
+            train_number TEXT NOT NULL,
+            schedule_time TEXT NOT NULL,
+            train_name TEXT,
+            destination TEXT,
+            final_status TEXT,
+            final_track TEXT,
+            -- The last status giving the train's delay, e.g. "Now 9:30PM", which
+            -- a final status such as "Boarding" no longer does
+            delay_status TEXT,
+            first_seen INTEGER,
+            last_seen INTEGER,
+            track_posted_at INTEGER,
+            events INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (station, day, train_number, schedule_time)
+        ) WITHOUT ROWID
+    ''')
+    add_missing_column(cursor, 'train_days', 'delay_status', 'TEXT')
+
+    # Track prediction summaries, maintained incrementally by query.TrackStats
+    # as tracks are posted rather than recomputed from the history. They are
+    # derived data, so summaries from before the station column was added are
+    # dropped and can be recomputed with `scrape.py query --rebuild`.
+    for table in ('track_stats', 'track_lead_stats'):
+        if table_columns(cursor, table) and 'station' not in table_columns(cursor, table):
+            logger.warning("Dropping %s to add the station column, run `query --rebuild` to recompute it", table)
+            cursor.execute(f'DROP TABLE {table}')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_stats (
+            station TEXT,
             train_number TEXT,
             train_name TEXT,
             destination TEXT,
-            status TEXT,
             track TEXT,
-            PRIMARY KEY (day, time, train_number)
-        )
+            assignments INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (station, train_number, train_name, destination, track)
+        ) WITHOUT ROWID
     ''')
-    
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_lead_stats (
+            station TEXT,
+            train_number TEXT,
+            train_name TEXT,
+            destination TEXT,
+            lead_bucket INTEGER,
+            samples INTEGER NOT NULL DEFAULT 0,
+            lead_seconds_total INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (station, train_number, train_name, destination, lead_bucket)
+        ) WITHOUT ROWID
+    ''')
+    # The last track counted for each scheduled train, whatever the day the
+    # board was scraped on, so the same posting seen again after the day rolls
+    # over or the snapshot is lost on a restart is not counted twice
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_postings (
+            station TEXT,
+            train_number TEXT,
+            train_name TEXT,
+            destination TEXT,
+            schedule_time TEXT,
+            track TEXT,
+            observed_at INTEGER,
+            PRIMARY KEY (station, train_number, train_name, destination, schedule_time)
+        ) WITHOUT ROWID
+    ''')
+    for table in ('track_stats', 'track_lead_stats'):
+        for column in ('train_name', 'destination'):
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_by_{column} ON {table} (station, {column})')
+
     conn.commit()
     conn.close()
 
-def upsert_train_data(trains: List[Train], db_path: str):
-    """Upsert train data into the database."""
-    conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
-    cursor = conn.cursor()
-    
-    for train in trains:
-        # Convert day string to DATE and time string to DATETIME
-        # Assuming day is in YYYY-MM-DD format and time is in HH:MM format
+def migrate_database(db_path: str, batch_rows: int = 100000, vacuum: bool = False):
+    """Migrate a database to the current schema, optionally vacuuming it to shrink the file."""
+    size = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    init_database(db_path, batch_rows)
+    if vacuum:
+        conn = sqlite3.connect(db_path)
         try:
-            day_date = datetime.datetime.strptime(train.day, "%Y-%m-%d").date()
-            # Combine day and time to create a full datetime
-            time_datetime = datetime.datetime.strptime(f"{train.day} {train.time}", "%Y-%m-%d %H:%M %p")
-        except ValueError as e:
-            print(f"Warning: Could not parse date/time for train {train.train_number}: {e}")
-            continue
-            
-        cursor.execute('''
-            INSERT OR REPLACE INTO train_track_locations 
-            (day, time, schedule_time, train_number, train_name, destination, status, track)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            day_date,
-            time_datetime,
-            train.time,
-            train.train_number,
-            train.train_name,
-            train.destination,
-            train.status,
-            train.track
-        ))
-    
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+    logger.info("Database %s is at schema version %d, %d bytes (was %d)",
+                db_path, SCHEMA_VERSION, os.path.getsize(db_path), size)
+
+@dataclass
+class WriteStats:
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    skipped: int = 0
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_day_time(day: str, time: str):
+    """
+    Convert a board day and scheduled time to the DATE and DATETIME stored in the database.
+
+    Boards repeat the same handful of times on every poll, so results are memoized.
+    Times were once read with %H, which ignores %p: PM trains were stored
+    twelve hours early and collided with the AM train of the same clock time.
+    Rows of archived days are repaired by `scrape.py reparse`.
+    """
+    # Assuming day is in YYYY-MM-DD format and time is a 12-hour "H:MM AM/PM"
+    day_date = datetime.datetime.strptime(day, "%Y-%m-%d").date()
+    # Combine day and time to create a full datetime
+    time_datetime = datetime.datetime.strptime(f"{day} {time}", "%Y-%m-%d %I:%M %p")
+    return day_date, time_datetime
+
+
+def scheduled_datetime(day: str, time: str) -> datetime.datetime:
+    """Return the timezone-aware scheduled datetime of a board row, e.g. ("2024-01-15", "6:45 PM")."""
+    naive = datetime.datetime.strptime(f"{day} {time}", "%Y-%m-%d %I:%M %p")
+    return timezone().localize(naive)
+
+
+class LookupIds:
+    """Cached name to id mapping of one v2 lookup table, adding names the first time they are seen."""
+
+    def __init__(self, conn: sqlite3.Connection, table: str):
+        self.conn = conn
+        self.table = table
+        self.reload()
+
+    def reload(self):
+        self.ids: Dict[str, int] = dict(self.conn.execute(f'SELECT name, id FROM {self.table}'))
+
+    def id(self, name: Optional[str]) -> Optional[int]:
+        if name is None:
+            return None
+        found = self.ids.get(name)
+        if found is None:
+            self.conn.execute(f'INSERT OR IGNORE INTO {self.table} (name) VALUES (?)', (name,))
+            found = self.conn.execute(f'SELECT id FROM {self.table} WHERE name = ?', (name,)).fetchone()[0]
+            self.ids[name] = found
+        return found
+
+
+@contextlib.contextmanager
+def transaction(conn: sqlite3.Connection):
+    """
+    Run a block in one transaction on conn, committed when it ends.
+
+    A block opened while conn is already in a transaction joins it and
+    leaves the commit to the outer block, so a scrape's history, events,
+    summaries and board snapshot can be written in a single commit.
+    """
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute('BEGIN')
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
     conn.commit()
-    conn.close()
 
 
-def parse(data):
+class TrainWriter:
+    """
+    Writes scraped trains to train_locations over a persistent connection.
+
+    Each write() runs in a single transaction: new rows are added with one
+    executemany INSERT OR IGNORE, then changed rows are updated in place with
+    one executemany UPDATE. Unlike INSERT OR REPLACE, rows whose values did
+    not change are left untouched, so their index entries are not rewritten.
+    Names are stored as lookup table ids, which are cached for the life of
+    the writer.
+    """
+
+    # Numbered parameters let both statements share the same row tuple:
+    # (day, station, time, train_number, schedule_time_id, train_name_id, destination_id, status_id, track)
+    INSERT_SQL = '''
+        INSERT OR IGNORE INTO train_locations
+        (day, station, time, train_number, schedule_time_id, train_name_id, destination_id, status_id, track)
+        VALUES (?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9)
+    '''
+    UPDATE_SQL = '''
+        UPDATE train_locations
+        SET schedule_time_id = ?5, train_name_id = ?6, destination_id = ?7, status_id = ?8, track = ?9
+        WHERE day = ?1 AND station = ?2 AND time = ?3 AND train_number = ?4
+          AND (schedule_time_id IS NOT ?5 OR train_name_id IS NOT ?6 OR destination_id IS NOT ?7
+               OR status_id IS NOT ?8 OR track IS NOT ?9)
+    '''
+
+    def __init__(self, db_path: str, conn: Optional[sqlite3.Connection] = None, cache_size_kib: int = 8192):
+        self.db_path = db_path
+        self.owns_conn = conn is None
+        self.conn = conn if conn is not None else sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        if self.owns_conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            # Negative cache_size is in KiB rather than pages
+            self.conn.execute(f'PRAGMA cache_size=-{int(cache_size_kib)}')
+        self.lookups = {column: LookupIds(self.conn, table) for column, table in LOOKUP_TABLES.items()}
+        # Run once the outermost transaction commits, dropped if it rolls back
+        self.commit_hooks: List[Callable[[], None]] = []
+
+    @staticmethod
+    def to_rows(trains: List[Train], station: str = DEFAULT_STATION.code):
+        """
+        Convert trains to row tuples, returning the rows and the number skipped.
+
+        Rows have the train_track_locations view's columns:
+        (day, time, schedule_time, train_number, train_name, destination, status, track, station)
+        """
+        rows = []
+        skipped = 0
+        for train in trains:
+            day, schedule_time, train_number, train_name, destination, status, track = train.astuple()
+            try:
+                day_date, time_datetime = parse_day_time(day, schedule_time)
+            except ValueError as e:
+                logger.warning("Could not parse date/time for train %s: %s", train_number, e)
+                skipped += 1
+                continue
+            rows.append((day_date, time_datetime, schedule_time, train_number, train_name, destination, status,
+                         track, station))
+        return rows, skipped
+
+    def encode(self, rows) -> List[tuple]:
+        """Convert to_rows() rows to train_locations rows, adding any names not seen before."""
+        lookups = self.lookups
+        return [
+            (day.isoformat(), station, int(time_datetime.timestamp()), train_number,
+             lookups['schedule_time'].id(schedule_time), lookups['train_name'].id(train_name),
+             lookups['destination'].id(destination), lookups['status'].id(status), track)
+            for day, time_datetime, schedule_time, train_number, train_name, destination, status, track, station
+            in rows
+        ]
+
+    @contextlib.contextmanager
+    def transaction(self):
+        outermost = not self.conn.in_transaction
+        try:
+            with transaction(self.conn):
+                yield self.conn
+        except BaseException:
+            if outermost:
+                self.commit_hooks.clear()
+            # Ids added in a rolled back transaction no longer exist
+            for lookup in self.lookups.values():
+                lookup.reload()
+            raise
+        if outermost:
+            hooks, self.commit_hooks = self.commit_hooks, []
+            for hook in hooks:
+                hook()
+
+    def after_commit(self, hook: Callable[[], None]):
+        """
+        Call hook once the transaction open on the writer commits, or now if none is.
+
+        Hooks are dropped when the transaction rolls back, so anything they
+        announce is only seen once it is in the database.
+        """
+        if self.conn.in_transaction:
+            self.commit_hooks.append(hook)
+        else:
+            hook()
+
+    def write(self, trains: List[Train], station: str = DEFAULT_STATION.code) -> WriteStats:
+        """Write one scrape's trains from a station in a single transaction."""
+        rows, skipped = self.to_rows(trains, station)
+        stats = WriteStats(skipped=skipped)
+        if not rows:
+            return stats
+        with self.transaction() as conn:
+            encoded = self.encode(rows)
+            stats.inserted = conn.executemany(self.INSERT_SQL, encoded).rowcount
+            stats.updated = conn.executemany(self.UPDATE_SQL, encoded).rowcount
+        stats.unchanged = max(len(rows) - stats.inserted - stats.updated, 0)
+        return stats
+
+    def insert_rows(self, rows) -> int:
+        """Insert to_rows() rows in one transaction, leaving existing rows alone."""
+        with self.transaction() as conn:
+            return conn.executemany(self.INSERT_SQL, self.encode(rows)).rowcount
+
+    def replace_trains(self, rows) -> int:
+        """
+        Replace the rows of each train in rows on its day, in one transaction.
+
+        A train is its station, day and number, so a row of the same train
+        stored at another time is deleted, while other trains of the day are
+        left as they are.
+        """
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM train_locations WHERE station = ? AND day = ? AND train_number = ?',
+                             {(station, day.isoformat(), train_number)
+                              for day, _, _, train_number, *_, station in rows})
+            return conn.executemany(self.INSERT_SQL, self.encode(rows)).rowcount
+
+    def close(self):
+        if self.owns_conn:
+            self.conn.close()
+
+
+def upsert_train_data(trains: List[Train], db_path: str, conn: Optional[sqlite3.Connection] = None) -> WriteStats:
+    """
+    Upsert train data into the database.
+
+    If an open connection is passed it is reused and left open, otherwise a
+    connection to db_path is opened and closed for this call.
+    """
+    writer = TrainWriter(db_path, conn=conn)
+    try:
+        return writer.write(trains)
+    finally:
+        writer.close()
+
+
+def parse(data, day: Optional[str] = None):
+    from bs4 import BeautifulSoup
     soup = BeautifulSoup(data, 'html.parser')
     trains = []
+    # Every row of a board belongs to the same scrape, so the day is looked up once
+    if day is None:
+        day = current_day()
     
     # Find all train header rows
     header_rows = soup.find_all('tr', class_='amtrak-header-row')
 
     if not header_rows:
-        print(f"No header rows found: {soup=}")
+        logger.debug("No header rows found in %d characters of markup", len(data))
     
     for header_row in header_rows:
         # Extract time from the first td
@@ -177,7 +742,7 @@ def parse(data):
         
         # Create Train object and add to list
         train = Train(
-            day=datetime.datetime.now(TIMEZONE).strftime("%Y-%m-%d"),
+            day=day,
             time=time,
             train_number=train_number,
             train_name=train_name,
@@ -185,28 +750,279 @@ def parse(data):
             status=status,
             track=track
         )
-        print(f"Found train: {train=}")
+        logger.debug("Found train: %s", train)
         trains.append(train)
     
     return trains
 
 
-def scrape():
-    r = primp.get('https://moynihantrainhall.nyc/transportation/', headers={'Referer': 'https://moynihantrainhall.nyc/'})
-    if r.status_code != 200:
-        raise Exception(f"Failed to scrape: {r.status_code}: {r.text}")
-    
-    soup = BeautifulSoup(r.text, 'html.parser')
-    
+# Maps the span/td classes used on the board to the Train field they hold
+HEADER_FIELD_CLASSES = {'train-number': 'train_number', 'train-name': 'train_name'}
+DESTINATION_FIELD_CLASSES = {
+    'pill-destination': 'destination',
+    'pill-status': 'status',
+    'track-cell': 'track',
+}
+
+
+class StreamingBoardParser(HTMLParser):
+    """
+    Event-driven board parser which makes a single pass over the page.
+
+    Rows are collected per target element id (e.g. amtrak-departures-target).
+    When no target ids are given, every row in the document is collected under
+    the None key, which lets it stand in for parse() on a bare table fragment.
+    """
+
+    def __init__(self, target_ids=None):
+        super().__init__(convert_charrefs=True)
+        self.target_ids = set(target_ids) if target_ids else None
+        self.rows = {target_id: [] for target_id in (self.target_ids or [None])}
+        # Target currently being read, with the tag and nesting depth used to find its end
+        self._target = None if self.target_ids else [None, None, 0]
+        self._row_kind = None
+        self._row = None
+        self._td_index = -1
+        self._field = None
+        # Tag of the element holding the current field and its nesting depth, as for the target
+        self._field_tag = None
+        self._field_depth = 0
+        self._chunks = []
+
+    def handle_starttag(self, tag, attrs):
+        if self._target is None:
+            if self.target_ids:
+                element_id = dict(attrs).get('id')
+                if element_id in self.target_ids:
+                    self._target = [element_id, tag, 1]
+            return
+        if tag == self._target[1]:
+            self._target[2] += 1
+        if tag == self._field_tag:
+            self._field_depth += 1
+
+        classes = (dict(attrs).get('class') or '').split()
+        if tag == 'tr':
+            self._end_field()
+            if 'amtrak-header-row' in classes:
+                self._row_kind = 'header'
+                self._row = {'time': '', 'train_number': '', 'train_name': '',
+                             'destination': '', 'status': '', 'track': ''}
+                self.rows[self._target[0]].append(self._row)
+            elif 'amtrak-destination' in classes:
+                # Destination rows belong to the most recent header row
+                rows = self.rows[self._target[0]]
+                self._row_kind = 'destination' if rows and not rows[-1].get('_has_destination') else None
+                if self._row_kind:
+                    rows[-1]['_has_destination'] = True
+            else:
+                self._row_kind = None
+            self._td_index = -1
+        elif self._row_kind == 'header':
+            if tag == 'td':
+                self._td_index += 1
+                if self._td_index == 0:
+                    self._start_field('time', tag)
+            elif self._td_index == 1 and self._field is None:
+                field = next((HEADER_FIELD_CLASSES[c] for c in classes if c in HEADER_FIELD_CLASSES), None)
+                if field:
+                    self._start_field(field, tag)
+        elif self._row_kind == 'destination' and self._field is None:
+            field = next((DESTINATION_FIELD_CLASSES[c] for c in classes if c in DESTINATION_FIELD_CLASSES), None)
+            if field:
+                self._start_field(field, tag)
+
+    def handle_endtag(self, tag):
+        if self._target is None:
+            return
+        if tag == self._field_tag:
+            self._field_depth -= 1
+            if self._field_depth == 0:
+                self._end_field()
+        elif tag == 'tr':
+            self._end_field()
+            self._row_kind = None
+        if tag == self._target[1] and self.target_ids:
+            self._target[2] -= 1
+            if self._target[2] == 0:
+                self._end_field()
+                self._row_kind = None
+                self._target = None
+
+    def handle_data(self, data):
+        if self._field is not None:
+            chunk = data.strip()
+            if chunk:
+                self._chunks.append(chunk)
+
+    def _start_field(self, field, tag):
+        self._field = field
+        self._field_tag = tag
+        self._field_depth = 1
+        self._chunks = []
+
+    def _end_field(self):
+        if self._field is not None and self._row is not None:
+            self._row[self._field] = ''.join(self._chunks)
+        self._field = None
+        self._field_tag = None
+        self._field_depth = 0
+        self._chunks = []
+
+    def trains(self, target_id=None, day=None) -> List[Train]:
+        """Return the Train records collected for the given target id."""
+        if day is None:
+            day = current_day()
+        return [
+            Train(
+                day=day,
+                time=row['time'],
+                train_number=row['train_number'],
+                train_name=row['train_name'],
+                destination=row['destination'],
+                status=row['status'],
+                track=row['track'],
+            )
+            for row in self.rows.get(target_id, [])
+        ]
+
+
+def parse_stream(data, day: Optional[str] = None) -> List[Train]:
+    """Parse a board table fragment with the streaming parser."""
+    parser = StreamingBoardParser()
+    parser.feed(data)
+    parser.close()
+    return parser.trains(day=day)
+
+
+def parse_board_stream(page: str, day: Optional[str] = None) -> ScheduleBoard:
+    """Parse both boards out of a full transportation page in a single pass."""
+    parser = StreamingBoardParser(target_ids=(DEPARTURES_TARGET_ID, ARRIVALS_TARGET_ID))
+    parser.feed(page)
+    parser.close()
+    if day is None:
+        day = current_day()
+    return ScheduleBoard(
+        departures=parser.trains(DEPARTURES_TARGET_ID, day=day),
+        arrivals=parser.trains(ARRIVALS_TARGET_ID, day=day),
+    )
+
+
+def parse_board_bs4(page: str) -> ScheduleBoard:
+    """Parse both boards out of a full transportation page with BeautifulSoup."""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(page, 'html.parser')
+    day = current_day()
+
     # Find the tables and convert to string for parsing
-    departures_table = soup.find(id='amtrak-departures-target')
-    arrivals_table = soup.find(id='amtrak-arrivals-target')
-    
+    departures_table = soup.find(id=DEPARTURES_TARGET_ID)
+    arrivals_table = soup.find(id=ARRIVALS_TARGET_ID)
+
     return ScheduleBoard(
-        departures=parse(str(departures_table) if departures_table else ""),
-        arrivals=parse(str(arrivals_table) if arrivals_table else ""),
+        departures=parse(str(departures_table) if departures_table else "", day),
+        arrivals=parse(str(arrivals_table) if arrivals_table else "", day),
     )
 
+
+PARSERS = {
+    'bs4': parse_board_bs4,
+    'stream': parse_board_stream,
+}
+
+
+FRAGMENT_PARSERS = {
+    'bs4': parse,
+    'stream': parse_stream,
+}
+
+# Comments and script/style bodies are matched whole so the tags inside them are skipped
+TOKEN_RE = re.compile(
+    r'<!--.*?(?:-->|\Z)'
+    r'|<(script|style)\b[^>]*>.*?(?:</\1\s*>|\Z)'
+    r'|<(/?)([a-zA-Z][a-zA-Z0-9]*)\b([^>]*?)(/?)>',
+    re.DOTALL | re.IGNORECASE,
+)
+
+
+def extract_fragment(page: str, element_id: str) -> str:
+    """
+    Return the raw markup of the element with the given id, or "" if absent.
+
+    This is a tag-balancing scan rather than a full parse, so it is cheap
+    enough to run before deciding whether the board needs parsing at all.
+    Tags inside comments and script or style elements are ignored.
+    """
+    id_re = re.compile(r'\sid\s*=\s*["\']%s["\']' % re.escape(element_id))
+    start = tag = None
+    depth = 0
+    for token in TOKEN_RE.finditer(page):
+        name = token.group(3)
+        if name is None or token.group(5):
+            continue
+        name = name.lower()
+        if start is None:
+            if not token.group(2) and id_re.search(token.group(4)):
+                start, tag, depth = token.start(), name, 1
+            continue
+        if name == tag:
+            depth += -1 if token.group(2) else 1
+            if depth == 0:
+                return page[start:token.end()]
+    return page[start:] if start is not None else ""
+
+
+def extract_target_fragments(page: str, station: Station = DEFAULT_STATION) -> Tuple[str, str]:
+    """Return the raw departures and arrivals target markup from a station's page."""
+    return extract_fragment(page, station.departures_target_id), extract_fragment(page, station.arrivals_target_id)
+
+
+def parse_fragments(departures_html: str, arrivals_html: str, parser: str = 'bs4') -> ScheduleBoard:
+    """Parse already extracted departures and arrivals markup."""
+    return parse_fragments_timed(departures_html, arrivals_html, parser)[0]
+
+
+def parse_fragments_timed(departures_html: str, arrivals_html: str,
+                          parser: str = 'bs4') -> Tuple[ScheduleBoard, Dict[str, float]]:
+    """
+    Parse already extracted departures and arrivals markup, also returning the
+    seconds spent on each as parse_departures and parse_arrivals.
+
+    The timings are returned rather than recorded so they survive parsing in
+    a worker process.
+    """
+    parse_fragment = FRAGMENT_PARSERS[parser]
+    day = current_day()
+    start = time.perf_counter()
+    departures = parse_fragment(departures_html, day)
+    parsed_departures = time.perf_counter()
+    arrivals = parse_fragment(arrivals_html, day)
+    timings = {
+        'parse_departures': parsed_departures - start,
+        'parse_arrivals': time.perf_counter() - parsed_departures,
+    }
+    return ScheduleBoard(departures=departures, arrivals=arrivals), timings
+
+
+def fetch_page(client=None, station: Station = DEFAULT_STATION) -> str:
+    """
+    Fetch a station's board page, by default the Moynihan transportation page.
+
+    A primp.Client can be passed to reuse its connection pool across scrapes.
+    """
+    if client is None:
+        import primp
+        client = primp
+    get = client.get
+    r = get(station.url, headers={'Referer': station.referer})
+    if r.status_code != 200:
+        raise Exception(f"Failed to scrape: {r.status_code}: {r.text}")
+    return r.text
+
+
+def scrape(parser: str = 'bs4', client=None):
+    """Fetch the transportation page and parse both boards."""
+    return PARSERS[parser](fetch_page(client))
+
 def find_trains_with_tracks(schedule_board: ScheduleBoard):
     """Find all trains that have track information."""
     trains = []
@@ -218,23 +1034,224 @@ def find_trains_with_tracks(schedule_board: ScheduleBoard):
     return trains
 
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Scrape Amtrak train data from Moynihan Train Hall')
     parser.add_argument('--db', default='train_data.sqlite3', help='Path to SQLite database file')
-    args = parser.parse_args()
-    
-    # Initialize database
+    parser.add_argument('--parser', default='bs4', choices=sorted(PARSERS), help='Board parser engine to use')
+    parser.add_argument('--daemon', action='store_true', help='Keep running and scrape on a fixed interval')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between scrapes in daemon mode')
+    parser.add_argument('--jitter', type=float, default=0, help='Maximum random offset in seconds applied to each scrape in daemon mode')
+    parser.add_argument('--adaptive', action='store_true', help='In daemon mode, poll faster while tracks are due to be posted and back off otherwise')
+    parser.add_argument('--min-interval', type=float, default=15, help='Seconds between scrapes while tracks are due, with --adaptive')
+    parser.add_argument('--max-interval', type=float, default=600, help='Most seconds between scrapes when nothing is due, with --adaptive')
+    parser.add_argument('--lead-minutes', type=float, default=20, help='Minutes before a train is expected that its track may be posted, with --adaptive')
+    parser.add_argument('--cache-size', type=int, default=8192, help='SQLite page cache size in KiB for the database writer')
+    parser.add_argument('--stations', help='JSON station registry to scrape instead of only Moynihan')
+    parser.add_argument('--parse-workers', type=int, help='Processes used to parse changed boards (default: one per station, up to the CPU count)')
+    parser.add_argument('--min-host-interval', type=float, default=1.0, help='Minimum seconds between requests to the same host')
+    parser.add_argument('--timeout', type=float, default=10, help='HTTP request timeout in seconds')
+    parser.add_argument('--http-cache', help='Directory to keep page bodies and ETag/Last-Modified in for conditional requests')
+    parser.add_argument('--archive', help='SQLite file to archive the raw board markup of every fetch in, for `reparse`')
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='Minimum level of log messages')
+    parser.add_argument('--log-format', default='text', choices=['text', 'json'], help='Log as plain text or one JSON object per line')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this port in daemon mode')
+    parser.add_argument('--feed-port', type=int, help='Push track and status changes as Server-Sent Events on this port in daemon mode')
+    parser.add_argument('--shards', help='Directory to write train history to as one SQLite file per period, see shards.py')
+    parser.add_argument('--shard-period', default='month', choices=['month', 'week'], help='Period covered by each history shard')
+    parser.add_argument('--stats-file', help='Write JSON stage timings and counters to this file after every scrape in daemon mode')
+    subparsers = parser.add_subparsers(dest='command', help='Run a tool instead of scraping')
+
+    query_parser = subparsers.add_parser('query', help='Show track statistics for a train, train name or destination')
+    query_parser.add_argument('--db', default=argparse.SUPPRESS, help='Path to SQLite database file')
+    query_parser.add_argument('--train-number', help='Train number, e.g. 241')
+    query_parser.add_argument('--train-name', help='Train name, e.g. "Empire Service"')
+    query_parser.add_argument('--destination', help='Destination, e.g. "Albany-Rensselaer, NY"')
+    query_parser.add_argument('--station', default=DEFAULT_STATION.code, help='Station code, e.g. NYP')
+    query_parser.add_argument('--rebuild', action='store_true', help='Recompute the summary tables from the event log first')
+
+    reparse_parser = subparsers.add_parser('reparse', help='Rebuild train_track_locations from the raw page archive')
+    reparse_parser.add_argument('--db', default=argparse.SUPPRESS, help='Path to SQLite database file')
+    reparse_parser.add_argument('--archive', default=argparse.SUPPRESS, help='Archive written by scraping with --archive')
+    reparse_parser.add_argument('--parser', default=argparse.SUPPRESS, choices=sorted(PARSERS), help='Board parser engine to use')
+    reparse_parser.add_argument('--workers', type=int, help='Parser processes (default: one per CPU)')
+    reparse_parser.add_argument('--since', help='First day to rebuild, e.g. 2024-01-15')
+    reparse_parser.add_argument('--until', help='Last day to rebuild, e.g. 2024-02-15')
+    reparse_parser.add_argument('--station', help='Only rebuild this station code')
+
+    simulate_parser = subparsers.add_parser('simulate', help='Replay archived boards to compare fixed and adaptive polling')
+    simulate_parser.add_argument('--archive', default=argparse.SUPPRESS, help='Archive written by scraping with --archive')
+    simulate_parser.add_argument('--parser', default=argparse.SUPPRESS, choices=sorted(PARSERS), help='Board parser engine to use')
+    simulate_parser.add_argument('--interval', type=float, default=argparse.SUPPRESS, help='Seconds between scrapes of the fixed schedule')
+    simulate_parser.add_argument('--min-interval', type=float, default=argparse.SUPPRESS, help='Seconds between scrapes while tracks are due')
+    simulate_parser.add_argument('--max-interval', type=float, default=argparse.SUPPRESS, help='Most seconds between scrapes when nothing is due')
+    simulate_parser.add_argument('--lead-minutes', type=float, default=argparse.SUPPRESS, help='Minutes before a train is expected that its track may be posted')
+    simulate_parser.add_argument('--since', help='First day to replay, e.g. 2024-01-15')
+    simulate_parser.add_argument('--until', help='Last day to replay, e.g. 2024-02-15')
+    simulate_parser.add_argument('--station', default=DEFAULT_STATION.code, help='Station code, e.g. NYP')
+
+    export_parser = subparsers.add_parser('export', help='Export finished days of train history to partitioned Parquet or Arrow files')
+    export_parser.add_argument('--db', default=argparse.SUPPRESS, help='Path to SQLite database file')
+    export_parser.add_argument('--out', required=True, help='Directory to write the station=CODE/day=YYYY-MM-DD partitions to')
+    export_parser.add_argument('--format', default='parquet', choices=['parquet', 'arrow'], help='Parquet or Arrow IPC files')
+    export_parser.add_argument('--full', action='store_true', help='Rewrite every day rather than only days not exported yet')
+    export_parser.add_argument('--include-today', action='store_true', help="Also export today's unfinished day, again on the next run")
+    export_parser.add_argument('--chunk-rows', type=int, default=50000, help='Rows read from SQLite per batch')
+    export_parser.add_argument('--station', help='Only export this station code')
+
+    analytics_parser = subparsers.add_parser('analytics', help='Report delay percentiles, day of week effects and rolling delays')
+    analytics_parser.add_argument('--db', default=argparse.SUPPRESS, help='Path to SQLite database file')
+    analytics_parser.add_argument('--month', help='Month to report on, e.g. 2024-01 (default: the current month)')
+    analytics_parser.add_argument('--since', help='First day to report on, instead of --month')
+    analytics_parser.add_argument('--until', help='Last day to report on, instead of --month')
+    analytics_parser.add_argument('--source', default='events', choices=['events', 'locations'], help='Read every status from the event log, or only the last one from the train history')
+    analytics_parser.add_argument('--by', default='train', choices=['train', 'route'], help='Group delays by train number or by route (train name)')
+    analytics_parser.add_argument('--window', type=int, default=7, help='Days in the rolling average')
+    analytics_parser.add_argument('--station', default=DEFAULT_STATION.code, help='Station code, e.g. NYP')
+
+    maintain_parser = subparsers.add_parser('maintain', help='Roll up and prune old history, then vacuum and analyze in short slices')
+    maintain_parser.add_argument('--db', default=argparse.SUPPRESS, help='Path to SQLite database file')
+    maintain_parser.add_argument('--keep-days', type=int, default=30, help='Days of train_events detail to keep, older days are rolled up into train_days')
+    maintain_parser.add_argument('--keep-history-days', type=int, help='Also delete train history older than this many days (default: keep it all)')
+    maintain_parser.add_argument('--budget', type=float, default=60, help='Seconds to spend vacuuming and analyzing')
+    maintain_parser.add_argument('--slice', type=float, default=0.1, help='Seconds each vacuum transaction aims to hold the write lock for')
+    maintain_parser.add_argument('--full-vacuum', action='store_true', help='Rewrite the whole file once to enable incremental vacuuming, blocking writers')
+
+    shards_parser = subparsers.add_parser('shards', help='List the history shards of --shards, or freeze finished ones')
+    shards_parser.add_argument('--freeze', action='store_true', help='Compact finished shards and make them read-only')
+    shards_parser.add_argument('--grace-days', type=int, default=7, help='Days after a shard ends before it is frozen')
+
+    migrate_parser = subparsers.add_parser('migrate', help='Convert train_track_locations to the v2 schema in batches')
+    migrate_parser.add_argument('--db', default=argparse.SUPPRESS, help='Path to SQLite database file')
+    migrate_parser.add_argument('--batch-rows', type=int, default=100000, help='Rows copied per transaction')
+    migrate_parser.add_argument('--vacuum', action='store_true', help='Rebuild the file afterwards to give the space of the old table back')
+
+    args = parser.parse_args(argv)
+
+    from metrics import configure_logging
+    configure_logging(args.log_level, args.log_format)
+
+    if args.command == 'migrate':
+        migrate_database(args.db, args.batch_rows, args.vacuum)
+        return
+
+    if args.command == 'simulate':
+        from scheduler import run_simulation
+        if args.archive is None:
+            simulate_parser.error('--archive is required')
+        run_simulation(args.archive, args.interval, args.min_interval, args.max_interval, station=args.station,
+                       since_day=args.since, until_day=args.until, parser=args.parser, lead_minutes=args.lead_minutes)
+        return
+
+    if args.command == 'shards':
+        from shards import ShardSet, list_shards
+        if args.shards is None:
+            shards_parser.error('--shards is required')
+        if args.freeze:
+            shard_set = ShardSet(args.shards)
+            try:
+                frozen = shard_set.freeze_finished(current_day(), args.grace_days)
+            finally:
+                shard_set.close()
+            logger.info("Froze %d history shards", len(frozen))
+        list_shards(args.shards)
+        return
+
+    # The remaining commands read or write the database, creating or migrating it first
     init_database(args.db)
-    
-    # Scrape data
-    schedule_board = scrape()
-    
-    # Find trains with tracks
-    trains_with_tracks = find_trains_with_tracks(schedule_board)
 
-    print(f'{trains_with_tracks=}')
-    
-    # Upsert data into database
-    upsert_train_data(trains_with_tracks, args.db)
-    
-    print(f"Successfully stored {len(trains_with_tracks)} trains with track information in database: {args.db}")
\ No newline at end of file
+    if args.command == 'query':
+        from query import run_query
+        if args.train_number is None and args.train_name is None and args.destination is None:
+            query_parser.error('one of --train-number, --train-name or --destination is required')
+        run_query(args.db, train_number=args.train_number, train_name=args.train_name,
+                  destination=args.destination, station=args.station, rebuild=args.rebuild)
+        return
+
+    if args.command == 'reparse':
+        from archive import reparse
+        if args.archive is None:
+            reparse_parser.error('--archive is required')
+        stats = reparse(args.archive, args.db, parser=args.parser, workers=args.workers,
+                        since_day=args.since, until_day=args.until, station=args.station,
+                        shard_dir=args.shards, shard_period=args.shard_period)
+        logger.info("Rebuilt %d rows for %d station days from %d boards in %d fetches (%d skipped)",
+                    stats.rows, stats.days, stats.boards, stats.fetches, stats.skipped)
+        return
+
+    if args.command == 'analytics':
+        from analytics import month_range, run_report
+        since_day, until_day = month_range(args.month or current_day()[:7])
+        run_report(args.db, args.since or since_day, args.until or until_day, source=args.source, by=args.by,
+                   station=args.station, window_days=args.window, shard_dir=args.shards)
+        return
+
+    if args.command == 'maintain':
+        from maintenance import run_maintenance
+        stats = run_maintenance(args.db, full_vacuum=args.full_vacuum, keep_days=args.keep_days,
+                                keep_history_days=args.keep_history_days, budget_seconds=args.budget,
+                                slice_seconds=args.slice, shard_dir=args.shards)
+        logger.info("Rolled up %d trains over %d station days (%d events deleted), pruned %d history rows, "
+                    "vacuumed %d pages, analyzed %d tables%s",
+                    stats.rolled_up_trains, stats.rolled_up_days, stats.pruned_events, stats.pruned_rows,
+                    stats.vacuumed_pages, stats.analyzed_tables, ", out of time" if stats.out_of_time else "")
+        return
+
+    if args.command == 'export':
+        from export import export
+        stats = export(args.db, args.out, file_format=args.format, incremental=not args.full,
+                       include_today=args.include_today, chunk_rows=args.chunk_rows, station=args.station,
+                       shard_dir=args.shards)
+        logger.info("Exported %d rows in %d station days to %s (%d already exported)",
+                    stats.rows, stats.days, args.out, stats.skipped_days)
+        return
+
+    from archive import FragmentArchive
+    from http_cache import HttpCache
+    from shards import open_writer
+    from stations import MultiStationPoller, load_stations, log_results
+    stations = load_stations(args.stations) if args.stations else [DEFAULT_STATION]
+
+    if args.daemon:
+        from poller import run_daemon
+        from scheduler import AdaptiveScheduler
+        if not 0 <= args.jitter < args.interval:
+            parser.error(f"--jitter must be at least 0 and less than --interval: {args.jitter}")
+        scheduler = None
+        if args.adaptive:
+            try:
+                scheduler = AdaptiveScheduler(args.interval, args.min_interval, args.max_interval,
+                                              lead_minutes=args.lead_minutes)
+            except ValueError as e:
+                parser.error(str(e))
+        run_daemon(args.db, interval=args.interval, jitter=args.jitter, parser=args.parser,
+                   cache_size_kib=args.cache_size, stations=stations, parse_workers=args.parse_workers,
+                   min_host_interval=args.min_host_interval, timeout=args.timeout, http_cache_dir=args.http_cache,
+                   metrics_port=args.metrics_port, stats_file=args.stats_file, archive_path=args.archive,
+                   feed_port=args.feed_port, shard_dir=args.shards, shard_period=args.shard_period,
+                   scheduler=scheduler)
+        return
+
+    writer = open_writer(args.db, args.shards, args.shard_period, cache_size_kib=args.cache_size)
+    archive = FragmentArchive(args.archive) if args.archive else None
+    station_poller = MultiStationPoller(stations, writer, parser=args.parser, parse_workers=args.parse_workers,
+                                        min_host_interval=args.min_host_interval, timeout=args.timeout,
+                                        http_cache=HttpCache(args.http_cache) if args.http_cache else None,
+                                        archive=archive)
+    try:
+        # Scrape data, skipping the parse and write for boards that are unchanged
+        results = station_poller.poll()
+    finally:
+        station_poller.close()
+        writer.close()
+        if archive is not None:
+            archive.close()
+
+    log_results(results, args.db)
+    failures = [result for result in results.values() if isinstance(result, Exception)]
+    if failures:
+        raise failures[0]
+
+if __name__ == "__main__":
+    # Let the subcommand modules importing scrape share this module instead of running it a second time
+    sys.modules.setdefault('scrape', sys.modules[__name__])
+    main()
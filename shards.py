@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+"""
+Train history split into one SQLite file per month or week.
+
+With --shards DIR, the rows TrainWriter would write to train_locations go
+to DIR/history-2024-01.sqlite3 (or history-2024-W03.sqlite3 for weekly
+shards) instead. The main database keeps everything else: board state,
+events and track summaries. The writer only has the current shard open, so
+its page cache and B-trees stay the size of one period however long the
+scraper has been running.
+
+DIR/manifest.sqlite3 records which days each shard covers and whether it
+is read-only. Readers use it to open only the shards overlapping a range of
+days:
+
+    ShardSet.connect()  ATTACHes the shards to one connection behind a
+                        train_track_locations view, for queries across a
+                        few shards (SQLite attaches at most 10 databases)
+    ShardSet.query()    runs a query on each shard in turn, for ranges of
+                        any length
+
+open_reader() returns a ShardSet, or a HistoryReader of the main database
+with the same query(), so tools such as `export` read either one.
+
+Once a period is over, `scrape.py --shards DIR shards --freeze` vacuums its
+shard, switches it out of WAL mode and marks it read-only, in the manifest
+and on disk. Frozen shards are opened as immutable, so readers skip locking,
+and memory-mapped.
+"""
+
+import datetime
+import logging
+import os
+import sqlite3
+import stat
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import quote
+
+from scrape import (
+    SCHEMA_VERSION, TRAIN_TRACK_LOCATIONS_VIEW_SQL, DEFAULT_STATION, Train, TrainWriter, WriteStats,
+    create_v2_tables,
+)
+
+logger = logging.getLogger(__name__)
+
+PERIODS = ['month', 'week']
+
+MANIFEST_FILE = 'manifest.sqlite3'
+
+# Mapped size of each frozen shard opened for reading
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+
+@dataclass
+class Shard:
+    key: str
+    first_day: str
+    last_day: str
+    path: str
+    read_only: bool = False
+
+
+def shard_key(day: str, period: str = 'month') -> str:
+    """Return the key of the shard holding a day, e.g. 2024-01 or 2024-W03."""
+    date = datetime.date.fromisoformat(day)
+    if period == 'week':
+        year, week, _ = date.isocalendar()
+        return f'{year}-W{week:02d}'
+    return f'{date.year}-{date.month:02d}'
+
+
+def shard_range(key: str) -> tuple:
+    """Return the first and last day of a shard key."""
+    if '-W' in key:
+        year, week = key.split('-W')
+        first = datetime.date.fromisocalendar(int(year), int(week), 1)
+        return first.isoformat(), (first + datetime.timedelta(days=6)).isoformat()
+    first = datetime.date.fromisoformat(f'{key}-01')
+    following = (first.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+    return first.isoformat(), (following - datetime.timedelta(days=1)).isoformat()
+
+
+def init_shard(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor = conn.cursor()
+        create_v2_tables(cursor)
+        cursor.execute(TRAIN_TRACK_LOCATIONS_VIEW_SQL)
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def shard_uri(shard: Shard) -> str:
+    # Nothing writes to a frozen shard, so readers can skip locking it altogether
+    options = 'mode=ro&immutable=1' if shard.read_only else 'mode=ro'
+    return f'file:{quote(os.path.abspath(shard.path))}?{options}'
+
+
+class ShardSet:
+    """The shard files of a directory and the manifest indexing them."""
+
+    def __init__(self, shard_dir: str, period: Optional[str] = None, check_same_thread: bool = True):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.manifest = sqlite3.connect(os.path.join(shard_dir, MANIFEST_FILE), timeout=30,
+                                        check_same_thread=check_same_thread)
+        with self.manifest:
+            self.manifest.execute('''
+                CREATE TABLE IF NOT EXISTS shards (
+                    key TEXT PRIMARY KEY,
+                    first_day TEXT NOT NULL,
+                    last_day TEXT NOT NULL,
+                    file TEXT NOT NULL,
+                    read_only INTEGER NOT NULL DEFAULT 0,
+                    created_at INTEGER NOT NULL
+                )
+            ''')
+            self.manifest.execute('CREATE INDEX IF NOT EXISTS shards_by_day ON shards (first_day, last_day)')
+            self.manifest.execute('CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)')
+            if period is not None:
+                self.manifest.execute("INSERT OR IGNORE INTO settings VALUES ('period', ?)", (period,))
+        row = self.manifest.execute("SELECT value FROM settings WHERE name = 'period'").fetchone()
+        self.period = row[0] if row else 'month'
+        if period is not None and period != self.period:
+            raise ValueError(f"{shard_dir} holds {self.period} shards, not {period} shards")
+
+    def _shard(self, row) -> Shard:
+        key, first_day, last_day, file, read_only = row
+        return Shard(key, first_day, last_day, os.path.join(self.shard_dir, file), bool(read_only))
+
+    def get(self, key: str) -> Optional[Shard]:
+        row = self.manifest.execute('SELECT key, first_day, last_day, file, read_only FROM shards WHERE key = ?',
+                                    (key,)).fetchone()
+        return self._shard(row) if row else None
+
+    def shards(self, since_day: str = '0000-01-01', until_day: str = '9999-12-31') -> List[Shard]:
+        """Return the shards with any day between since_day and until_day, oldest first."""
+        rows = self.manifest.execute('''
+            SELECT key, first_day, last_day, file, read_only FROM shards
+            WHERE last_day >= ? AND first_day <= ?
+            ORDER BY first_day
+        ''', (since_day, until_day)).fetchall()
+        return [self._shard(row) for row in rows]
+
+    def create(self, key: str) -> Shard:
+        """Return the shard for key, creating its file and manifest entry if needed."""
+        shard = self.get(key)
+        if shard is not None:
+            return shard
+        first_day, last_day = shard_range(key)
+        file = f'history-{key}.sqlite3'
+        init_shard(os.path.join(self.shard_dir, file))
+        with self.manifest:
+            self.manifest.execute('INSERT OR IGNORE INTO shards VALUES (?, ?, ?, ?, 0, ?)',
+                                  (key, first_day, last_day, file, int(time.time())))
+        logger.info("Created history shard %s for %s to %s", file, first_day, last_day)
+        return self.get(key)
+
+    def freeze(self, key: str):
+        """Compact a shard and make it read-only, in the manifest and on disk."""
+        shard = self.get(key)
+        if shard is None or shard.read_only:
+            return
+        conn = sqlite3.connect(shard.path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            # Readers of a read-only file cannot create the -wal and -shm files WAL needs
+            conn.execute('PRAGMA journal_mode = DELETE')
+            conn.execute('VACUUM')
+            conn.execute('ANALYZE')
+        finally:
+            conn.close()
+        mode = os.stat(shard.path).st_mode
+        os.chmod(shard.path, mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+        with self.manifest:
+            self.manifest.execute('UPDATE shards SET read_only = 1 WHERE key = ?', (key,))
+        logger.info("Froze history shard %s", os.path.basename(shard.path))
+
+    def freeze_finished(self, today: str, grace_days: int = 7) -> List[str]:
+        """Freeze every shard whose last day is more than grace_days before today, returning their keys."""
+        cutoff = (datetime.date.fromisoformat(today) - datetime.timedelta(days=grace_days)).isoformat()
+        keys = [row[0] for row in self.manifest.execute(
+            'SELECT key FROM shards WHERE read_only = 0 AND last_day < ? ORDER BY first_day', (cutoff,))]
+        for key in keys:
+            self.freeze(key)
+        return keys
+
+    def remove(self, key: str) -> int:
+        """Delete a shard's file and manifest entry, returning how many rows it held."""
+        shard = self.get(key)
+        if shard is None:
+            return 0
+        conn = sqlite3.connect(shard_uri(shard), uri=True)
+        try:
+            rows = conn.execute('SELECT COUNT(*) FROM train_locations').fetchone()[0]
+        finally:
+            conn.close()
+        with self.manifest:
+            self.manifest.execute('DELETE FROM shards WHERE key = ?', (key,))
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(shard.path + suffix):
+                os.remove(shard.path + suffix)
+        logger.info("Removed history shard %s", os.path.basename(shard.path))
+        return rows
+
+    def connect(self, since_day: str = '0000-01-01', until_day: str = '9999-12-31',
+                mmap_size: int = DEFAULT_MMAP_SIZE) -> sqlite3.Connection:
+        """
+        Return a connection to the shards covering a range of days, read through a train_track_locations view.
+
+        Raises ValueError if the range covers more shards than SQLite can attach.
+        """
+        shards = self.shards(since_day, until_day)
+        conn = sqlite3.connect(':memory:', uri=True)
+        limit = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(shards) > limit:
+            conn.close()
+            raise ValueError(f"{since_day} to {until_day} covers {len(shards)} shards, but only {limit} can be "
+                             f"attached at once, use ShardSet.query() instead")
+        selects = []
+        for index, shard in enumerate(shards):
+            conn.execute('ATTACH DATABASE ? AS ?', (shard_uri(shard), f'shard_{index}'))
+            if shard.read_only:
+                conn.execute(f'PRAGMA shard_{index}.mmap_size = {int(mmap_size)}')
+            selects.append(f'SELECT * FROM shard_{index}.train_track_locations')
+        if not selects:
+            # An empty view with the same columns
+            selects.append('SELECT NULL AS day, NULL AS time, NULL AS schedule_time, NULL AS train_number, '
+                           'NULL AS train_name, NULL AS destination, NULL AS status, NULL AS track, '
+                           'NULL AS station WHERE 0')
+        conn.execute(f'CREATE TEMP VIEW train_track_locations AS {" UNION ALL ".join(selects)}')
+        return conn
+
+    def query(self, sql: str, params=(), since_day: str = '0000-01-01', until_day: str = '9999-12-31',
+              newest_first: bool = False, mmap_size: int = DEFAULT_MMAP_SIZE) -> Iterator[tuple]:
+        """
+        Run sql against each shard covering a range of days, yielding its rows shard by shard.
+
+        The query reads train_track_locations as in an unsharded database.
+        Shards are visited oldest first, or newest first, so a query ordered
+        by day gives rows in day order across shards and the caller can stop
+        once it has enough.
+        """
+        shards = self.shards(since_day, until_day)
+        for shard in (reversed(shards) if newest_first else shards):
+            conn = sqlite3.connect(shard_uri(shard), uri=True)
+            try:
+                if shard.read_only:
+                    conn.execute(f'PRAGMA mmap_size = {int(mmap_size)}')
+                yield from conn.execute(sql, params)
+            finally:
+                conn.close()
+
+    def close(self):
+        self.manifest.close()
+
+
+class ShardedTrainWriter:
+    """
+    Drop-in TrainWriter writing train history to the shard of each train's day.
+
+    conn is the main database, used as before for board state, events and
+    track summaries. Only the shard being written is kept open, so a
+    writer holds one shard at a time outside the first minutes of a period.
+    """
+
+    def __init__(self, db_path: str, shard_dir: str, period: str = 'month', cache_size_kib: int = 8192):
+        self.main = TrainWriter(db_path, cache_size_kib=cache_size_kib)
+        self.conn = self.main.conn
+        self.shard_set = ShardSet(shard_dir, period)
+        self.cache_size_kib = cache_size_kib
+        self.writers: Dict[str, TrainWriter] = {}
+
+    def transaction(self):
+        """
+        Open a transaction on the main database, see TrainWriter.transaction().
+
+        Shards are separate files, so their rows are committed on their own,
+        before it. Writes are upserts, so rows committed to a shard for a
+        board whose main transaction then failed are written again unchanged.
+        """
+        return self.main.transaction()
+
+    def after_commit(self, hook):
+        """Call hook once the main database transaction commits, see TrainWriter.after_commit()."""
+        self.main.after_commit(hook)
+
+    def writer(self, key: str) -> TrainWriter:
+        if key not in self.writers:
+            shard = self.shard_set.create(key)
+            if shard.read_only:
+                raise ValueError(f"History shard {key} is read-only")
+            self.writers[key] = TrainWriter(shard.path, cache_size_kib=self.cache_size_kib)
+        return self.writers[key]
+
+    def write(self, trains: List[Train], station: str = DEFAULT_STATION.code) -> WriteStats:
+        """Write one scrape's trains, in one transaction per shard they fall in."""
+        by_shard: Dict[str, List[Train]] = {}
+        stats = WriteStats()
+        for train in trains:
+            try:
+                key = shard_key(train.day, self.shard_set.period)
+            except ValueError as e:
+                logger.warning("Could not parse day for train %s: %s", train.train_number, e)
+                key = None
+            by_shard.setdefault(key, []).append(train)
+        # Keys sort in day order, so writers of periods before the newest one written are done with.
+        # A batch without trains, or only trains of an earlier period, closes nothing.
+        current = max((key for key in by_shard if key is not None), default=None)
+        for key in [key for key in self.writers if current is not None and key < current]:
+            self.writers.pop(key).close()
+        for key, shard_trains in by_shard.items():
+            if key is None:
+                stats.skipped += len(shard_trains)
+                continue
+            written = self.writer(key).write(shard_trains, station)
+            stats.inserted += written.inserted
+            stats.updated += written.updated
+            stats.unchanged += written.unchanged
+            stats.skipped += written.skipped
+        return stats
+
+    def replace_trains(self, rows) -> int:
+        """Replace the rows of each train in rows, see TrainWriter.replace_trains(), in one transaction per shard."""
+        rows_by_shard: Dict[str, list] = {}
+        for row in rows:
+            rows_by_shard.setdefault(shard_key(row[0].isoformat(), self.shard_set.period), []).append(row)
+        return sum(self.writer(key).replace_trains(shard_rows) for key, shard_rows in sorted(rows_by_shard.items()))
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        self.shard_set.close()
+        self.main.close()
+
+
+def open_writer(db_path: str, shard_dir: Optional[str] = None, period: str = 'month', cache_size_kib: int = 8192):
+    """Return a ShardedTrainWriter if shard_dir is set, otherwise a plain TrainWriter."""
+    if shard_dir:
+        return ShardedTrainWriter(db_path, shard_dir, period, cache_size_kib)
+    return TrainWriter(db_path, cache_size_kib=cache_size_kib)
+
+
+class HistoryReader:
+    """Read-only queries of the main database's train history, with the interface of ShardSet.query()."""
+
+    def __init__(self, db_path: str):
+        self.conn = sqlite3.connect(f'file:{quote(os.path.abspath(db_path))}?mode=ro', uri=True)
+
+    def query(self, sql: str, params=(), since_day: str = '0000-01-01', until_day: str = '9999-12-31',
+              newest_first: bool = False) -> Iterator[tuple]:
+        # The range only selects shards, the query itself filters the days
+        yield from self.conn.execute(sql, params)
+
+    def close(self):
+        self.conn.close()
+
+
+def open_reader(db_path: str, shard_dir: Optional[str] = None):
+    """Return a ShardSet if shard_dir is set, otherwise a HistoryReader of the main database."""
+    if shard_dir:
+        return ShardSet(shard_dir)
+    return HistoryReader(db_path)
+
+
+def list_shards(shard_dir: str):
+    """Print every shard with its days, row count and size."""
+    shard_set = ShardSet(shard_dir)
+    try:
+        for shard in shard_set.shards():
+            conn = sqlite3.connect(shard_uri(shard), uri=True)
+            try:
+                rows = conn.execute('SELECT COUNT(*) FROM train_locations').fetchone()[0]
+            finally:
+                conn.close()
+            print(f"{shard.key}: {shard.first_day} to {shard.last_day}, {rows} rows, "
+                  f"{os.path.getsize(shard.path) // 1024} KiB{', read-only' if shard.read_only else ''}")
+    finally:
+        shard_set.close()
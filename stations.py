@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Concurrent scraping of several station boards.
+
+Any page using the same amtrak-header-row markup as the Moynihan board can be
+registered as a Station. MultiStationPoller fetches every station at once
+from a thread pool over one pooled primp client, spacing out requests to the
+same host, parses the boards that changed in a process pool and writes the
+results tagged with each station's code. With an HttpCache, fetches are
+conditional and a 304 skips the station without parsing. With a
+FragmentArchive, the raw board markup of every fetch is archived so it can
+be re-parsed later, and with a ChangeFeed the changes are pushed to
+subscribers. Each poll's stage timings and counts are added to a
+metrics.Metrics registry.
+
+The station registry is a JSON list, e.g.
+
+    [
+        {"code": "NYP", "url": "https://moynihantrainhall.nyc/transportation/",
+         "referer": "https://moynihantrainhall.nyc/"},
+        {"code": "PHL", "url": "https://example.com/board/",
+         "departures_target_id": "departures", "arrivals_target_id": "arrivals"}
+    ]
+"""
+
+import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import primp
+
+from archive import FragmentArchive
+from changes import ChangeDetector, PollResult, board_fingerprint, store_board
+from events import EventLog
+from feed import ChangeFeed, FeedSink
+from http_cache import FetchResult, HttpCache
+from metrics import METRICS, Metrics, format_timings
+from query import TrackStats
+from scrape import Station, TrainWriter, current_day, extract_target_fragments, fetch_page, parse_fragments_timed
+
+logger = logging.getLogger(__name__)
+
+
+def load_stations(path: str) -> List[Station]:
+    """Load a station registry file."""
+    with open(path) as f:
+        entries = json.load(f)
+    stations = []
+    for entry in entries:
+        entry.setdefault('referer', entry['url'])
+        stations.append(Station(**entry))
+    codes = [station.code for station in stations]
+    if len(set(codes)) != len(codes):
+        raise ValueError(f"Duplicate station codes in {path}: {codes}")
+    return stations
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host by at least min_interval seconds."""
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self.next_slot: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host: str):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.min_interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class MultiStationPoller:
+    def __init__(self, stations: List[Station], writer: TrainWriter, parser: str = 'bs4', client=None,
+                 parse_workers: Optional[int] = None, min_host_interval: float = 1.0, timeout: float = 10,
+                 http_cache: Optional[HttpCache] = None, metrics: Metrics = METRICS,
+                 archive: Optional[FragmentArchive] = None, feed: Optional[ChangeFeed] = None):
+        self.stations = stations
+        self.writer = writer
+        self.parser = parser
+        self.client = client if client is not None else primp.Client(timeout=timeout)
+        self.rate_limiter = HostRateLimiter(min_host_interval)
+        self.http_cache = http_cache
+        self.metrics = metrics
+        self.archive = archive
+        self.detectors = {station.code: ChangeDetector(writer.conn, station.code) for station in stations}
+        self.sinks = {
+            station.code: [EventLog(writer.conn, station.code), TrackStats(writer.conn, station.code)]
+            for station in stations
+        }
+        if feed is not None:
+            for station in stations:
+                self.sinks[station.code].append(FeedSink(feed, writer, station.code))
+        self.fetch_pool = ThreadPoolExecutor(max_workers=len(stations), thread_name_prefix='fetch')
+        self.parse_workers = parse_workers if parse_workers is not None else min(len(stations), multiprocessing.cpu_count())
+        self.parse_pool = None
+
+    def fetch(self, station: Station) -> FetchResult:
+        self.rate_limiter.wait(urlparse(station.url).hostname or '')
+        # Timed after the rate limiter so a queued request is not counted as a slow one
+        start = time.perf_counter()
+        fetched_at = int(time.time())
+        if self.http_cache is not None:
+            fetched = self.http_cache.fetch(self.client, station)
+        else:
+            page = fetch_page(self.client, station)
+            fetched = FetchResult(page=page, bytes_transferred=len(page.encode()))
+        fetched.seconds = time.perf_counter() - start
+        fetched.fetched_at = fetched_at
+        return fetched
+
+    def parse_all(self, pending: Dict[str, tuple]):
+        """
+        Parse the changed boards, in the process pool when there is more than one.
+
+        Returns (ScheduleBoard, parse timings) for each station.
+        """
+        if len(pending) < 2 or self.parse_workers < 2:
+            return {
+                code: parse_fragments_timed(dep, arr, parser=self.parser) for code, (_, dep, arr) in pending.items()
+            }
+        if self.parse_pool is None:
+            # spawn rather than fork, since the fetch threads are already running
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                                  mp_context=multiprocessing.get_context('spawn'))
+        futures = {
+            code: self.parse_pool.submit(parse_fragments_timed, dep, arr, self.parser)
+            for code, (_, dep, arr) in pending.items()
+        }
+        return {code: future.result() for code, future in futures.items()}
+
+    def poll(self, day: Optional[str] = None) -> Dict[str, object]:
+        """
+        Poll every station once.
+
+        Returns each station's PollResult, or the exception raised while
+        fetching it so one failing station does not block the others.
+        """
+        if day is None:
+            day = current_day()
+        poll_start = time.perf_counter()
+        futures = {station.code: self.fetch_pool.submit(self.fetch, station) for station in self.stations}
+
+        results: Dict[str, object] = {}
+        pending = {}
+        fetches = {}
+        timings = {}
+        for station in self.stations:
+            try:
+                fetched = futures[station.code].result()
+            except Exception as e:
+                results[station.code] = e
+                continue
+            # A 304 is re-checked against the cached body rather than skipped
+            # outright, since the fingerprint also changes with the service day
+            start = time.perf_counter()
+            departures_html, arrivals_html = extract_target_fragments(fetched.page, station)
+            fingerprint = board_fingerprint(day, departures_html, arrivals_html)
+            timings[station.code] = {'fetch': fetched.seconds, 'extract': time.perf_counter() - start}
+            if self.archive is not None:
+                start = time.perf_counter()
+                self.archive.record(station.code, day, departures_html, arrivals_html, fetched.fetched_at)
+                timings[station.code]['archive'] = time.perf_counter() - start
+            if self.detectors[station.code].board_changed(fingerprint):
+                pending[station.code] = (fingerprint, departures_html, arrivals_html)
+            else:
+                results[station.code] = PollResult(changed=False, not_modified=fetched.not_modified)
+            fetches[station.code] = fetched
+
+        # SQLite has a single writer, so boards are stored one after another
+        for code, (schedule_board, parse_timings) in self.parse_all(pending).items():
+            results[code] = store_board(self.detectors[code], self.writer, pending[code][0], schedule_board,
+                                        self.sinks[code])
+            timings[code].update(parse_timings)
+        for code, fetched in fetches.items():
+            results[code].bytes_transferred = fetched.bytes_transferred
+            results[code].timings = {**timings[code], **results[code].timings}
+
+        for code, result in results.items():
+            self.metrics.record_poll(code, result)
+        self.metrics.observe('poll', time.perf_counter() - poll_start)
+        return {station.code: results[station.code] for station in self.stations}
+
+    def close(self):
+        self.fetch_pool.shutdown()
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+            self.parse_pool = None
+
+
+def log_results(results: Dict[str, object], db_path: str, include_unchanged: bool = True):
+    """
+    Log each station's poll result.
+
+    Unchanged boards are logged at DEBUG unless include_unchanged is set. The
+    stage timings are passed as structured fields as well as in the message.
+    """
+    for code, result in results.items():
+        if isinstance(result, Exception):
+            logger.error("%s: %s", code, result, extra={'station': code})
+            continue
+        fields = {'station': code, 'bytes_transferred': result.bytes_transferred, 'timings': result.timings}
+        unchanged_level = logging.INFO if include_unchanged else logging.DEBUG
+        if result.not_modified:
+            logger.log(unchanged_level, "%s: page not modified since last scrape (%s)",
+                       code, format_timings(result.timings), extra=fields)
+        elif not result.changed:
+            logger.log(unchanged_level, "%s: board unchanged since last scrape (%d bytes; %s)",
+                       code, result.bytes_transferred, format_timings(result.timings), extra=fields)
+        else:
+            logger.info("%s: stored %d train changes in database: %s (%s, %d bytes; %s)",
+                        code, len(result.changes), db_path, result.stats, result.bytes_transferred,
+                        format_timings(result.timings),
+                        extra={**fields, 'changes': len(result.changes), 'trains': result.trains})
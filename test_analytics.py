@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import io
+import sqlite3
+import unittest
+from contextlib import redirect_stdout
+
+from analytics import (
+    PHASE_SECOND_BOARDING, StatusInfo, delay_percentiles, load_history, month_range, parse_status,
+    rolling_delay, weekday_effects,
+)
+from changes import diff_trains
+from events import EventLog
+from maintenance import run_maintenance
+from scrape import TrainWriter, main
+from test_scrape import DatabaseTestCase, make_train
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TestParseStatus(unittest.TestCase):
+    def test_status_vocabulary(self):
+        self.assertEqual(parse_status("On Time", "9:20 PM"), StatusInfo(0))
+        self.assertEqual(parse_status("Now 9:25PM", "9:20 PM"), StatusInfo(5))
+        self.assertEqual(parse_status("Now 12:10AM", "11:50 PM"), StatusInfo(20))
+        self.assertEqual(parse_status("Second Boarding", "9:20 PM"),
+                         StatusInfo(None, boarding_phase=PHASE_SECOND_BOARDING))
+        self.assertEqual(parse_status("Cancelled", "9:20 PM"), StatusInfo(None, cancelled=True))
+        self.assertEqual(parse_status("Delayed", "9:20 PM"), StatusInfo(None))
+        self.assertEqual(parse_status(None, None), StatusInfo(None))
+
+    def test_month_range(self):
+        self.assertEqual(month_range("2024-02"), ("2024-02-01", "2024-02-29"))
+        self.assertEqual(month_range("2023-12"), ("2023-12-01", "2023-12-31"))
+
+
+@unittest.skipUnless(numpy, "numpy is not installed")
+class TestDelayAnalytics(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = sqlite3.connect(self.db_path)
+        # Monday, Tuesday and the following Monday
+        boards = [
+            [[make_train("2024-01-15")], [make_train("2024-01-15", status="Now 9:30PM")],
+             [make_train("2024-01-15", status="Boarding")]],
+            [[make_train("2024-01-16", status="Now 9:50PM")], [make_train("2024-01-16", status="Second Boarding")]],
+            [[make_train("2024-01-22")], [make_train("2024-01-22", status="Cancelled")]],
+        ]
+        event_log = EventLog(self.conn)
+        writer = TrainWriter(self.db_path)
+        observed_at = 1000
+        for day in boards:
+            previous = []
+            for board in day:
+                event_log.record(diff_trains(previous, board), observed_at=observed_at)
+                writer.write(board)
+                previous = board
+                observed_at += 1
+        # Another route that ran on time on both days it ran
+        writer.write([make_train("2024-01-15", "241", name="Empire Service", time="6:45 PM"),
+                      make_train("2024-01-16", "241", name="Empire Service", time="6:45 PM")])
+        writer.close()
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_events_keep_last_delay_of_each_run(self):
+        history = load_history(self.conn, 'events')
+        self.assertEqual(len(history), 3)
+        by_day = {str(day): delay for day, delay in zip(history.day, history.delay_minutes.tolist())}
+        self.assertEqual(by_day["2024-01-15"], 10)
+        self.assertEqual(by_day["2024-01-16"], 30)
+        self.assertTrue(numpy.isnan(by_day["2024-01-22"]))
+        self.assertEqual(history.cancelled.tolist().count(True), 1)
+        self.assertEqual(int(history.boarding_phase.max()), PHASE_SECOND_BOARDING)
+
+        [summary] = delay_percentiles(history)
+        self.assertEqual((summary.key, summary.trains, summary.with_delay, summary.cancelled), ("2275", 3, 2, 1))
+        self.assertEqual(summary.mean_minutes, 20)
+        self.assertEqual(summary.on_time_share, 0)
+
+    def test_events_of_rolled_up_days(self):
+        """Test days whose events were pruned by maintain are read from their rollup"""
+        before = load_history(self.conn, 'events')
+        stats = run_maintenance(self.db_path, keep_days=1, today="2024-01-20", pause_seconds=0)
+        self.assertEqual(stats.rolled_up_days, 2)
+        history = load_history(self.conn, 'events')
+        self.assertEqual([str(day) for day in history.day], [str(day) for day in before.day])
+        numpy.testing.assert_array_equal(history.delay_minutes, before.delay_minutes)
+        self.assertEqual(history.cancelled.tolist(), before.cancelled.tolist())
+        self.assertEqual(history.boarding_phase.tolist(), before.boarding_phase.tolist())
+
+    def test_locations_only_keep_last_status(self):
+        history = load_history(self.conn, 'locations', until_day="2024-01-16")
+        summaries = delay_percentiles(history, by='route')
+        self.assertEqual([(summary.key, summary.trains, summary.with_delay) for summary in summaries],
+                         [("Empire Service", 2, 2), ("Acela", 2, 0)])
+        self.assertEqual(summaries[0].p90_minutes, 0)
+
+    def test_weekday_effects_and_rolling_mean(self):
+        history = load_history(self.conn, 'events')
+        effects = weekday_effects(history)
+        self.assertEqual([(effect.weekday, effect.trains, effect.effect_minutes) for effect in effects],
+                         [("Monday", 1, -10), ("Tuesday", 1, 10)])
+        daily = rolling_delay(history, window_days=2)
+        self.assertEqual([(day.day, day.mean_minutes, day.rolling_mean_minutes) for day in daily],
+                         [("2024-01-15", 10, 10), ("2024-01-16", 30, 20)])
+
+    def test_analytics_command(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            main(['--db', self.db_path, '--log-level', 'WARNING', 'analytics', '--month', '2024-01'])
+        self.assertIn("3 trains at NYP from 2024-01-01 to 2024-01-31", output.getvalue())
+        self.assertIn("Train 2275: 0% on time over 2, mean 20.0 min", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
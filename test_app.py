@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import datetime
+import unittest
+from unittest.mock import patch
+
+from app import create_app
+from scrape import DEFAULT_STATION, TrainWriter, current_day
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase
+
+
+class TestApp(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.writer = TrainWriter(self.db_path)
+        self.poller = MultiStationPoller([DEFAULT_STATION], self.writer, parser='stream', client=object(),
+                                         min_host_interval=0)
+        self.app = create_app(self.db_path, check_interval=0)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.app.extensions['response_cache'].close()
+        self.poller.close()
+        self.writer.close()
+
+    def scrape(self, page=SCRAPE_PAGE_HTML):
+        with patch('stations.fetch_page', return_value=page):
+            self.poller.poll(day="2024-01-15")
+
+    def test_board(self):
+        self.assertEqual(self.client.get('/board').status_code, 404)
+        self.scrape()
+        response = self.client.get('/board')
+        self.assertEqual(response.status_code, 200)
+        board = response.get_json()
+        self.assertEqual(board['station'], 'NYP')
+        self.assertEqual([train['train_number'] for train in board['departures']], ['241', '57'])
+        self.assertEqual(len(board['arrivals']), 1)
+
+    def test_train(self):
+        self.scrape()
+        train = self.client.get('/trains/241').get_json()
+        self.assertEqual(train['trains'][0]['board'], 'departures')
+        self.assertEqual(train['trains'][0]['track'], '6')
+        self.assertEqual(self.client.get('/trains/999').status_code, 404)
+        self.assertEqual(self.client.get('/trains/241?station=PHL').status_code, 404)
+
+    def test_history(self):
+        self.scrape()
+        history = self.client.get('/trains/241/history').get_json()
+        self.assertEqual(len(history['history']), 1)
+        self.assertEqual(history['history'][0]['track'], '6')
+        self.assertEqual(history['tracks'], [{'track': '6', 'assignments': 1, 'share': 1.0}])
+        # ?days counts days back from today, not rows
+        later = (datetime.date.fromisoformat(current_day()) + datetime.timedelta(days=5)).isoformat()
+        with patch('app.current_day', return_value=later):
+            self.assertEqual(self.client.get('/trains/241/history?days=5').status_code, 200)
+            self.assertEqual(self.client.get('/trains/241/history?days=4').status_code, 404)
+
+    def test_etag_revalidation(self):
+        """Test an unchanged resource is answered with 304 and a new scrape changes the ETag"""
+        self.scrape()
+        response = self.client.get('/trains/241')
+        etag = response.headers['ETag']
+        response = self.client.get('/trains/241', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.scrape(SCRAPE_PAGE_HTML.replace('>6<', '>9<'))
+        response = self.client.get('/trains/241', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['trains'][0]['track'], '9')
+
+    def test_hot_requests_skip_database(self):
+        """Test cached responses are served without querying until the database changes"""
+        self.scrape()
+        cache = self.app.extensions['response_cache']
+        cache.check_interval = 60
+        self.client.get('/board')
+        with patch('app.board_payload') as render:
+            self.client.get('/board')
+        render.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
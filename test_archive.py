@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import unittest
+from unittest.mock import patch
+
+from archive import FragmentArchive, reparse
+from scrape import DEFAULT_STATION, Train, TrainWriter, extract_target_fragments, main
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase
+
+TRACK_CHANGED_HTML = SCRAPE_PAGE_HTML.replace('>6<', '>9<')
+
+
+class TestFragmentArchive(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive_path = os.path.join(self.tmp.name, 'archive.sqlite3')
+        self.archive = FragmentArchive(self.archive_path)
+
+    def tearDown(self):
+        self.archive.close()
+
+    def record(self, page, day="2024-01-15", fetched_at=1705363200):
+        departures_html, arrivals_html = extract_target_fragments(page)
+        self.archive.record('NYP', day, departures_html, arrivals_html, fetched_at)
+
+    def rows(self):
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return conn.execute(
+                "SELECT day, train_number, track FROM train_track_locations ORDER BY day, train_number"
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def test_identical_fragments_stored_once(self):
+        """Test repeated fetches of the same board add fetch rows but no new fragments"""
+        self.record(SCRAPE_PAGE_HTML, fetched_at=1)
+        self.record(SCRAPE_PAGE_HTML, fetched_at=2)
+        self.record(TRACK_CHANGED_HTML, fetched_at=3)
+        conn = self.archive.conn
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM fetches").fetchone()[0], 3)
+        # The arrivals fragment is the same on all three boards
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM fragments").fetchone()[0], 3)
+
+        fetches = list(self.archive.fetches())
+        self.assertEqual([fetch[0] for fetch in fetches], [1, 2, 3])
+        departures_html, _ = extract_target_fragments(TRACK_CHANGED_HTML)
+        self.assertEqual(self.archive.fragment(fetches[2][3]), departures_html)
+        stored = conn.execute("SELECT LENGTH(data) FROM fragments WHERE hash = ?", (fetches[2][3],)).fetchone()[0]
+        self.assertLess(stored, len(departures_html.encode()))
+
+    def test_reparse_rebuilds_archived_days(self):
+        """Test reparse keeps each train's last track and leaves days missing from the archive alone"""
+        writer = TrainWriter(self.db_path)
+        writer.write([
+            Train("2024-01-14", "6:45 PM", "241", "Empire Service", "Albany-Rensselaer, NY", "On Time", "3"),
+            Train("2024-01-15", "6:45 PM", "241", "Empire Service", "Albany-Rensselaer, NY", "On Time", "1"),
+        ])
+        writer.close()
+        self.record(SCRAPE_PAGE_HTML, fetched_at=1)
+        self.record(TRACK_CHANGED_HTML, fetched_at=2)
+        self.record(TRACK_CHANGED_HTML, fetched_at=3)
+
+        stats = reparse(self.archive_path, self.db_path, workers=1)
+        self.assertEqual((stats.fetches, stats.boards, stats.days, stats.rows), (3, 2, 1, 1))
+        self.assertEqual(self.rows(), [("2024-01-14", "241", "3"), ("2024-01-15", "241", "9")])
+
+    def test_reparse_partly_archived_day(self):
+        """Test reparse replaces the archived trains of a day and keeps those written before archiving began"""
+        writer = TrainWriter(self.db_path)
+        writer.write([
+            Train("2024-01-15", "8:00 AM", "100", "Northeast Regional", "Boston, MA", "Departed", "11"),
+            # Stored twelve hours early by the old %H parsing
+            Train("2024-01-15", "6:45 AM", "241", "Empire Service", "Albany-Rensselaer, NY", "On Time", "1"),
+        ])
+        writer.close()
+        self.record(TRACK_CHANGED_HTML)
+
+        reparse(self.archive_path, self.db_path, workers=1)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            rows = conn.execute(
+                "SELECT train_number, schedule_time, track FROM train_track_locations ORDER BY time"
+            ).fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(rows, [("100", "8:00 AM", "11"), ("241", "6:45 PM", "9")])
+
+    def test_reparse_in_process_pool(self):
+        """Test reparsing across worker processes gives the same rows as reparsing serially"""
+        for offset, page in enumerate([SCRAPE_PAGE_HTML, TRACK_CHANGED_HTML] * 3):
+            self.record(page, day=f"2024-01-{15 + offset // 2}", fetched_at=offset)
+        stats = reparse(self.archive_path, self.db_path, workers=2, chunksize=1)
+        self.assertEqual(stats.rows, 3)
+        self.assertEqual(self.rows(), [
+            ("2024-01-15", "241", "9"), ("2024-01-16", "241", "9"), ("2024-01-17", "241", "9"),
+        ])
+
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_poller_archives_every_fetch(self, mock_fetch_page):
+        writer = TrainWriter(self.db_path)
+        poller = MultiStationPoller([DEFAULT_STATION], writer, client=object(), min_host_interval=0,
+                                    archive=self.archive)
+        try:
+            poller.poll(day="2024-01-15")
+            results = poller.poll(day="2024-01-15")
+        finally:
+            poller.close()
+            writer.close()
+        self.assertFalse(results['NYP'].changed)
+        self.assertIn('archive', results['NYP'].timings)
+        self.assertEqual([(station, day) for _, station, day, _, _ in self.archive.fetches()],
+                         [("NYP", "2024-01-15"), ("NYP", "2024-01-15")])
+
+    def test_reparse_command(self):
+        self.record(TRACK_CHANGED_HTML)
+        main(['--db', self.db_path, '--log-level', 'WARNING', 'reparse', '--archive', self.archive_path,
+              '--workers', '1', '--parser', 'stream'])
+        self.assertEqual(self.rows(), [("2024-01-15", "241", "9")])
+
+
+if __name__ == '__main__':
+    unittest.main()
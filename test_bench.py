@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+import bench
+from scrape import parse_board_stream
+
+
+class TestBench(unittest.TestCase):
+    def test_synthetic_page_parses(self):
+        """Test synthetic pages carry the requested number of rows on both boards"""
+        board = parse_board_stream(bench.synthetic_page(25, filler_kib=1))
+        self.assertEqual(len(board.departures), 25)
+        self.assertEqual(len(board.arrivals), 25)
+        self.assertTrue(all(train.train_number and train.status for train in board.departures))
+
+    def test_import_skips_network_and_parser_dependencies(self):
+        """Test importing scrape leaves primp, bs4 and pytz to the commands that use them"""
+        output = subprocess.run([sys.executable, '-c', 'import scrape, sys; print(sorted(set(sys.modules) & '
+                                 '{"primp", "bs4", "pytz"}))'], cwd=os.path.dirname(bench.SCRAPE_PY),
+                                capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_run_smoke(self):
+        """Test a tiny offline run covers every benchmark and is JSON serializable"""
+        results = bench.run(synthetic_rows=(5,), db_sizes=(0, 50), board_rows=10, repeat=1, filler_kib=1)
+        json.dumps(results)
+
+        pages = {entry['page'] for entry in results['parse']}
+        self.assertIn('sample_transportation.html', pages)
+        self.assertIn('synthetic-5', pages)
+        self.assertEqual({entry['stage'] for entry in results['scrape']}, {'scrape', 'poll_changed', 'poll_unchanged'})
+        inserts = [entry for entry in results['upsert'] if entry['stage'] == 'insert']
+        self.assertEqual([entry['db_rows'] for entry in inserts], [0, 50])
+        self.assertTrue(all(entry['stats']['inserted'] == 10 for entry in inserts))
+        self.assertEqual([entry['command'] for entry in results['startup']], list(bench.STARTUP_COMMANDS))
+        self.assertTrue(all(entry['max_rss_kib'] > 0 for entry in results['startup']))
+
+
+if __name__ == '__main__':
+    unittest.main()
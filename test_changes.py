@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import unittest
+from unittest.mock import patch
+
+from changes import (
+    CHANGE_NEW, CHANGE_REMOVED, CHANGE_STATUS, CHANGE_TRACK,
+    ChangeDetector, board_fingerprint, changed_trains, diff_trains,
+)
+from events import EventLog
+from scrape import (
+    DEFAULT_STATION, TrainWriter, extract_target_fragments, parse_board_bs4, parse_fragments,
+    parse_fragments_timed, scheduled_datetime,
+)
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase, make_train
+
+
+class TestExtractFragments(unittest.TestCase):
+    def test_fragments_parse_like_full_page(self):
+        """Test parsing the extracted fragments matches parsing the full page"""
+        departures_html, arrivals_html = extract_target_fragments(SCRAPE_PAGE_HTML)
+        self.assertTrue(departures_html.startswith('<div id="amtrak-departures-target">'))
+        self.assertTrue(departures_html.endswith('</div>'))
+        expected = parse_board_bs4(SCRAPE_PAGE_HTML)
+        board = parse_fragments(departures_html, arrivals_html, parser='stream')
+        self.assertEqual(board, expected)
+
+    def test_missing_fragment(self):
+        self.assertEqual(extract_target_fragments("<html></html>"), ("", ""))
+
+    def test_decoys_are_skipped(self):
+        """Test data-id attributes and tags in comments or scripts are not taken for the board"""
+        decoys = ('<span data-id="amtrak-departures-target">x</span>'
+                  '<!-- <div id="amtrak-departures-target"> -->'
+                  '<script>document.write(\'<div id="amtrak-departures-target"><div>\')</script>')
+        page = SCRAPE_PAGE_HTML.replace('<body>', '<body>' + decoys, 1)
+        self.assertIn(decoys, page)
+        departures_html, _ = extract_target_fragments(page)
+        self.assertTrue(departures_html.startswith('<div id="amtrak-departures-target">'))
+        self.assertEqual(parse_fragments(departures_html, "", parser='stream').departures,
+                         parse_board_bs4(SCRAPE_PAGE_HTML).departures)
+
+
+class TestDiffTrains(unittest.TestCase):
+    def test_diff_kinds(self):
+        """Test new trains, track assignments, status changes and removals are reported"""
+        previous = [make_train(number="241"), make_train(number="57"), make_train(number="99")]
+        current = [make_train(number="241", track="6", status="Boarding"), make_train(number="57"), make_train(number="132")]
+        changes = diff_trains(previous, current)
+        self.assertEqual(
+            [(change.kind, change.train.train_number) for change in changes],
+            [(CHANGE_TRACK, "241"), (CHANGE_STATUS, "241"), (CHANGE_NEW, "132"), (CHANGE_REMOVED, "99")],
+        )
+        self.assertEqual(changes[0].previous.track, "")
+        self.assertEqual([train.train_number for train in changed_trains(changes)], ["241", "132"])
+
+    def test_midnight_rollover(self):
+        """Test trains re-dated when the scrape day rolls over keep their key and service day"""
+        # 66 is listed under the scrape day, so as the morning before until midnight
+        before = [make_train(number="2275", time="11:50 PM", track="6"), make_train(number="66", time="12:05 AM")]
+        after = [make_train(number="2275", time="11:50 PM", track="6", day="2024-01-16", status="Departed"),
+                 make_train(number="66", time="12:05 AM", day="2024-01-16")]
+        previous_at = scheduled_datetime("2024-01-15", "11:58 PM").timestamp()
+        now = previous_at + 3 * 60
+        changes = diff_trains(before, after, now, previous_at)
+        self.assertEqual([(change.kind, change.train.train_number, change.train.day) for change in changes],
+                         [(CHANGE_STATUS, "2275", "2024-01-15")])
+
+        # A day later the same train is another run
+        changes = diff_trains(before[:1], after[:1], previous_at + 20 * 3600, previous_at)
+        self.assertEqual([change.kind for change in changes], [CHANGE_NEW, CHANGE_REMOVED])
+
+    def test_fingerprint_includes_day(self):
+        self.assertNotEqual(board_fingerprint("2024-01-15", "a", "b"), board_fingerprint("2024-01-16", "a", "b"))
+        self.assertNotEqual(board_fingerprint("2024-01-15", "ab", ""), board_fingerprint("2024-01-15", "a", "b"))
+
+
+class TestPollBoard(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.writer = TrainWriter(self.db_path)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def poll(self, sinks=None):
+        """Poll the board once with a new poller, as a fresh process would"""
+        poller = MultiStationPoller([DEFAULT_STATION], self.writer, parser='stream', client=object(),
+                                    min_host_interval=0)
+        if sinks is not None:
+            poller.sinks[DEFAULT_STATION.code] = sinks
+        try:
+            return poller.poll(day="2024-01-15")[DEFAULT_STATION.code]
+        finally:
+            poller.close()
+
+    @patch('stations.parse_fragments_timed', wraps=parse_fragments_timed)
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_unchanged_board_skips_parse(self, mock_fetch_page, mock_parse):
+        """Test an unchanged board is neither parsed nor written, even after a restart"""
+        result = self.poll()
+        self.assertTrue(result.changed)
+        self.assertEqual([change.kind for change in result.changes], [CHANGE_NEW] * 3)
+        self.assertEqual(result.stats.inserted, 1)
+        self.assertEqual(result.trains, 3)
+        self.assertEqual(sorted(result.timings), sorted([
+            'fetch', 'extract', 'parse_departures', 'parse_arrivals', 'diff', 'filter', 'write', 'record',
+        ]))
+
+        # A new poller picks the fingerprint back up from board_state
+        result = self.poll()
+        self.assertFalse(result.changed)
+        self.assertEqual(mock_parse.call_count, 1)
+        self.assertEqual(list(result.timings), ['fetch', 'extract'])
+
+    @patch('stations.fetch_page')
+    def test_changed_board_writes_diff_only(self, mock_fetch_page):
+        """Test only the changed train is written when the board changes"""
+        mock_fetch_page.return_value = SCRAPE_PAGE_HTML
+        self.poll()
+
+        mock_fetch_page.return_value = SCRAPE_PAGE_HTML.replace("Second Boarding", "Final Call")
+        result = self.poll()
+        self.assertEqual([change.kind for change in result.changes], [CHANGE_STATUS])
+        self.assertEqual(result.stats.updated, 1)
+        self.assertEqual(result.stats.unchanged, 0)
+
+        status = sqlite3.connect(self.db_path).execute("SELECT status FROM train_track_locations").fetchone()[0]
+        self.assertEqual(status, "Final Call")
+
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_failed_sink_rolls_back_the_board(self, mock_fetch_page):
+        """Test a sink failing leaves no history, events or snapshot, so the next poll stores the board once"""
+        event_log = EventLog(self.writer.conn)
+
+        class FailingSink:
+            def record(self, changes, observed_at):
+                raise RuntimeError("disk full")
+
+        with self.assertRaises(RuntimeError):
+            self.poll(sinks=[event_log, FailingSink()])
+        self.assertIsNone(ChangeDetector(self.writer.conn).fingerprint)
+        conn = sqlite3.connect(self.db_path)
+        self.addCleanup(conn.close)
+        for table in ('train_locations', 'train_events', 'board_state'):
+            self.assertEqual(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], 0, table)
+
+        result = self.poll(sinks=[event_log])
+        self.assertEqual(result.stats.inserted, 1)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_events").fetchone()[0], 3)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_track_locations").fetchone()[0], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import datetime
+import sqlite3
+import unittest
+from unittest.mock import patch
+
+from changes import diff_trains
+from events import EventLog, track_assignments, track_usage, train_history
+from scrape import DEFAULT_STATION, TRAIN_EVENTS_SQL, TrainWriter, column_types, init_database
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase, make_train
+
+
+class TestEventLog(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = sqlite3.connect(self.db_path)
+        self.event_log = EventLog(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_transitions_are_appended(self):
+        """Test each status and track transition is kept rather than overwritten"""
+        boards = [
+            [make_train()],
+            [make_train(status="Now 9:25PM")],
+            [make_train(status="Now 9:25PM", track="7")],
+            [make_train(status="Second Boarding", track="7")],
+            [],
+        ]
+        previous = []
+        for observed_at, board in enumerate(boards, start=1000):
+            self.event_log.record(diff_trains(previous, board), observed_at=observed_at)
+            previous = board
+
+        history = train_history(self.conn, "2275")
+        self.assertEqual([(row[0], row[1], row[4], row[5]) for row in history], [
+            (1000, 'new', "On Time", ""),
+            (1001, 'status', "Now 9:25PM", ""),
+            (1002, 'track', "Now 9:25PM", "7"),
+            (1003, 'status', "Second Boarding", "7"),
+            (1004, 'removed', "Second Boarding", "7"),
+        ])
+        self.assertEqual(track_assignments(self.conn, "2024-01-15"), [(1002, "2275", "9:20 PM", "Washington, DC", "7")])
+        self.assertEqual(track_usage(self.conn, "7"), [("2024-01-15", "2275", 1002)])
+        self.assertEqual(track_usage(self.conn, "7", since_day="2024-01-16"), [])
+
+    def test_queries_use_indexes(self):
+        """Test the history queries are answered from the covering indexes"""
+        plans = {
+            'train': "SELECT observed_at, event, day, schedule_time, status, track FROM train_events "
+                     "WHERE train_number = '1' ORDER BY observed_at",
+            'day': "SELECT observed_at, train_number, schedule_time, destination, track FROM train_events "
+                   "WHERE day = '2024-01-15' AND event IN ('new', 'track') AND track != '' ORDER BY observed_at",
+            'track': "SELECT day, train_number, observed_at FROM train_events "
+                     "WHERE track = '7' AND day >= '' AND event IN ('new', 'track') AND track != '' "
+                     "ORDER BY day, observed_at",
+        }
+        for name, sql in plans.items():
+            plan = " ".join(row[-1] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql))
+            self.assertIn("COVERING INDEX", plan, name)
+            self.assertNotIn("TEMP B-TREE", plan, name)
+
+    def test_time_reads_back_with_declared_types(self):
+        """Test event times are stored as epoch seconds that PARSE_DECLTYPES connections read back"""
+        self.event_log.record(diff_trains([], [make_train()]), observed_at=1000)
+        self.conn.commit()
+        conn = sqlite3.connect(self.db_path, detect_types=sqlite3.PARSE_DECLTYPES)
+        self.addCleanup(conn.close)
+        day, event_time = conn.execute("SELECT day, time FROM train_events").fetchone()
+        self.assertEqual(day, datetime.date(2024, 1, 15))
+        self.assertEqual(event_time, int(datetime.datetime(2024, 1, 15, 21, 20).timestamp()))
+
+    def test_datetime_time_column_is_retyped(self):
+        """Test a train_events table with time declared DATETIME is rebuilt with its rows and indexes"""
+        self.event_log.record(diff_trains([], [make_train()]), observed_at=1000)
+        self.conn.execute("ALTER TABLE train_events RENAME TO train_events_new")
+        self.conn.execute(TRAIN_EVENTS_SQL.replace("time INTEGER", "time DATETIME"))
+        self.conn.execute("INSERT INTO train_events SELECT * FROM train_events_new")
+        self.conn.execute("DROP TABLE train_events_new")
+        self.conn.commit()
+
+        with self.assertLogs('scrape', level='WARNING'):
+            init_database(self.db_path)
+        self.assertEqual(column_types(self.conn.cursor(), 'train_events')['time'], 'INTEGER')
+        self.assertEqual(self.conn.execute("SELECT observed_at, train_number FROM train_events").fetchall(),
+                         [(1000, "2275")])
+        indexes = {row[1] for row in self.conn.execute("PRAGMA index_list(train_events)")}
+        self.assertEqual(indexes, {'train_events_by_train', 'train_events_track_by_day', 'train_events_track_usage'})
+
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_poller_records_events(self, mock_fetch_page):
+        """Test MultiStationPoller appends the board diff to the event log"""
+        writer = TrainWriter(self.db_path)
+        poller = MultiStationPoller([DEFAULT_STATION], writer, parser='stream', client=object(), min_host_interval=0)
+        try:
+            poller.poll(day="2024-01-15")
+        finally:
+            poller.close()
+            writer.close()
+        count = self.conn.execute("SELECT COUNT(*) FROM train_events WHERE event = 'new'").fetchone()[0]
+        self.assertEqual(count, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import os
+import unittest
+
+from scrape import TrainWriter, current_day, main
+
+try:
+    import pyarrow
+    import pyarrow.dataset
+except ImportError:
+    pyarrow = None
+
+from export import export
+from test_scrape import DatabaseTestCase, make_train
+
+
+@unittest.skipUnless(pyarrow, "pyarrow is not installed")
+class TestExport(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.out_dir = os.path.join(self.tmp.name, 'export')
+        self.write([make_train("2024-01-14"), make_train("2024-01-15"), make_train("2024-01-15", "57", track="11"),
+                    make_train(current_day())])
+
+    def write(self, trains):
+        writer = TrainWriter(self.db_path)
+        writer.write(trains)
+        writer.close()
+
+    def read(self, file_format='parquet'):
+        dataset = pyarrow.dataset.dataset(self.out_dir, format=file_format, partitioning='hive')
+        return dataset.to_table()
+
+    def test_export_finished_days(self):
+        stats = export(self.db_path, self.out_dir, chunk_rows=1)
+        self.assertEqual((stats.days, stats.rows), (2, 3))
+        self.assertEqual(os.listdir(self.out_dir), ['station=NYP'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.out_dir, 'station=NYP'))),
+                         ['day=2024-01-14', 'day=2024-01-15'])
+
+        table = self.read()
+        rows = sorted(zip(table.column('day').to_pylist(), table.column('train_number').to_pylist(),
+                          table.column('track').to_pylist()))
+        self.assertEqual(rows, [('2024-01-14', '2275', ''), ('2024-01-15', '2275', ''), ('2024-01-15', '57', '11')])
+        self.assertTrue(pyarrow.types.is_dictionary(table.schema.field('destination').type))
+        self.assertTrue(pyarrow.types.is_timestamp(table.schema.field('time').type))
+
+    def test_incremental_export_appends_new_days(self):
+        export(self.db_path, self.out_dir)
+        self.assertEqual(export(self.db_path, self.out_dir).days, 0)
+
+        self.write([make_train("2024-01-16")])
+        stats = export(self.db_path, self.out_dir)
+        self.assertEqual((stats.days, stats.rows, stats.skipped_days), (1, 1, 2))
+        self.assertEqual(self.read().num_rows, 4)
+
+    def test_stations_are_separate_partitions(self):
+        writer = TrainWriter(self.db_path)
+        writer.write([make_train("2024-01-14", number="171")], station='PHL')
+        writer.close()
+        self.assertEqual(export(self.db_path, self.out_dir, station='PHL').rows, 1)
+        # Another station's days are still exported, and a full export of one station leaves the others
+        self.assertEqual(export(self.db_path, self.out_dir, station='NYP').days, 2)
+        self.assertEqual(export(self.db_path, self.out_dir, incremental=False, station='PHL').days, 1)
+        table = self.read()
+        self.assertEqual(sorted(zip(table.column('station').to_pylist(), table.column('train_number').to_pylist())),
+                         [('NYP', '2275'), ('NYP', '2275'), ('NYP', '57'), ('PHL', '171')])
+
+    def test_unfinished_day_is_exported_again(self):
+        self.assertEqual(export(self.db_path, self.out_dir, include_today=True).days, 3)
+        self.write([make_train(current_day(), number="57")])
+        stats = export(self.db_path, self.out_dir, include_today=True)
+        self.assertEqual((stats.days, stats.rows, stats.skipped_days), (1, 2, 2))
+        self.assertEqual(self.read().num_rows, 5)
+
+    def test_arrow_format_and_command(self):
+        main(['--db', self.db_path, '--log-level', 'WARNING', 'export', '--out', self.out_dir,
+              '--format', 'arrow', '--include-today'])
+        self.assertEqual(self.read('arrow').num_rows, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import json
+import unittest
+import urllib.request
+from unittest.mock import patch
+
+from changes import (
+    CHANGE_NEW, CHANGE_OTHER, CHANGE_REMOVED, CHANGE_STATUS, CHANGE_TRACK, ChangeDetector, TrainChange, store_board,
+)
+from feed import (
+    EVENT_STATUS_CHANGED, EVENT_TRACK_ASSIGNED, EVENT_TRAIN_REMOVED, ChangeFeed, DemoPublisher, FeedServer, FeedSink,
+)
+from scrape import DEFAULT_STATION, ScheduleBoard, TrainWriter
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase, make_train
+
+
+class TestChangeFeed(unittest.TestCase):
+    def test_event_types(self):
+        """Test only track postings, status changes and removals are published"""
+        feed = ChangeFeed()
+        subscription = feed.subscribe()
+        events = feed.publish('NYP', [
+            TrainChange(CHANGE_NEW, make_train(track="")),
+            TrainChange(CHANGE_NEW, make_train(number="57", track="6")),
+            TrainChange(CHANGE_TRACK, make_train(track="9"), make_train(track="6")),
+            TrainChange(CHANGE_STATUS, make_train(status="Boarding"), make_train()),
+            TrainChange(CHANGE_OTHER, make_train(), make_train()),
+            TrainChange(CHANGE_REMOVED, make_train(), make_train()),
+        ], observed_at=100)
+        self.assertEqual([event.type for event in events],
+                         [EVENT_TRACK_ASSIGNED, EVENT_TRACK_ASSIGNED, EVENT_STATUS_CHANGED, EVENT_TRAIN_REMOVED])
+        self.assertEqual(events[1].previous['track'], "6")
+        self.assertEqual([subscription.get(timeout=0).id for _ in events], [event.id for event in events])
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_filters(self):
+        feed = ChangeFeed()
+        by_station = feed.subscribe(station='PHL')
+        by_train = feed.subscribe(train_number='57')
+        feed.publish('NYP', [TrainChange(CHANGE_NEW, make_train(number="57", track="6"))], observed_at=100)
+        feed.publish('PHL', [TrainChange(CHANGE_NEW, make_train(track="6"))], observed_at=100)
+        self.assertEqual(by_station.get(timeout=0).station, 'PHL')
+        self.assertIsNone(by_station.get(timeout=0))
+        self.assertEqual(by_train.get(timeout=0).train['train_number'], '57')
+        self.assertIsNone(by_train.get(timeout=0))
+
+    def test_slow_subscriber_is_dropped_and_can_resume(self):
+        """Test a full queue drops the subscriber without blocking, and Last-Event-ID replays the rest"""
+        feed = ChangeFeed(max_queue=2)
+        slow = feed.subscribe()
+        events = feed.publish('NYP', [TrainChange(CHANGE_NEW, make_train(number=str(n), track="6")) for n in range(4)], 100)
+        self.assertTrue(slow.overflowed)
+        self.assertNotIn(slow, feed.subscribers)
+        received = [slow.get(timeout=0).id, slow.get(timeout=0).id]
+        self.assertEqual(received, [events[0].id, events[1].id])
+
+        resumed = feed.subscribe(last_event_id=received[-1])
+        self.assertEqual([resumed.get(timeout=0).id, resumed.get(timeout=0).id], [events[2].id, events[3].id])
+        self.assertFalse(resumed.overflowed)
+
+    def test_demo_publisher(self):
+        feed = ChangeFeed()
+        subscription = feed.subscribe()
+        publisher = DemoPublisher(feed, seed=1)
+        for _ in range(10):
+            publisher.step()
+        self.assertEqual(len(feed.history), 10)
+        self.assertIn(subscription.get(timeout=0).type,
+                      (EVENT_TRACK_ASSIGNED, EVENT_STATUS_CHANGED, EVENT_TRAIN_REMOVED))
+
+
+class TestFeedDelivery(DatabaseTestCase):
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_poller_publishes_changes(self, mock_fetch_page):
+        feed = ChangeFeed()
+        subscription = feed.subscribe()
+        writer = TrainWriter(self.db_path)
+        poller = MultiStationPoller([DEFAULT_STATION], writer, client=object(), min_host_interval=0, feed=feed)
+        try:
+            poller.poll(day="2024-01-15")
+        finally:
+            poller.close()
+            writer.close()
+        event = subscription.get(timeout=0)
+        self.assertEqual((event.type, event.station, event.train['track']), (EVENT_TRACK_ASSIGNED, 'NYP', '6'))
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_rolled_back_board_is_not_published(self):
+        """Test changes are published once the board commits, and not at all if it rolls back"""
+        feed = ChangeFeed()
+        subscription = feed.subscribe()
+        writer = TrainWriter(self.db_path)
+        self.addCleanup(writer.close)
+        detector = ChangeDetector(writer.conn)
+        board = ScheduleBoard(departures=[make_train(track="6")], arrivals=[])
+        published = []
+
+        class FailingSink:
+            def record(self, changes, observed_at):
+                published.append(subscription.get(timeout=0))
+                raise RuntimeError("disk full")
+
+        with self.assertRaises(RuntimeError):
+            store_board(detector, writer, 'a', board, sinks=[FeedSink(feed, writer), FailingSink()])
+        self.assertEqual(published, [None])
+        self.assertIsNone(subscription.get(timeout=0))
+
+        store_board(detector, writer, 'a', board, sinks=[FeedSink(feed, writer)])
+        self.assertEqual(subscription.get(timeout=0).train['track'], '6')
+        self.assertIsNone(subscription.get(timeout=0))
+
+    def test_server_streams_events(self):
+        feed = ChangeFeed()
+        events = feed.publish('NYP', [TrainChange(CHANGE_NEW, make_train(track="6"))], observed_at=100)
+        server = FeedServer(feed, 0, host='127.0.0.1', keepalive=0.1)
+        server.start()
+        try:
+            request = urllib.request.Request(f'http://127.0.0.1:{server.port}/events?train=2275',
+                                             headers={'Last-Event-ID': str(events[0].id - 1)})
+            with urllib.request.urlopen(request, timeout=5) as response:
+                self.assertEqual(response.headers['Content-Type'], 'text/event-stream')
+                lines = [response.readline().decode().rstrip('\n') for _ in range(3)]
+        finally:
+            server.close()
+        self.assertEqual(lines[0], f'id: {events[0].id}')
+        self.assertEqual(lines[1], f'event: {EVENT_TRACK_ASSIGNED}')
+        self.assertEqual(json.loads(lines[2][len('data: '):])['train']['track'], '6')
+
+
+if __name__ == '__main__':
+    unittest.main()
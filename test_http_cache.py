@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from http_cache import HttpCache, response_size
+from scrape import DEFAULT_STATION, TrainWriter, init_database
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML
+
+
+def make_response(status_code=200, text=SCRAPE_PAGE_HTML, headers=None):
+    response = Mock()
+    response.status_code = status_code
+    response.text = text
+    response.content = text.encode()
+    response.headers = headers or {}
+    return response
+
+
+class FakeClient:
+    """Answers with 304 when the request carries the current ETag"""
+
+    def __init__(self, etag='"v1"', headers=None):
+        self.etag = etag
+        self.requests = []
+        self.headers = headers or {}
+
+    def get(self, url, headers):
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == self.etag:
+            return make_response(304, text='')
+        return make_response(headers={'etag': self.etag, 'last-modified': 'Mon, 15 Jan 2024 23:00:00 GMT',
+                                      **self.headers})
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(os.path.join(self.tmp.name, 'cache'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_conditional_request(self):
+        """Test validators are stored and sent back, and a 304 returns the cached body"""
+        client = FakeClient(headers={'content-length': '1234'})
+
+        first = self.cache.fetch(client, DEFAULT_STATION)
+        self.assertFalse(first.not_modified)
+        self.assertEqual(first.bytes_transferred, 1234)
+        self.assertNotIn('If-None-Match', client.requests[0])
+
+        second = self.cache.fetch(client, DEFAULT_STATION)
+        self.assertTrue(second.not_modified)
+        self.assertEqual(second.page, SCRAPE_PAGE_HTML)
+        self.assertEqual(second.bytes_transferred, 0)
+        self.assertEqual(client.requests[1]['If-None-Match'], '"v1"')
+        self.assertEqual(client.requests[1]['If-Modified-Since'], 'Mon, 15 Jan 2024 23:00:00 GMT')
+        self.assertEqual(client.requests[1]['Referer'], DEFAULT_STATION.referer)
+
+        client.etag = '"v2"'
+        third = self.cache.fetch(client, DEFAULT_STATION)
+        self.assertFalse(third.not_modified)
+
+    def test_no_conditional_request_without_body(self):
+        """Test validators are not sent if the cached body has gone missing"""
+        client = FakeClient()
+        self.cache.fetch(client, DEFAULT_STATION)
+        os.unlink(os.path.join(self.cache.cache_dir, 'NYP.html'))
+        self.assertFalse(self.cache.fetch(client, DEFAULT_STATION).not_modified)
+        self.assertNotIn('If-None-Match', client.requests[1])
+
+    def test_http_error(self):
+        client = Mock()
+        client.get.return_value = make_response(503, text="Service Unavailable")
+        with self.assertRaises(Exception) as context:
+            self.cache.fetch(client, DEFAULT_STATION)
+        self.assertIn("Failed to scrape: 503", str(context.exception))
+
+    def test_response_size_without_content_length(self):
+        self.assertEqual(response_size(make_response(text="abc")), 3)
+
+
+class TestConditionalPoll(unittest.TestCase):
+    def test_not_modified_skips_parse(self):
+        """Test a 304 is reported as not modified and nothing is written"""
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'test.sqlite3')
+            init_database(db_path)
+            writer = TrainWriter(db_path)
+            poller = MultiStationPoller([DEFAULT_STATION], writer, client=FakeClient(), min_host_interval=0,
+                                        http_cache=HttpCache(os.path.join(tmp, 'cache')))
+            try:
+                first = poller.poll(day="2024-01-15")['NYP']
+                second = poller.poll(day="2024-01-15")['NYP']
+                # A new service day is still written even though the page is cached
+                third = poller.poll(day="2024-01-16")['NYP']
+            finally:
+                poller.close()
+                writer.close()
+
+        self.assertTrue(first.changed)
+        self.assertGreater(first.bytes_transferred, 0)
+        self.assertFalse(second.changed)
+        self.assertTrue(second.not_modified)
+        self.assertEqual(second.bytes_transferred, 0)
+        self.assertTrue(third.changed)
+
+
+if __name__ == '__main__':
+    unittest.main()
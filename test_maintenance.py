@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import unittest
+
+from changes import diff_trains
+from events import EventLog
+from maintenance import Maintenance, run_maintenance
+from query import TrackStats, track_distribution, track_lead
+from scrape import TrainWriter, init_database, main
+from test_scrape import DatabaseTestCase, make_train
+
+
+class TestMaintenance(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = sqlite3.connect(self.db_path)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def record(self, boards, observed_at):
+        event_log = EventLog(self.conn)
+        track_stats = TrackStats(self.conn)
+        previous = []
+        for board in boards:
+            changes = diff_trains(previous, board)
+            event_log.record(changes, observed_at=observed_at)
+            track_stats.record(changes, observed_at=observed_at)
+            previous = board
+            observed_at += 60
+
+    def maintain(self, **kwargs):
+        maintenance = Maintenance(self.db_path, today="2024-02-20", pause_seconds=0, **kwargs)
+        try:
+            return maintenance.run()
+        finally:
+            maintenance.close()
+
+    def test_rollup_replaces_old_events(self):
+        """Test old days are rolled up into train_days and only their events are deleted"""
+        self.record([
+            [make_train("2024-01-15")],
+            [make_train("2024-01-15", track="7")],
+            [make_train("2024-01-15", status="Boarding", track="9")],
+            [],
+        ], observed_at=1705368000)
+        self.record([[make_train("2024-02-20")], [make_train("2024-02-20", track="3")]], observed_at=1708459200)
+        distribution = track_distribution(self.conn, train_number="2275")
+        lead = track_lead(self.conn, train_number="2275")
+
+        stats = self.maintain(keep_days=30)
+        self.assertEqual((stats.rolled_up_days, stats.rolled_up_trains, stats.pruned_events), (1, 1, 5))
+        self.assertEqual(self.conn.execute("SELECT DISTINCT day FROM train_events").fetchall(), [("2024-02-20",)])
+        self.assertEqual(self.conn.execute('''
+            SELECT day, final_status, final_track, first_seen, last_seen, track_posted_at, events FROM train_days
+        ''').fetchall(), [("2024-01-15", "Boarding", "9", 1705368000, 1705368180, 1705368060, 5)])
+
+        # The summaries can still be rebuilt after the detail is gone
+        TrackStats(self.conn).rebuild()
+        self.assertEqual(track_distribution(self.conn, train_number="2275"), distribution)
+        self.assertEqual(track_lead(self.conn, train_number="2275"), lead)
+
+    def test_prune_history(self):
+        writer = TrainWriter(self.db_path)
+        writer.write([make_train("2024-01-15", track="7"), make_train("2024-02-19", track="7")])
+        writer.close()
+        self.assertEqual(self.maintain(keep_history_days=7).pruned_rows, 1)
+        self.assertEqual(self.conn.execute("SELECT day FROM train_track_locations").fetchall(), [("2024-02-19",)])
+        # Without a history window nothing is deleted
+        self.assertEqual(self.maintain(keep_history_days=None).pruned_rows, 0)
+
+    def test_incremental_vacuum_shrinks_file(self):
+        self.record([[make_train(f"2024-01-{day:02d}", number=str(number)) for number in range(500)]
+                     for day in range(1, 15)], observed_at=1704085200)
+        self.conn.commit()
+        size = os.path.getsize(self.db_path)
+        stats = self.maintain(keep_days=1, slice_seconds=10)
+        self.assertGreater(stats.vacuumed_pages, 0)
+        self.assertFalse(stats.out_of_time)
+        self.assertEqual(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertLess(os.path.getsize(self.db_path), size)
+
+    def test_budget_stops_vacuum_and_analyze(self):
+        self.record([[make_train("2024-01-15", number=str(number)) for number in range(500)]], observed_at=1)
+        stats = self.maintain(keep_days=1, budget_seconds=0)
+        self.assertEqual(stats.rolled_up_trains, 500)
+        self.assertEqual((stats.vacuumed_pages, stats.analyzed_tables, stats.out_of_time), (0, 0, True))
+
+    def test_full_vacuum_enables_incremental_vacuum(self):
+        # A file created before init_database set auto_vacuum
+        old_path = os.path.join(self.tmp.name, 'old.sqlite3')
+        conn = sqlite3.connect(old_path)
+        conn.execute("CREATE TABLE board_state (name TEXT PRIMARY KEY, value TEXT)")
+        conn.close()
+        init_database(old_path)
+        with self.assertLogs('maintenance', level='INFO') as logs:
+            run_maintenance(old_path, today="2024-02-20", pause_seconds=0)
+        self.assertIn("--full-vacuum", logs.output[0])
+        with self.assertLogs('maintenance', level='WARNING'):
+            run_maintenance(old_path, full_vacuum=True, today="2024-02-20", pause_seconds=0)
+        conn = sqlite3.connect(old_path)
+        self.assertEqual(conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        conn.close()
+
+    def test_maintain_command(self):
+        with self.assertLogs('scrape', level='INFO') as logs:
+            main(['--db', self.db_path, 'maintain', '--keep-days', '7', '--budget', '5'])
+        self.assertIn("analyzed 5 tables", logs.output[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
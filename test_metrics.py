@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import io
+import json
+import logging
+import os
+import unittest
+import urllib.request
+from unittest.mock import patch
+
+from metrics import JsonFormatter, Metrics, MetricsServer
+from poller import Daemon
+from scrape import DEFAULT_STATION, TrainWriter
+from stations import MultiStationPoller
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counters_and_timings(self):
+        metrics = Metrics()
+        metrics.inc('polls_total', station='NYP', result='changed')
+        metrics.inc('polls_total', station='NYP', result='changed')
+        metrics.inc('bytes_transferred_total', 512, station='NYP')
+        metrics.observe('fetch', 0.5, station='NYP')
+        metrics.observe('fetch', 1.5, station='NYP')
+        with metrics.timer('write', station='NYP'):
+            pass
+
+        snapshot = metrics.snapshot()
+        counters = {(c['name'], tuple(sorted(c['labels'].items()))): c['value'] for c in snapshot['counters']}
+        self.assertEqual(counters[('polls_total', (('result', 'changed'), ('station', 'NYP')))], 2)
+        self.assertEqual(counters[('bytes_transferred_total', (('station', 'NYP'),))], 512)
+        fetch = next(t for t in snapshot['timings'] if t['stage'] == 'fetch')
+        self.assertEqual((fetch['count'], fetch['total_seconds'], fetch['max_seconds'], fetch['last_seconds']),
+                         (2, 2.0, 1.5, 1.5))
+        self.assertIn('write', [t['stage'] for t in snapshot['timings']])
+
+    def test_prometheus_text(self):
+        metrics = Metrics()
+        metrics.inc('polls_total', station='NYP', result='unchanged')
+        metrics.observe('parse_departures', 0.25, station='NYP')
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE scrape_polls_total counter', text)
+        self.assertIn('scrape_polls_total{result="unchanged",station="NYP"} 1', text)
+        self.assertIn('# TYPE scrape_stage_seconds summary', text)
+        self.assertIn('scrape_stage_seconds_count{stage="parse_departures",station="NYP"} 1', text)
+        self.assertIn('scrape_stage_seconds_sum{stage="parse_departures",station="NYP"} 0.250000', text)
+        self.assertIn('scrape_stage_seconds_max{stage="parse_departures",station="NYP"} 0.250000', text)
+
+    def test_server(self):
+        metrics = Metrics()
+        metrics.inc('polls_total', station='NYP', result='changed')
+        server = MetricsServer(metrics, 0, host='127.0.0.1')
+        server.start()
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics') as response:
+                self.assertIn(b'scrape_polls_total{result="changed",station="NYP"} 1', response.read())
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/stats.json') as response:
+                self.assertEqual(json.load(response)['counters'][0]['name'], 'polls_total')
+        finally:
+            server.close()
+
+    def test_json_formatter_includes_extra_fields(self):
+        stream = io.StringIO()
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        logger = logging.getLogger('test_metrics.json')
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.warning("NYP: %s", "slow", extra={'station': 'NYP', 'timings': {'fetch': 1.25}})
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['level'], 'WARNING')
+        self.assertEqual(entry['message'], 'NYP: slow')
+        self.assertEqual(entry['station'], 'NYP')
+        self.assertEqual(entry['timings'], {'fetch': 1.25})
+
+
+class TestPollMetrics(DatabaseTestCase):
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_poll_records_stage_timings(self, mock_fetch_page):
+        """Test each poll's stage timings are kept on the result and added to the registry"""
+        metrics = Metrics()
+        writer = TrainWriter(self.db_path)
+        poller = MultiStationPoller([DEFAULT_STATION], writer, client=object(), min_host_interval=0,
+                                    metrics=metrics)
+        try:
+            changed = poller.poll(day="2024-01-15")['NYP']
+            unchanged = poller.poll(day="2024-01-15")['NYP']
+        finally:
+            poller.close()
+            writer.close()
+
+        self.assertEqual(sorted(changed.timings), sorted([
+            'fetch', 'extract', 'parse_departures', 'parse_arrivals', 'diff', 'filter', 'write', 'record',
+        ]))
+        self.assertEqual(sorted(unchanged.timings), ['extract', 'fetch'])
+
+        text = metrics.to_prometheus()
+        self.assertIn('scrape_polls_total{result="changed",station="NYP"} 1', text)
+        self.assertIn('scrape_polls_total{result="unchanged",station="NYP"} 1', text)
+        self.assertIn('scrape_trains_parsed_total{station="NYP"} 3', text)
+        self.assertIn('scrape_rows_written_total{outcome="inserted",station="NYP"} 1', text)
+        self.assertIn('scrape_changes_total{kind="new",station="NYP"} 3', text)
+        self.assertIn('scrape_stage_seconds_count{stage="fetch",station="NYP"} 2', text)
+        self.assertIn('scrape_stage_seconds_count{stage="write",station="NYP"} 1', text)
+        self.assertIn('scrape_stage_seconds_count{stage="poll"} 2', text)
+
+    @patch('stations.fetch_page', return_value=SCRAPE_PAGE_HTML)
+    def test_daemon_writes_stats_file(self, mock_fetch_page):
+        stats_file = os.path.join(self.tmp.name, 'stats.json')
+        daemon = Daemon(self.db_path, interval=0.01, client=object(), min_host_interval=0,
+                        metrics=Metrics(), stats_file=stats_file)
+        mock_fetch_page.side_effect = lambda client, station: daemon.stop() or SCRAPE_PAGE_HTML
+        daemon.run()
+
+        with open(stats_file) as f:
+            stats = json.load(f)
+        self.assertIn('fetch', [timing['stage'] for timing in stats['timings']])
+        self.assertIn('polls_total', [counter['name'] for counter in stats['counters']])
+
+
+if __name__ == '__main__':
+    unittest.main()
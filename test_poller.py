@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import io
+import sqlite3
+import unittest
+from unittest.mock import patch
+
+from poller import Daemon
+from scrape import main
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase
+
+
+class TestDaemon(DatabaseTestCase):
+    def test_next_due_stays_on_grid(self):
+        """Test scheduling is anchored to the start time rather than the last scrape"""
+        daemon = Daemon(':memory:', interval=30)
+        self.assertEqual(daemon.next_due(start=100, now=100), 130)
+        self.assertEqual(daemon.next_due(start=100, now=104.5), 130)
+        self.assertEqual(daemon.next_due(start=100, now=131), 160)
+
+    def test_next_due_skips_missed_slots(self):
+        """Test a scrape overrunning several intervals does not cause a burst"""
+        daemon = Daemon(':memory:', interval=30)
+        self.assertEqual(daemon.next_due(start=100, now=195), 220)
+
+    def test_next_due_jitter_bounded(self):
+        """Test jitter stays within the configured bound and never schedules in the past"""
+        daemon = Daemon(':memory:', interval=30, jitter=5)
+        for _ in range(100):
+            due = daemon.next_due(start=0, now=10)
+            self.assertGreaterEqual(due, 25)
+            self.assertLessEqual(due, 35)
+
+    def test_invalid_jitter(self):
+        with self.assertRaises(ValueError):
+            Daemon(':memory:', interval=10, jitter=10)
+
+    @patch('poller.run_daemon')
+    def test_invalid_jitter_is_a_usage_error(self, mock_run_daemon):
+        with patch('sys.stderr', new_callable=io.StringIO) as stderr, self.assertRaises(SystemExit):
+            main(['--db', self.db_path, '--daemon', '--interval', '10', '--jitter', '10'])
+        self.assertIn("--jitter must be", stderr.getvalue())
+        mock_run_daemon.assert_not_called()
+
+    @patch('stations.fetch_page')
+    def test_run_reuses_client_and_connection(self, mock_fetch_page):
+        """Test the loop scrapes until stopped, sharing one client and one connection"""
+        client = object()
+        daemon = Daemon(self.db_path, interval=0.01, client=client, min_host_interval=0)
+
+        def fake_fetch_page(client, station):
+            self.assertIs(client, daemon.client)
+            if mock_fetch_page.call_count == 3:
+                daemon.stop()
+            return SCRAPE_PAGE_HTML
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        daemon.run()
+
+        self.assertEqual(mock_fetch_page.call_count, 3)
+        self.assertEqual(daemon.scrape_count, 3)
+        self.assertIsNone(daemon.writer)
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_track_locations").fetchone()[0], 1)
+        conn.close()
+
+    @patch('stations.fetch_page')
+    def test_run_survives_scrape_errors(self, mock_fetch_page):
+        """Test a failed scrape is counted and polling continues"""
+        daemon = Daemon(self.db_path, interval=0.01, client=object(), min_host_interval=0)
+
+        def fake_fetch_page(client, station):
+            if mock_fetch_page.call_count == 2:
+                daemon.stop()
+            raise Exception("Failed to scrape: 503: Service Unavailable")
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        with self.assertLogs('stations', level='ERROR') as logs:
+            daemon.run()
+
+        self.assertEqual(daemon.error_count, 2)
+        self.assertIn("NYP: Failed to scrape: 503", logs.output[0])
+        self.assertEqual(daemon.scrape_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import sqlite3
+import unittest
+
+from changes import diff_trains
+from events import EventLog
+from query import TrackStats, track_distribution, track_lead
+from scrape import scheduled_datetime
+from test_scrape import DatabaseTestCase, make_train
+
+
+class TestTrackStats(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.conn = sqlite3.connect(self.db_path)
+        self.sinks = [EventLog(self.conn), TrackStats(self.conn)]
+
+    def tearDown(self):
+        self.conn.close()
+
+    def replay(self, boards):
+        """Feed successive (minutes before departure, board) snapshots through the sinks"""
+        previous = []
+        for minutes_before, board in boards:
+            train = board[0] if board else make_train()
+            departure = scheduled_datetime(train.day, train.time)
+            observed_at = int(departure.timestamp()) - minutes_before * 60
+            changes = diff_trains(previous, board)
+            for sink in self.sinks:
+                sink.record(changes, observed_at)
+            previous = board
+
+    def test_distribution_and_lead(self):
+        """Test track counts and posting lead times accumulate across days"""
+        self.replay([(30, [make_train()]), (12, [make_train(track="6")]), (0, [])])
+        self.replay([(30, [make_train(day="2024-01-16")]), (22, [make_train(track="6", day="2024-01-16")])])
+        self.replay([(15, [make_train(track="7", day="2024-01-17")])])
+
+        distribution = track_distribution(self.conn, train_number="2275")
+        self.assertEqual([(share.track, share.assignments) for share in distribution], [("6", 2), ("7", 1)])
+        self.assertAlmostEqual(distribution[0].share, 2 / 3)
+
+        lead = track_lead(self.conn, destination="Washington, DC")
+        self.assertEqual(lead.samples, 3)
+        self.assertAlmostEqual(lead.mean_minutes, (12 + 22 + 15) / 3)
+        self.assertEqual(lead.median_minutes, 17.5)
+
+    def test_reassignment_moves_count(self):
+        """Test a track change moves the assignment without adding a lead sample"""
+        self.replay([(20, [make_train(track="6")]), (10, [make_train(track="9")])])
+        distribution = track_distribution(self.conn, train_name="Acela")
+        self.assertEqual([(share.track, share.assignments) for share in distribution], [("9", 1)])
+        self.assertEqual(track_lead(self.conn, train_number="2275").samples, 1)
+
+    def test_rebuild_matches_incremental(self):
+        """Test rebuilding from train_events gives the incrementally maintained summaries"""
+        self.replay([(20, [make_train(track="6"), make_train(number="57")]), (10, [make_train(track="9"), make_train(number="57", track="3")])])
+        before = (track_distribution(self.conn, train_number="2275"), track_lead(self.conn, train_number="57"))
+        TrackStats(self.conn).rebuild()
+        after = (track_distribution(self.conn, train_number="2275"), track_lead(self.conn, train_number="57"))
+        self.assertEqual(before, after)
+
+    def test_rollover_and_restart_are_not_new_postings(self):
+        """Test a tracked train re-dated at midnight or seen after a restart is counted once"""
+        posted = int(scheduled_datetime("2024-01-15", "9:20 PM").timestamp()) - 15 * 60
+        self.replay([(15, [make_train(track="6")])])
+        # The day rolls over with the train still on the board, then a restart
+        # starts from an empty snapshot after the track changed
+        rolled_over = [make_train(day="2024-01-16", track="6")]
+        for previous, board, observed_at in (([make_train(track="6")], rolled_over, posted + 3 * 3600),
+                                             ([], [make_train(day="2024-01-16", track="9")], posted + 4 * 3600)):
+            for sink in self.sinks:
+                sink.record(diff_trains(previous, board), observed_at)
+        distribution = track_distribution(self.conn, train_number="2275")
+        self.assertEqual([(share.track, share.assignments) for share in distribution], [("9", 1)])
+        self.assertEqual(track_lead(self.conn, train_number="2275").samples, 1)
+
+        # The next day's run is a new posting
+        self.replay([(20, [make_train(day="2024-01-16", track="6")])])
+        self.assertEqual(track_lead(self.conn, train_number="2275").samples, 2)
+        before = track_distribution(self.conn, train_number="2275")
+        TrackStats(self.conn).rebuild()
+        self.assertEqual(track_distribution(self.conn, train_number="2275"), before)
+
+    def test_filter_required(self):
+        with self.assertRaises(ValueError):
+            track_distribution(self.conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
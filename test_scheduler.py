@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+import datetime
+import io
+import os
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from archive import FragmentArchive
+from metrics import Metrics
+from poller import Daemon
+from scheduler import (
+    AdaptiveScheduler, FixedScheduler, Recording, expected_at, percentile, simulate,
+)
+from scrape import ScheduleBoard, main, timezone
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase, make_train
+
+NOW = datetime.datetime(2024, 1, 15, 20, 0)
+
+
+def departures(*trains):
+    return ScheduleBoard(departures=list(trains), arrivals=[])
+
+
+def board_html(table_id, trains):
+    rows = ''.join(
+        f'<tr class="amtrak-header-row"><td>{time}</td><td colspan="2"><span class="train-number">{number}</span>'
+        f'&nbsp;<span class="train-name">Acela</span></td></tr><tr class="amtrak-destination">'
+        f'<td colspan="2" class="pill-cell"><span class="pill-destination">Washington, DC</span>'
+        f'<span class="pill-status ">On Time</span></td><td class="track-cell">{track}</td></tr>'
+        for time, number, track in trains
+    )
+    return f'<table id="{table_id}" class="amtrak-table"><tbody>{rows}</tbody></table>'
+
+
+def timestamp(hour, minute):
+    return int(timezone().localize(datetime.datetime(2024, 1, 15, hour, minute)).timestamp())
+
+
+class TestAdaptiveScheduler(unittest.TestCase):
+    def test_expected_at(self):
+        self.assertEqual(expected_at(make_train(), NOW), datetime.datetime(2024, 1, 15, 21, 20))
+        self.assertEqual(expected_at(make_train(status="Now 9:25PM"), NOW), datetime.datetime(2024, 1, 15, 21, 25))
+        self.assertIsNone(expected_at(make_train(status="Cancelled"), NOW))
+        # Listed under the service day, but leaving after midnight
+        late = datetime.datetime(2024, 1, 15, 23, 50)
+        self.assertEqual(expected_at(make_train(time="12:15 AM"), late), datetime.datetime(2024, 1, 16, 0, 15))
+
+    def test_polls_fast_while_a_track_is_due(self):
+        scheduler = AdaptiveScheduler(interval=60, min_interval=15, max_interval=600)
+        self.assertEqual(scheduler.next_interval([departures(make_train(time="8:15 PM"))], False, NOW), 15)
+        # Delayed past its window, then overdue
+        self.assertEqual(scheduler.next_interval([departures(make_train(time="7:30 PM", status="Now 8:10PM"))],
+                                                 False, NOW), 15)
+        self.assertEqual(scheduler.next_interval([departures(make_train(time="7:00 PM"))], True, NOW), 60)
+        # Trains with a track have nothing left to wait for
+        self.assertEqual(scheduler.next_interval([departures(make_train(time="8:15 PM", track="7"))], True, NOW), 60)
+
+    def test_backs_off_until_the_next_window(self):
+        scheduler = AdaptiveScheduler(interval=60, min_interval=15, max_interval=600, backoff=2)
+        self.assertEqual([scheduler.next_interval([], False, NOW) for _ in range(5)], [120, 240, 480, 600, 600])
+        # The 9:20 PM train's window opens at 9:00 PM, and the quiet interval applies until then
+        board = departures(make_train())
+        self.assertEqual(scheduler.next_interval([board], False, NOW), 600)
+        self.assertEqual(scheduler.next_interval([board], False, datetime.datetime(2024, 1, 15, 20, 58)), 120)
+        self.assertEqual(scheduler.next_interval([board], True, datetime.datetime(2024, 1, 15, 20, 59, 50)), 15)
+        # The soonest window of any station counts
+        self.assertEqual(scheduler.next_interval([departures(), board], True, datetime.datetime(2024, 1, 15, 20, 59)), 60)
+
+    def test_invalid_intervals(self):
+        with self.assertRaises(ValueError):
+            AdaptiveScheduler(interval=10, min_interval=30, max_interval=600)
+        with self.assertRaises(ValueError):
+            AdaptiveScheduler(interval=60, min_interval=0, max_interval=600)
+
+    def test_percentile(self):
+        self.assertIsNone(percentile([], 0.5))
+        self.assertEqual(percentile([30, 10, 20], 0.5), 20)
+        self.assertEqual(percentile(list(range(1, 11)), 0.9), 9)
+
+
+class TestSimulation(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.archive_path = os.path.join(self.tmp.name, 'archive.sqlite3')
+        archive = FragmentArchive(self.archive_path)
+        # A fetch a minute from 7:00 PM to 9:30 PM, tracks posted at 8:17 PM and 9:05 PM
+        for minute in range(0, 151):
+            at = timestamp(19 + minute // 60, minute % 60)
+            trains = [("8:30 PM", "132", "5" if minute >= 77 else ""), ("9:20 PM", "2275", "7" if minute >= 125 else "")]
+            archive.record("NYP", "2024-01-15", board_html("amtrak-departures", trains),
+                           board_html("amtrak-arrivals", []), fetched_at=at)
+        archive.close()
+
+    def test_recording(self):
+        recording = Recording(self.archive_path)
+        self.assertEqual(len(recording), 151)
+        self.assertEqual(max(recording.versions), 2)
+        self.assertEqual(recording.posted(), {("2024-01-15", "8:30 PM", "132"): timestamp(20, 17),
+                                              ("2024-01-15", "9:20 PM", "2275"): timestamp(21, 5)})
+        self.assertEqual(len(Recording(self.archive_path, station="BOS")), 0)
+
+    def test_adaptive_sees_tracks_sooner_with_fewer_fetches(self):
+        recording = Recording(self.archive_path)
+        fixed = simulate(recording, FixedScheduler(60))
+        self.assertEqual((fixed.fetches, fixed.detected, fixed.median_latency), (151, 2, 0))
+        slow = simulate(recording, FixedScheduler(600))
+        self.assertEqual(slow.fetches, 16)
+        self.assertEqual(slow.max_latency, 5 * 60)
+
+        adaptive = simulate(recording, AdaptiveScheduler(interval=300, min_interval=60, max_interval=600))
+        self.assertEqual(adaptive.detected, 2)
+        self.assertLessEqual(adaptive.max_latency, 60)
+        self.assertLess(adaptive.fetches, fixed.fetches / 4)
+
+    def test_simulate_command(self):
+        """Test simulate reads only the archive, without creating a database"""
+        db_path = os.path.join(self.tmp.name, 'unused.sqlite3')
+        output = io.StringIO()
+        with redirect_stdout(output):
+            main(['--db', db_path, 'simulate', '--archive', self.archive_path, '--interval', '300'])
+        self.assertFalse(os.path.exists(db_path))
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], "151 fetches of NYP recorded, tracks posted for 2 trains")
+        self.assertTrue(lines[1].startswith("Fixed 300s: 31 fetches, 2/2 tracks seen"))
+        self.assertTrue(lines[2].startswith("Adaptive 15-600s:"))
+
+
+class TestAdaptiveDaemon(DatabaseTestCase):
+    @patch('stations.fetch_page')
+    def test_daemon_waits_as_scheduled(self, mock_fetch_page):
+        metrics = Metrics()
+        scheduler = AdaptiveScheduler(interval=0.01, min_interval=0.01, max_interval=0.02)
+        daemon = Daemon(self.db_path, interval=60, client=object(), min_host_interval=0, metrics=metrics,
+                        scheduler=scheduler)
+
+        def fake_fetch_page(client, station):
+            if mock_fetch_page.call_count == 3:
+                daemon.stop()
+            return SCRAPE_PAGE_HTML
+        mock_fetch_page.side_effect = fake_fetch_page
+
+        daemon.run()
+        self.assertEqual(daemon.scrape_count, 3)
+        # Only the first scrape changed the board
+        self.assertEqual(scheduler.unchanged_polls, 2)
+        [timing] = [timing for timing in metrics.snapshot()['timings'] if timing['stage'] == 'poll_interval']
+        self.assertEqual(timing['count'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,105 @@
 #!/usr/bin/env python3
 
+import datetime
+import os
+import sqlite3
+import tempfile
 import unittest
 from unittest.mock import patch, Mock
-from scrape import parse, Train, scrape, ScheduleBoard
+from scrape import (
+    parse, parse_stream, parse_board_stream, Train, scrape, ScheduleBoard,
+    init_database, upsert_train_data, TrainWriter, WriteStats, main, migrate_to_v2,
+    MIGRATION_PROGRESS_KEY, SCHEMA_VERSION,
+)
+
+SCRAPE_PAGE_HTML = """
+        <html>
+            <body>
+                <div id="amtrak-departures-target">
+                    <table>
+                        <tbody>
+                            <tr class="amtrak-header-row">
+                                <td>6:45 PM</td>
+                                <td colspan="2">
+                                    <span class="train-number">241</span>&nbsp;
+                                    <span class="train-name">Empire Service</span>
+                                </td>
+                            </tr>
+                            <tr class="amtrak-destination">
+                                <td colspan="2" class="pill-cell">
+                                    <span class="pill-destination">Albany-Rensselaer, NY</span>
+                                    <span class="pill-status ">Second Boarding</span>
+                                </td>
+                                <td class="track-cell">6</td>
+                            </tr>
+                            <tr class="amtrak-header-row">
+                                <td>7:01 PM</td>
+                                <td colspan="2">
+                                    <span class="train-number">57</span>&nbsp;
+                                    <span class="train-name">Vermonter</span>
+                                </td>
+                            </tr>
+                            <tr class="amtrak-destination">
+                                <td colspan="2" class="pill-cell">
+                                    <span class="pill-destination">Washington, DC</span>
+                                    <span class="pill-status ">On Time</span>
+                                </td>
+                                <td class="track-cell"></td>
+                            </tr>
+                        </tbody>
+                    </table>
+                </div>
+                <div id="amtrak-arrivals-target">
+                    <table>
+                        <tbody>
+                            <tr class="amtrak-header-row">
+                                <td>7:02 PM</td>
+                                <td colspan="2">
+                                    <span class="train-number">67</span>&nbsp;
+                                    <span class="train-name">Northeast Regional</span>
+                                </td>
+                            </tr>
+                            <tr class="amtrak-destination">
+                                <td colspan="2" class="pill-cell">
+                                    <span class="pill-destination">Boston, MA</span>
+                                    <span class="pill-status ">On Time</span>
+                                </td>
+                                <td class="track-cell"></td>
+                            </tr>
+                        </tbody>
+                    </table>
+                </div>
+            </body>
+        </html>
+        """
+
+
+def make_train(day="2024-01-15", number="2275", status="On Time", track="", time="9:20 PM", name="Acela",
+               destination="Washington, DC"):
+    """Return a Train for tests, by default an untracked 9:20 PM Acela to Washington."""
+    return Train(day, time, number, name, destination, status, track)
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Base for tests needing a fresh database, at self.db_path in the temporary directory self.tmp."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # Cleanups run after tearDown, so subclasses can close connections there first
+        self.addCleanup(self.tmp.cleanup)
+        self.db_path = os.path.join(self.tmp.name, 'test.sqlite3')
+        init_database(self.db_path)
+
 
 class TestParse(unittest.TestCase):
+    parse = staticmethod(parse)
+
     def test_parse_golden_input_departures(self):
         # Golden input
         golden_html = """<table id="amtrak-departures" class="amtrak-table departures"><thead class="placeholder-head"><tr><th></th><th></th><th></th></tr></thead><tbody><tr class="amtrak-header-row"><td>6:45 PM</td><td colspan="2"><span class="train-number">241</span>&nbsp;<span class="train-name">Empire Service</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Albany-Rensselaer, NY</span><span class="pill-status ">Second Boarding</span></td><td class="track-cell">6</td></tr><tr class="amtrak-header-row"><td>7:01 PM</td><td colspan="2"><span class="train-number">57</span>&nbsp;<span class="train-name">Vermonter</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Washington, DC</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>7:15 PM</td><td colspan="2"><span class="train-number">2258</span>&nbsp;<span class="train-name">Acela</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Boston, MA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>7:30 PM</td><td colspan="2"><span class="train-number">132</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Boston, MA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>7:53 PM</td><td colspan="2"><span class="train-number">671</span>&nbsp;<span class="train-name">Keystone Service</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Harrisburg, PA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>7:59 PM</td><td colspan="2"><span class="train-number">165</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Washington, DC</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>8:00 PM</td><td colspan="2"><span class="train-number">146</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">New Haven, CT</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>8:29 PM</td><td colspan="2"><span class="train-number">2259</span>&nbsp;<span class="train-name">Acela</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Washington, DC</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>9:00 PM</td><td colspan="2"><span class="train-number">166</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Boston, MA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>9:20 PM</td><td colspan="2"><span class="train-number">2275</span>&nbsp;<span class="train-name">Acela</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Washington, DC</span><span class="pill-status ">Now 9:25PM</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>9:22 PM</td><td colspan="2"><span class="train-number">139</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Philadelphia, PA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr></tbody></table>"""
         
         # Parse the HTML
-        trains = parse(golden_html)
+        trains = self.parse(golden_html)
         
         # Verify we got the expected number of trains
         self.assertEqual(len(trains), 11)
@@ -77,13 +166,13 @@ class TestParse(unittest.TestCase):
 
     def test_parse_empty_input(self):
         """Test parsing empty HTML input"""
-        trains = parse("")
+        trains = self.parse("")
         self.assertEqual(trains, [])
     
     def test_parse_no_trains(self):
         """Test parsing HTML with no train data"""
         html_without_trains = "<html><body><table><tbody></tbody></table></body></html>"
-        trains = parse(html_without_trains)
+        trains = self.parse(html_without_trains)
         self.assertEqual(trains, [])
 
     def test_parse_golden_input_arrivals(self):
@@ -91,7 +180,7 @@ class TestParse(unittest.TestCase):
         golden_html = """<table id="amtrak-arrivals" class="amtrak-table arrivals"><tbody><tr class="amtrak-header-row"><td>7:02 PM</td><td colspan="2"><span class="train-number">67</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Boston, MA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>7:24 PM</td><td colspan="2"><span class="train-number">90</span>&nbsp;<span class="train-name">Palmetto</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Savannah, GA</span><span class="pill-status ">Now 11:15PM</span></td><td class="track-cell"></td></tr><tr class="amtrak-header-row"><td>7:59 PM</td><td colspan="2"><span class="train-number">169</span>&nbsp;<span class="train-name">Northeast Regional</span></td></tr><tr class="amtrak-destination"><td colspan="2" class="pill-cell"><span class="pill-destination">Boston, MA</span><span class="pill-status ">On Time</span></td><td class="track-cell"></td></tr></tbody></table>"""
         
         # Parse the HTML
-        trains = parse(golden_html)
+        trains = self.parse(golden_html)
         
         # Verify we got the expected number of trains
         self.assertEqual(len(trains), 3)
@@ -139,73 +228,54 @@ class TestParse(unittest.TestCase):
             self.assertGreater(len(train.status), 0)
 
 
+    def test_parse_nested_field_markup(self):
+        """Test a field runs to its own closing tag, not the first one with the same name"""
+        html = ('<table><tr class="amtrak-header-row"><td>9:20 PM</td><td><span class="train-number">2275</span>'
+                '<span class="train-name">Acela</span></td></tr><tr class="amtrak-destination">'
+                '<td class="pill-cell"><span class="pill-destination">Washington, DC</span>'
+                '<span class="pill-status"><span>Now</span> 9:25PM</span></td>'
+                '<td class="track-cell"><b>7</b></td></tr></table>')
+        [train] = self.parse(html)
+        self.assertEqual((train.status, train.track), ("Now9:25PM", "7"))
+
+
+class TestStreamParse(TestParse):
+    """Run the parse() golden tests against the streaming parser"""
+    parse = staticmethod(parse_stream)
+
+    def test_parse_board_single_pass(self):
+        """Test both boards are read from a full page in one pass"""
+        board = parse_board_stream(SCRAPE_PAGE_HTML, day="2024-01-15")
+
+        self.assertEqual([t.train_number for t in board.departures], ["241", "57"])
+        self.assertEqual([t.train_number for t in board.arrivals], ["67"])
+        self.assertEqual(board.departures[0].track, "6")
+        self.assertEqual(board.departures[0].status, "Second Boarding")
+        self.assertEqual(board.arrivals[0].destination, "Boston, MA")
+        for train in board.departures + board.arrivals:
+            self.assertEqual(train.day, "2024-01-15")
+
+    def test_parse_board_matches_bs4(self):
+        """Test the streaming parser returns the same trains as the bs4 parser"""
+        from scrape import parse_board_bs4
+        expected = parse_board_bs4(SCRAPE_PAGE_HTML)
+        board = parse_board_stream(SCRAPE_PAGE_HTML, day=expected.departures[0].day)
+        self.assertEqual(board, expected)
+
+    def test_parse_board_missing_targets(self):
+        """Test a page without the target elements yields empty boards"""
+        board = parse_board_stream("<html><body><p>Maintenance</p></body></html>")
+        self.assertEqual(board, ScheduleBoard(departures=[], arrivals=[]))
+
+
 class TestScrape(unittest.TestCase):
-    @patch('scrape.primp.get')
+    @patch('primp.get')
     def test_scrape_success(self, mock_get):
         """Test the scrape() function with mocked HTTP response"""
         # Mock response data
         mock_response = Mock()
         mock_response.status_code = 200
-        mock_response.text = """
-        <html>
-            <body>
-                <div id="amtrak-departures-target">
-                    <table>
-                        <tbody>
-                            <tr class="amtrak-header-row">
-                                <td>6:45 PM</td>
-                                <td colspan="2">
-                                    <span class="train-number">241</span>&nbsp;
-                                    <span class="train-name">Empire Service</span>
-                                </td>
-                            </tr>
-                            <tr class="amtrak-destination">
-                                <td colspan="2" class="pill-cell">
-                                    <span class="pill-destination">Albany-Rensselaer, NY</span>
-                                    <span class="pill-status ">Second Boarding</span>
-                                </td>
-                                <td class="track-cell">6</td>
-                            </tr>
-                            <tr class="amtrak-header-row">
-                                <td>7:01 PM</td>
-                                <td colspan="2">
-                                    <span class="train-number">57</span>&nbsp;
-                                    <span class="train-name">Vermonter</span>
-                                </td>
-                            </tr>
-                            <tr class="amtrak-destination">
-                                <td colspan="2" class="pill-cell">
-                                    <span class="pill-destination">Washington, DC</span>
-                                    <span class="pill-status ">On Time</span>
-                                </td>
-                                <td class="track-cell"></td>
-                            </tr>
-                        </tbody>
-                    </table>
-                </div>
-                <div id="amtrak-arrivals-target">
-                    <table>
-                        <tbody>
-                            <tr class="amtrak-header-row">
-                                <td>7:02 PM</td>
-                                <td colspan="2">
-                                    <span class="train-number">67</span>&nbsp;
-                                    <span class="train-name">Northeast Regional</span>
-                                </td>
-                            </tr>
-                            <tr class="amtrak-destination">
-                                <td colspan="2" class="pill-cell">
-                                    <span class="pill-destination">Boston, MA</span>
-                                    <span class="pill-status ">On Time</span>
-                                </td>
-                                <td class="track-cell"></td>
-                            </tr>
-                        </tbody>
-                    </table>
-                </div>
-            </body>
-        </html>
-        """
+        mock_response.text = SCRAPE_PAGE_HTML
         mock_get.return_value = mock_response
         
         # Call the scrape function
@@ -247,7 +317,25 @@ class TestScrape(unittest.TestCase):
         self.assertEqual(result.arrivals[0].status, "On Time")
         self.assertEqual(result.arrivals[0].track, "")
 
-    @patch('scrape.primp.get')
+    @patch('primp.get')
+    def test_scrape_stream_parser(self, mock_get):
+        """Test the scrape() function with the streaming parser engine"""
+        mock_response = Mock()
+        mock_response.status_code = 200
+        mock_response.text = SCRAPE_PAGE_HTML
+        mock_get.return_value = mock_response
+
+        result = scrape(parser='stream')
+
+        self.assertIsInstance(result, ScheduleBoard)
+        self.assertEqual(len(result.departures), 2)
+        self.assertEqual(result.departures[0].train_number, "241")
+        self.assertEqual(result.departures[0].track, "6")
+        self.assertEqual(result.departures[1].train_name, "Vermonter")
+        self.assertEqual(len(result.arrivals), 1)
+        self.assertEqual(result.arrivals[0].train_number, "67")
+
+    @patch('primp.get')
     def test_scrape_http_error(self, mock_get):
         """Test the scrape() function handles HTTP errors properly"""
         # Mock response with error status code
@@ -264,5 +352,177 @@ class TestScrape(unittest.TestCase):
         self.assertIn("Failed to scrape: 404", str(context.exception))
         self.assertIn("Not Found", str(context.exception))
 
+class TestTrainWriter(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.writer = TrainWriter(self.db_path)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def trains(self, status="On Time", track="6"):
+        return [
+            Train("2024-01-15", "6:45 PM", "241", "Empire Service", "Albany-Rensselaer, NY", status, track),
+            Train("2024-01-15", "7:01 PM", "57", "Vermonter", "Washington, DC", "On Time", "11"),
+        ]
+
+    def rows(self):
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute(
+            "SELECT train_number, status, track FROM train_track_locations ORDER BY train_number"
+        ).fetchall()
+        conn.close()
+        return rows
+
+    def test_write_reports_inserted_updated_unchanged(self):
+        """Test write() counts new, changed and identical rows separately"""
+        self.assertEqual(self.writer.write(self.trains()), WriteStats(inserted=2))
+        self.assertEqual(self.writer.write(self.trains()), WriteStats(unchanged=2))
+        self.assertEqual(self.writer.write(self.trains(status="Second Boarding")), WriteStats(updated=1, unchanged=1))
+        self.assertEqual(self.rows(), [("241", "Second Boarding", "6"), ("57", "On Time", "11")])
+
+    def test_write_skips_unparseable_times(self):
+        """Test rows with an invalid time are skipped without failing the batch"""
+        trains = self.trains() + [Train("2024-01-15", "TBD", "99", "Acela", "Boston, MA", "On Time", "7")]
+        with self.assertLogs('scrape', level='WARNING') as logs:
+            stats = self.writer.write(trains)
+        self.assertEqual(stats, WriteStats(inserted=2, skipped=1))
+        self.assertIn("Could not parse date/time for train 99", logs.output[0])
+
+    def test_write_keeps_am_and_pm_apart(self):
+        """Test a PM train is stored at its own time rather than colliding with the AM train"""
+        trains = [make_train(time="6:45 AM"), make_train(time="6:45 PM")]
+        self.assertEqual(self.writer.write(trains), WriteStats(inserted=2))
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT schedule_time, time FROM train_track_locations ORDER BY time").fetchall()
+        conn.close()
+        self.assertEqual([schedule_time for schedule_time, _ in rows], ["6:45 AM", "6:45 PM"])
+        self.assertEqual(rows[1][1] - rows[0][1], 12 * 3600)
+
+    def test_write_enables_wal(self):
+        mode = self.writer.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_upsert_train_data_with_connection(self):
+        """Test upsert_train_data() reuses and leaves open a passed connection"""
+        conn = sqlite3.connect(self.db_path)
+        stats = upsert_train_data(self.trains(), self.db_path, conn=conn)
+        self.assertEqual(stats.inserted, 2)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_track_locations").fetchone()[0], 2)
+        conn.close()
+
+    def test_names_stored_once(self):
+        """Test repeated names are written as ids into the lookup tables"""
+        self.writer.write(self.trains())
+        self.writer.write([Train("2024-01-16", "6:45 PM", "241", "Empire Service", "Albany-Rensselaer, NY",
+                                 "On Time", "6")])
+        conn = self.writer.conn
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_locations").fetchone()[0], 3)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_names").fetchone()[0], 2)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM statuses").fetchone()[0], 1)
+
+    def test_failed_write_forgets_new_ids(self):
+        """Test ids cached during a rolled back write are not reused afterwards"""
+        with patch.object(self.writer, 'UPDATE_SQL', 'UPDATE no_such_table SET x = ?1'):
+            with self.assertRaises(sqlite3.OperationalError):
+                self.writer.write(self.trains())
+        self.assertEqual(self.writer.lookups['train_name'].ids, {})
+        self.assertEqual(self.writer.write(self.trains()), WriteStats(inserted=2))
+        self.assertEqual(self.rows(), [("241", "On Time", "6"), ("57", "On Time", "11")])
+
+
+def v1_time(day, schedule_time, hour_format="%H"):
+    """Return the epoch time a v1 writer stored, parsing the hour with %H as it did, or the fixed %I."""
+    return int(datetime.datetime.strptime(f"{day} {schedule_time}", f"%Y-%m-%d {hour_format}:%M %p").timestamp())
+
+
+V1_ROWS = [
+    ("2024-01-15", v1_time("2024-01-15", "6:45 PM"), "6:45 PM", "241", "Empire Service", "Albany-Rensselaer, NY",
+     "On Time", "6"),
+    ("2024-01-15", v1_time("2024-01-15", "7:01 PM"), "7:01 PM", "57", "Vermonter", "Washington, DC", "On Time", "11"),
+    ("2024-01-16", v1_time("2024-01-16", "6:45 PM"), "6:45 PM", "241", "Empire Service", "Albany-Rensselaer, NY",
+     "Boarding", "7"),
+    ("2024-01-16", None, "TBD", "99", "Acela", "Boston, MA", "On Time", "3"),
+]
+
+
+class TestSchemaMigration(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, 'test.sqlite3')
+        # A v1 database from before stations were tracked
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE train_track_locations (
+                day DATE, time DATETIME, schedule_time TEXT, train_number TEXT, train_name TEXT,
+                destination TEXT, status TEXT, track TEXT,
+                PRIMARY KEY (day, time, train_number)
+            )
+        ''')
+        conn.executemany("INSERT INTO train_track_locations VALUES (?, ?, ?, ?, ?, ?, ?, ?)", V1_ROWS)
+        conn.execute("CREATE TABLE board_state (name TEXT PRIMARY KEY, value TEXT)")
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path)
+        self.addCleanup(conn.close)
+        return conn
+
+    def assertMigrated(self, conn):
+        self.assertEqual(conn.execute("PRAGMA user_version").fetchone()[0], SCHEMA_VERSION)
+        self.assertEqual(conn.execute("SELECT type FROM sqlite_master WHERE name = 'train_track_locations'"
+                                      ).fetchone()[0], 'view')
+        rows = conn.execute('''
+            SELECT day, time, schedule_time, train_number, train_name, destination, status, track, station
+            FROM train_track_locations ORDER BY day, time
+        ''').fetchall()
+        # PM times are corrected, and the row without a time has no key and is dropped
+        self.assertEqual(rows, [(row[0], v1_time(row[0], row[2], "%I")) + row[2:] + ("NYP",) for row in V1_ROWS[:3]])
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_names").fetchone()[0], 3)
+        self.assertIsNone(conn.execute("SELECT value FROM board_state WHERE name = ?",
+                                       (MIGRATION_PROGRESS_KEY,)).fetchone())
+
+    def test_init_database_migrates_in_batches(self):
+        with self.assertLogs('scrape', level='INFO') as logs:
+            init_database(self.db_path, batch_rows=1)
+        self.assertEqual(sum("Migrated train_track_locations up to rowid" in line for line in logs.output), 4)
+        self.assertMigrated(self.connect())
+
+    def test_migration_resumes(self):
+        """Test a migration interrupted after a batch carries on from the saved rowid"""
+        conn = self.connect()
+        conn.execute("INSERT INTO board_state VALUES (?, '2')", (MIGRATION_PROGRESS_KEY,))
+        conn.commit()
+        with self.assertLogs('scrape', level='WARNING'):
+            stats = migrate_to_v2(conn, batch_rows=10)
+        # Only the rows after rowid 2 were copied
+        self.assertEqual((stats.rows, stats.skipped, stats.batches), (1, 1, 1))
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_locations").fetchone()[0], 1)
+
+    def test_merges_rows_of_the_corrected_time(self):
+        """Test a PM row written before the %I fix and its rewrite after it are merged into the latest"""
+        conn = self.connect()
+        conn.execute("INSERT INTO train_track_locations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     ("2024-01-15", v1_time("2024-01-15", "6:45 PM", "%I"), "6:45 PM", "241", "Empire Service",
+                      "Albany-Rensselaer, NY", "Departed", "6"))
+        conn.commit()
+        with self.assertLogs('scrape', level='WARNING'):
+            stats = migrate_to_v2(conn)
+        self.assertEqual((stats.rows, stats.skipped), (4, 1))
+        rows = conn.execute("SELECT time, status FROM train_track_locations WHERE day = '2024-01-15' AND "
+                            "train_number = '241'").fetchall()
+        self.assertEqual(rows, [(v1_time("2024-01-15", "6:45 PM", "%I"), "Departed")])
+
+    def test_migrate_command(self):
+        with self.assertLogs('scrape', level='INFO') as logs:
+            main(['--db', self.db_path, 'migrate', '--batch-rows', '2', '--vacuum'])
+        self.assertIn("schema version 2", logs.output[-1])
+        self.assertMigrated(self.connect())
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sqlite3
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+from analytics import load_history
+from app import create_app
+from archive import FragmentArchive, reparse
+from export import export
+from maintenance import run_maintenance
+from scrape import extract_target_fragments, main
+from shards import ShardSet, ShardedTrainWriter, open_writer, shard_key, shard_range
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase, make_train
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+class TestShardKeys(unittest.TestCase):
+    def test_month_and_week_keys(self):
+        self.assertEqual(shard_key("2024-01-15"), "2024-01")
+        self.assertEqual(shard_key("2024-01-15", "week"), "2024-W03")
+        # ISO weeks belong to the year of their Thursday
+        self.assertEqual(shard_key("2024-12-30", "week"), "2025-W01")
+
+    def test_ranges(self):
+        self.assertEqual(shard_range("2024-02"), ("2024-02-01", "2024-02-29"))
+        self.assertEqual(shard_range("2024-12"), ("2024-12-01", "2024-12-31"))
+        self.assertEqual(shard_range("2024-W03"), ("2024-01-15", "2024-01-21"))
+
+
+class TestShards(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.shard_dir = os.path.join(self.tmp.name, 'shards')
+
+    def write(self, boards, period='month'):
+        writer = ShardedTrainWriter(self.db_path, self.shard_dir, period)
+        try:
+            return [writer.write(board) for board in boards]
+        finally:
+            writer.close()
+
+    def shard_set(self):
+        shard_set = ShardSet(self.shard_dir)
+        self.addCleanup(shard_set.close)
+        return shard_set
+
+    def test_writes_go_to_the_shard_of_their_day(self):
+        stats = self.write([
+            [make_train("2024-01-31")],
+            [make_train("2024-01-31", track="9"), make_train("2024-02-01", track="7")],
+            [make_train("2024-02-01", track="7"), make_train("not a day")],
+        ])
+        self.assertEqual([(s.inserted, s.updated, s.unchanged, s.skipped) for s in stats],
+                         [(1, 0, 0, 0), (1, 1, 0, 0), (0, 0, 1, 1)])
+        shards = self.shard_set().shards()
+        self.assertEqual([(s.key, s.first_day, s.last_day, s.read_only) for s in shards],
+                         [("2024-01", "2024-01-01", "2024-01-31", False),
+                          ("2024-02", "2024-02-01", "2024-02-29", False)])
+        for shard, day, track in zip(shards, ("2024-01-31", "2024-02-01"), ("9", "7")):
+            conn = sqlite3.connect(shard.path)
+            self.assertEqual(conn.execute("SELECT day, track FROM train_track_locations").fetchall(), [(day, track)])
+            conn.close()
+        # The main database keeps no history of its own
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_locations").fetchone()[0], 0)
+        conn.close()
+
+    def test_writer_keeps_the_current_shard_open(self):
+        writer = ShardedTrainWriter(self.db_path, self.shard_dir)
+        self.addCleanup(writer.close)
+        writer.write([make_train("2024-01-31")])
+        writer.write([])
+        self.assertEqual(list(writer.writers), ["2024-01"])
+        # Late trains of the previous period keep it open alongside the current one
+        writer.write([make_train("2024-02-01"), make_train("2024-01-31", track="9")])
+        writer.write([make_train("2024-01-31", track="9")])
+        self.assertEqual(sorted(writer.writers), ["2024-01", "2024-02"])
+        writer.write([make_train("2024-02-01", track="7")])
+        self.assertEqual(list(writer.writers), ["2024-02"])
+
+    def test_weekly_shards(self):
+        self.write([[make_train("2024-01-14"), make_train("2024-01-15")]], period='week')
+        self.assertEqual([s.key for s in self.shard_set().shards()], ["2024-W02", "2024-W03"])
+        with self.assertRaises(ValueError):
+            ShardSet(self.shard_dir, 'month')
+
+    def test_connect_and_query_across_shards(self):
+        self.write([[make_train("2024-01-31", track="7")], [make_train("2024-02-01", track="3")],
+                    [make_train("2024-03-05", track="5")]])
+        shard_set = self.shard_set()
+        self.assertEqual([s.key for s in shard_set.shards("2024-01-15", "2024-02-15")], ["2024-01", "2024-02"])
+
+        conn = shard_set.connect("2024-01-15", "2024-02-15")
+        self.assertEqual(conn.execute("SELECT day, track FROM train_track_locations ORDER BY day").fetchall(),
+                         [("2024-01-31", "7"), ("2024-02-01", "3")])
+        conn.close()
+        conn = shard_set.connect("2023-01-01", "2023-12-31")
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_track_locations").fetchone()[0], 0)
+        conn.close()
+
+        sql = "SELECT day FROM train_track_locations ORDER BY day DESC"
+        self.assertEqual([day for day, in shard_set.query(sql, newest_first=True)],
+                         ["2024-03-05", "2024-02-01", "2024-01-31"])
+        self.assertEqual([day for day, in shard_set.query(sql, since_day="2024-03-01")], ["2024-03-05"])
+
+    def test_freeze(self):
+        self.write([[make_train("2024-01-31")], [make_train("2024-02-20")]])
+        shard_set = self.shard_set()
+        self.assertEqual(shard_set.freeze_finished("2024-02-20", grace_days=7), ["2024-01"])
+        frozen = shard_set.get("2024-01")
+        self.assertTrue(frozen.read_only)
+        self.assertFalse(os.access(frozen.path, os.W_OK) and os.stat(frozen.path).st_mode & 0o200)
+        self.assertFalse(shard_set.get("2024-02").read_only)
+
+        # Frozen shards are still read, immutable and memory-mapped
+        conn = shard_set.connect()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_track_locations").fetchone()[0], 2)
+        self.assertEqual(conn.execute("PRAGMA shard_0.journal_mode").fetchone()[0], "delete")
+        conn.close()
+        with self.assertRaisesRegex(ValueError, "read-only"):
+            self.write([[make_train("2024-01-31", track="9")]])
+
+    def test_attach_limit(self):
+        self.write([[make_train(f"2024-{month:02d}-01")] for month in range(1, 13)])
+        shard_set = self.shard_set()
+        with self.assertRaisesRegex(ValueError, "ShardSet.query"):
+            shard_set.connect()
+        self.assertEqual(len(list(shard_set.query("SELECT day FROM train_track_locations"))), 12)
+
+    def test_open_writer_without_shards(self):
+        writer = open_writer(self.db_path)
+        self.assertNotIsInstance(writer, ShardedTrainWriter)
+        writer.close()
+
+    @patch('app.current_day', return_value="2024-02-02")
+    def test_history_endpoint_reads_shards(self, mock_current_day):
+        self.write([[make_train("2024-01-31", track="7")], [make_train("2024-02-01", track="3")]])
+        app = create_app(self.db_path, check_interval=0, shard_dir=self.shard_dir)
+        self.addCleanup(app.extensions['response_cache'].close)
+        with patch('app.ShardSet', wraps=ShardSet) as mock_shard_set:
+            history = app.test_client().get('/trains/2275/history?days=1').get_json()
+            self.assertEqual([(row['day'], row['track']) for row in history['history']], [("2024-02-01", "3")])
+            history = app.test_client().get('/trains/2275/history?days=2').get_json()
+            self.assertEqual([row['day'] for row in history['history']], ["2024-02-01", "2024-01-31"])
+        # The manifest is opened once for the cache, not on every miss
+        self.assertEqual(mock_shard_set.call_count, 1)
+
+    def test_reparse_writes_to_shards(self):
+        self.write([[make_train("2024-01-15", number="241", track="1")]])
+        archive_path = os.path.join(self.tmp.name, 'archive.sqlite3')
+        archive = FragmentArchive(archive_path)
+        archive.record('NYP', "2024-01-15", *extract_target_fragments(SCRAPE_PAGE_HTML), 1)
+        archive.close()
+        stats = reparse(archive_path, self.db_path, workers=1, shard_dir=self.shard_dir)
+        self.assertEqual(stats.rows, 1)
+        self.assertEqual(list(self.shard_set().query("SELECT day, train_number, track FROM train_track_locations")),
+                         [("2024-01-15", "241", "6")])
+        conn = sqlite3.connect(self.db_path)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM train_locations").fetchone()[0], 0)
+        conn.close()
+
+    @unittest.skipUnless(pyarrow, "pyarrow is not installed")
+    def test_export_reads_shards(self):
+        self.write([[make_train("2024-01-31")], [make_train("2024-02-01"), make_train("2024-02-01", number="57")]])
+        out_dir = os.path.join(self.tmp.name, 'export')
+        stats = export(self.db_path, out_dir, shard_dir=self.shard_dir)
+        self.assertEqual((stats.days, stats.rows), (2, 3))
+
+    @unittest.skipUnless(numpy, "numpy is not installed")
+    def test_analytics_locations_read_shards(self):
+        self.write([[make_train("2024-01-31", status="Now 9:30PM")], [make_train("2024-02-01")]])
+        conn = sqlite3.connect(self.db_path)
+        self.addCleanup(conn.close)
+        history = load_history(conn, 'locations', shard_dir=self.shard_dir)
+        self.assertEqual(sorted(history.delay_minutes.tolist()), [0, 10])
+        self.assertEqual(len(load_history(conn, 'locations')), 0)
+
+    def test_maintain_prunes_shards(self):
+        self.write([[make_train("2024-01-31")], [make_train("2024-02-01")], [make_train("2024-02-20")]])
+        stats = run_maintenance(self.db_path, keep_history_days=10, today="2024-02-20", pause_seconds=0,
+                                shard_dir=self.shard_dir)
+        self.assertEqual(stats.pruned_rows, 2)
+        shard_set = self.shard_set()
+        self.assertEqual([shard.key for shard in shard_set.shards()], ["2024-02"])
+        self.assertFalse(os.path.exists(os.path.join(self.shard_dir, 'history-2024-01.sqlite3')))
+        self.assertEqual([day for day, in shard_set.query("SELECT day FROM train_track_locations")], ["2024-02-20"])
+
+    def test_shards_command(self):
+        self.write([[make_train("2024-01-31")], [make_train("2024-02-20")]])
+        output = io.StringIO()
+        db_path = os.path.join(self.tmp.name, 'unused.sqlite3')
+        with redirect_stdout(output), self.assertLogs('scrape', level='INFO'):
+            main(['--db', db_path, '--shards', self.shard_dir, 'shards', '--freeze'])
+        self.assertFalse(os.path.exists(db_path))
+        self.assertIn("2024-01: 2024-01-01 to 2024-01-31, 1 rows", output.getvalue())
+        self.assertIn("read-only", output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
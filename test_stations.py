@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from scrape import Station, TrainWriter
+from stations import HostRateLimiter, MultiStationPoller, load_stations
+from test_scrape import SCRAPE_PAGE_HTML, DatabaseTestCase
+
+OTHER_PAGE_HTML = (
+    SCRAPE_PAGE_HTML
+    .replace('amtrak-departures-target', 'departures')
+    .replace('amtrak-arrivals-target', 'arrivals')
+    .replace('>6<', '>2<')
+)
+
+STATIONS = [
+    Station('NYP', 'https://moynihantrainhall.nyc/transportation/', 'https://moynihantrainhall.nyc/'),
+    Station('PHL', 'https://example.com/phl/', 'https://example.com/',
+            departures_target_id='departures', arrivals_target_id='arrivals'),
+]
+
+
+def fake_fetch_page(client, station):
+    if station.code == 'NYP':
+        return SCRAPE_PAGE_HTML
+    return OTHER_PAGE_HTML
+
+
+class TestLoadStations(unittest.TestCase):
+    def test_load_stations(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump([{"code": "PHL", "url": "https://example.com/phl/", "departures_target_id": "departures"}], f)
+        try:
+            stations = load_stations(f.name)
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(stations, [Station('PHL', 'https://example.com/phl/', 'https://example.com/phl/',
+                                            departures_target_id='departures')])
+
+
+class TestHostRateLimiter(unittest.TestCase):
+    def test_spaces_requests_per_host(self):
+        limiter = HostRateLimiter(0.05)
+        start = time.monotonic()
+        limiter.wait('a.example.com')
+        limiter.wait('b.example.com')
+        self.assertLess(time.monotonic() - start, 0.04)
+        limiter.wait('a.example.com')
+        self.assertGreaterEqual(time.monotonic() - start, 0.045)
+
+
+class TestMultiStationPoller(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.writer = TrainWriter(self.db_path)
+
+    def tearDown(self):
+        self.writer.close()
+
+    @patch('stations.fetch_page', side_effect=fake_fetch_page)
+    def test_poll_tags_rows_with_station(self, mock_fetch_page):
+        """Test every station is polled and its rows are stored under its code"""
+        poller = MultiStationPoller(STATIONS, self.writer, parser='stream', client=object(),
+                                    parse_workers=1, min_host_interval=0)
+        try:
+            results = poller.poll(day="2024-01-15")
+            self.assertEqual(list(results), ['NYP', 'PHL'])
+            self.assertTrue(all(result.changed for result in results.values()))
+
+            # Each station keeps its own fingerprint
+            results = poller.poll(day="2024-01-15")
+            self.assertFalse(any(result.changed for result in results.values()))
+        finally:
+            poller.close()
+
+        conn = sqlite3.connect(self.db_path)
+        rows = conn.execute("SELECT station, train_number, track FROM train_track_locations ORDER BY station").fetchall()
+        events = conn.execute("SELECT DISTINCT station FROM train_events ORDER BY station").fetchall()
+        conn.close()
+        self.assertEqual(rows, [('NYP', '241', '6'), ('PHL', '241', '2')])
+        self.assertEqual(events, [('NYP',), ('PHL',)])
+
+    @patch('stations.fetch_page')
+    def test_failed_station_does_not_block_others(self, mock_fetch_page):
+        def fetch(client, station):
+            if station.code == 'PHL':
+                raise Exception("Failed to scrape: 500: Internal Server Error")
+            return SCRAPE_PAGE_HTML
+        mock_fetch_page.side_effect = fetch
+
+        poller = MultiStationPoller(STATIONS, self.writer, client=object(), min_host_interval=0)
+        try:
+            results = poller.poll(day="2024-01-15")
+        finally:
+            poller.close()
+        self.assertTrue(results['NYP'].changed)
+        self.assertIn("500", str(results['PHL']))
+
+
+if __name__ == '__main__':
+    unittest.main()